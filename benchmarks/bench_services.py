@@ -0,0 +1,133 @@
+""" Бенчмарк публичных эндпоинтов шлюза в одном процессе (см. stack.py).
+
+python benchmarks/bench_services.py --users 20 --items 50 --save results.json
+python benchmarks/bench_services.py --baseline results.json --tolerance 0.25
+
+Для каждого эндпоинта выводится количество запросов, req/s и перцентили p50/p95/p99 в миллисекундах.
+С --baseline результаты сравниваются с сохранёнными; при ухудшении p50 или req/s больше, чем на
+tolerance, скрипт завершается с кодом 1 """
+import argparse
+import collections
+import json
+import sys
+import time
+
+from stack import build_stack
+
+
+class Runner:
+    def __init__(self, app):
+        self.client = app.test_client()
+        self.timings = collections.defaultdict(list)
+
+    def call(self, method, path, name=None, **kwargs):
+        name = name or f'{method} {path}'
+        start = time.perf_counter()
+        r = self.client.open(path, method=method, **kwargs)
+        self.timings[name].append(time.perf_counter() - start)
+        if r.status_code >= 500:
+            raise RuntimeError(f'{name}: {r.status_code} {r.get_data(as_text=True)}')
+        return r
+
+
+def workload(runner, users, items, reads):
+    """ Регистрация, вход, наполнение списка, чтение, отметка купленным, удаление """
+    tokens = []
+    for i in range(users):
+        user = f'bench{i}'
+        r = runner.call('POST', '/register', json={"user": user, "password": "password"})
+        tokens.append(r.get_json()['token'])
+        runner.call('POST', '/auth', json={"user": user, "password": "password"})
+        runner.call('GET', '/auth', query_string={"token": tokens[-1]})
+
+    for token in tokens:
+        for j in range(items):
+            runner.call('POST', '/shoplist',
+                        json={"token": token, "name": f'item{j}', "shop": f'shop{j % 3}'})
+
+    for token in tokens:
+        for _ in range(reads):
+            runner.call('GET', '/shoplist', name=f'GET /shoplist ({items} items)',
+                        query_string={"token": token})
+
+    for token in tokens:
+        for j in range(0, items, 2):
+            runner.call('POST', '/shoplist/bought',
+                        json={"token": token, "name": f'item{j}', "shop": f'shop{j % 3}',
+                              "bought": "true"})
+        for j in range(1, items, 2):
+            runner.call('DELETE', '/shoplist',
+                        json={"token": token, "name": f'item{j}', "shop": f'shop{j % 3}'})
+
+
+def percentile(values, p):
+    values = sorted(values)
+    index = min(int(round(p / 100 * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def summarize(timings):
+    result = {}
+    for name, values in timings.items():
+        result[name] = {
+            "count": len(values),
+            "rps": round(len(values) / sum(values), 1),
+            "p50_ms": round(percentile(values, 50) * 1000, 3),
+            "p95_ms": round(percentile(values, 95) * 1000, 3),
+            "p99_ms": round(percentile(values, 99) * 1000, 3)
+        }
+    return result
+
+
+def compare(result, baseline, tolerance):
+    """ Список эндпоинтов, у которых p50 или req/s хуже базовых больше, чем на tolerance """
+    regressions = []
+    for name, current in result.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        if current['p50_ms'] > base['p50_ms'] * (1 + tolerance):
+            regressions.append(f"{name}: p50 {base['p50_ms']}ms -> {current['p50_ms']}ms")
+        if current['rps'] < base['rps'] * (1 - tolerance):
+            regressions.append(f"{name}: req/s {base['rps']} -> {current['rps']}")
+    return regressions
+
+
+def print_table(result):
+    print(f"{'endpoint':<34} {'count':>7} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for name, row in result.items():
+        print(f"{name:<34} {row['count']:>7} {row['rps']:>9} {row['p50_ms']:>9} "
+              f"{row['p95_ms']:>9} {row['p99_ms']:>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--items', type=int, default=50)
+    parser.add_argument('--reads', type=int, default=20, help='чтений списка на пользователя')
+    parser.add_argument('--save', help='сохранить результаты в JSON')
+    parser.add_argument('--baseline', help='сравнить с сохранёнными результатами')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args()
+
+    apps = build_stack()
+    runner = Runner(apps['api'])
+    workload(runner, args.users, args.items, args.reads)
+    result = summarize(runner.timings)
+    print_table(result)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(result, f, indent=4, ensure_ascii=False)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f'REGRESSION {line}')
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,152 @@
+""" Микробенчмарк проверки параметров и JSON: процессорное время на запрос Flask-приложения
+с прежним check_params (тело читается через request.get_json() на каждый параметр, стандартный
+json) и с common/validation (схема компилируется при объявлении маршрута, тело разбирается один
+раз, JSON через orjson, если он установлен).
+
+python benchmarks/bench_validation.py --requests 20000 --items 50
+
+Запросы вызывают WSGI-приложение напрямую, без тестового клиента, поэтому в замер попадает только
+обработка запроса Flask: маршрутизация, разбор тела, проверка параметров и сериализация ответа """
+import argparse
+import functools
+import io
+import os
+import sys
+import time
+
+from flask import Flask, jsonify, make_response, request
+from werkzeug.test import EnvironBuilder
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'services',
+                                'common'))
+import validation
+
+
+def legacy_check_params(params_get=None, params_post=None, params_delete=None, params_put=None):
+    """ check_params, который был скопирован в api.py, shoplist.py и database.py """
+    def __check_params(func):
+        @functools.wraps(func)
+        def check_params_inner(*args, **kwargs):
+            if request.method == 'GET':
+                for param in params_get:
+                    if not param in request.args:
+                        return make_response(jsonify({"error": "incorrect GET input"}), 400)
+            if request.method == 'POST':
+                for param in params_post:
+                    if not param in request.get_json().keys():
+                        return make_response(jsonify({"error": "incorrect POST input"}), 400)
+            return func(*args, **kwargs)
+
+        return check_params_inner
+
+    return __check_params
+
+
+def items_list(items):
+    return [{"user": "bench", "name": f'item{i}', "shop": f'shop{i % 3}', "amount": i,
+             "bought": "false", "version": i, "id": f'{i:024x}'} for i in range(items)]
+
+
+def legacy_app(items):
+    app = Flask('legacy')
+    data = items_list(items)
+
+    @app.route('/shoplist', methods=['POST'])
+    @legacy_check_params(params_post=['token', 'name'])
+    def add():
+        # как в api.shoplist: каждое поле читается отдельным вызовом get_json
+        params = {"user": request.get_json()['token'], "name": request.get_json()['name'],
+                  "bought": "false"}
+        if 'shop' in request.get_json():
+            params['shop'] = request.get_json()['shop']
+        if 'amount' in request.get_json():
+            params['amount'] = request.get_json()['amount']
+        return make_response(jsonify(params), 201)
+
+    @app.route('/shoplist', methods=['GET'])
+    @legacy_check_params(params_get=['token'])
+    def items_handler():
+        return jsonify(data)
+
+    return app
+
+
+def validation_app(items):
+    app = Flask('validation')
+    validation.setup_json(app)
+    data = items_list(items)
+
+    @app.route('/shoplist', methods=['POST'])
+    @validation.check_params(params_post={'token': str, 'name': str})
+    def add():
+        body = validation.request_params()
+        params = {"user": body['token'], "name": body['name'], "bought": "false"}
+        if 'shop' in body:
+            params['shop'] = body['shop']
+        if 'amount' in body:
+            params['amount'] = body['amount']
+        return make_response(jsonify(params), 201)
+
+    @app.route('/shoplist', methods=['GET'])
+    @validation.check_params(params_get=['token'])
+    def items_handler():
+        return jsonify(data)
+
+    return app
+
+
+def build_environ(method, **kwargs):
+    builder = EnvironBuilder(path='/shoplist', method=method, **kwargs)
+    try:
+        environ = builder.get_environ()
+    finally:
+        builder.close()
+    return environ, environ['wsgi.input'].read()
+
+
+def cpu_per_request(app, method, count, **kwargs):
+    """ Процессорное время одного запроса в микросекундах """
+    environ, body = build_environ(method, **kwargs)
+
+    def start_response(status, headers):
+        pass
+
+    def call():
+        request_environ = dict(environ)
+        request_environ['wsgi.input'] = io.BytesIO(body)
+        response = app.wsgi_app(request_environ, start_response)
+        b''.join(response)
+        if hasattr(response, 'close'):
+            response.close()
+
+    for _ in range(min(count, 1000)):
+        call()
+    start = time.process_time()
+    for _ in range(count):
+        call()
+    return (time.process_time() - start) / count * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=20000)
+    parser.add_argument('--items', type=int, default=50, help='элементов в ответе GET')
+    args = parser.parse_args()
+
+    cases = [
+        ('POST /shoplist', 'POST',
+         {"json": {"token": "t" * 50, "name": "milk", "shop": "shop1", "amount": 2}}),
+        (f'GET /shoplist ({args.items} items)', 'GET', {"query_string": {"token": "t" * 50}})
+    ]
+    legacy, current = legacy_app(args.items), validation_app(args.items)
+    print(f'JSON backend: {validation.backend}')
+    print(f'{"request":<28}{"legacy us":>12}{"validation us":>16}{"saved us":>12}{"saved":>9}')
+    for name, method, kwargs in cases:
+        before = cpu_per_request(legacy, method, args.requests, **kwargs)
+        after = cpu_per_request(current, method, args.requests, **kwargs)
+        print(f'{name:<28}{before:>12.1f}{after:>16.1f}{before - after:>12.1f}'
+              f'{(before - after) / before:>9.1%}')
+
+
+if __name__ == '__main__':
+    main()
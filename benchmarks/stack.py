@@ -0,0 +1,35 @@
+""" Все четыре сервиса в одном процессе (режим монолита, services/monolith):
+Redis и MongoDB заменены на fakeredis и mongomock """
+import os
+import sys
+
+
+services_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'services')
+
+
+def build_stack():
+    """ Импортировать сервисы поверх стендов в памяти, вернуть словарь имя -> Flask-приложение """
+    for name in ('common', 'api', 'auth', 'shoplist', 'database', 'monolith'):
+        path = os.path.join(services_dir, name)
+        if path not in sys.path:
+            sys.path.insert(0, path)
+    os.environ.setdefault('TRACE_EXPORTER', 'none')
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    # бенчмарк отправляет запросы одного пользователя быстрее любых лимитов шлюза
+    os.environ.setdefault('RATE_LIMITS', 'off')
+
+    import fakeredis
+    import mongomock
+    import pymongo
+    import redis
+
+    # сервисы создают клиентов при импорте, поэтому классы подменяются до него
+    redis.Redis = fakeredis.FakeRedis
+    pymongo.MongoClient = mongomock.MongoClient
+
+    import monolith
+    import api
+    import auth
+    import database
+    import shoplist
+    return {"api": api.app, "auth": auth.app, "shoplist": shoplist.app, "database": database.app}
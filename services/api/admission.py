@@ -0,0 +1,312 @@
+""" Допуск запросов в шлюз: ограничение частоты запросов пользователя и IP (token bucket в Redis)
+и ограничение количества запросов, одновременно обрабатываемых всеми процессами шлюза (тоже в Redis).
+
+Лимиты задаются по маршрутам ("<METHOD> <шаблон маршрута>", "*" - по умолчанию):
+{"POST /shoplist": {"user": [10, 20], "ip": null, "concurrency": 50}}
+- user, ip - [запросов в секунду, размер корзины]; null отключает ограничение
+- concurrency - максимум одновременных запросов маршрута во всех процессах шлюза
+RATE_LIMITS (JSON) дополняет и переопределяет default_limits, MAX_IN_FLIGHT - общий предел
+одновременных запросов всех процессов шлюза. Отклонённые запросы считаются по маршруту и причине:
+rate_user, rate_ip (429), route_concurrency (429), overload (503) """
+import json
+import math
+import os
+import threading
+import time
+import uuid
+
+from redis import RedisError
+
+import metrics
+
+
+# KEYS[1] - корзина (hash: tokens, ts); ARGV: запросов в секунду, размер корзины, время в мс
+# возвращает {1, 0}, если запрос допущен, или {0, мс до появления токена}
+token_bucket_script = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate / 1000)
+if tokens < 1 then
+    return {0, math.ceil((1 - tokens) * 1000 / rate)}
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens - 1, 'ts', now)
+-- полная корзина не отличается от отсутствующей, поэтому ключ живёт, пока она наполняется
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst * 1000 / rate) + 1000)
+return {1, 0}
+"""
+
+# KEYS - запросы в обработке (sorted set: id запроса -> срок аренды в мс): общий и маршрута;
+# ARGV: id запроса, время в мс, аренда в мс, пределы для каждого ключа
+# возвращает 0, если запрос допущен, или номер ключа, предел которого достигнут.
+# Аренда истекает, если процесс шлюза завершился, не освободив место
+in_flight_enter_script = """
+local now = tonumber(ARGV[2])
+local lease = tonumber(ARGV[3])
+for i = 1, #KEYS do
+    redis.call('ZREMRANGEBYSCORE', KEYS[i], '-inf', now)
+    if redis.call('ZCARD', KEYS[i]) >= tonumber(ARGV[3 + i]) then
+        return i
+    end
+end
+for i = 1, #KEYS do
+    redis.call('ZADD', KEYS[i], now + lease, ARGV[1])
+    redis.call('PEXPIRE', KEYS[i], lease)
+end
+return 0
+"""
+in_flight_leave_script = """
+for i = 1, #KEYS do
+    redis.call('ZREM', KEYS[i], ARGV[1])
+end
+return 0
+"""
+
+default_limits = {
+    "*": {"user": [20, 40], "ip": [50, 100]},
+    # подбор пароля и массовая регистрация
+    "POST /auth": {"ip": [5, 20]},
+    "POST /register": {"ip": [2, 20]},
+    "POST /shoplist/batch": {"user": [2, 10]},
+    # новые подключения к потоку событий
+    "GET /shoplist/events": {"user": [1, 5]}
+}
+# маршруты, к которым ограничения не применяются
+exempt_routes = {'/healthz', '/readyz', '/metrics', '/breakers'}
+# долгие потоки событий не учитываются в одновременных запросах независимо от RATE_LIMITS:
+# соединение не занимает обработчик апстримов, а открытые потоки заняли бы весь MAX_IN_FLIGHT
+unlimited_routes = {'GET /shoplist/events'}
+# сколько запросов шлюза одновременно обрабатывают auth, shoplist и MongoDB без роста задержек
+default_max_in_flight = 200
+
+
+def default_max_streams():
+    """ Предел потоков /shoplist/events процесса шлюза на потоках (api:app): каждый открытый поток
+    событий занимает поток воркера, поэтому в threaded им отдаётся не больше половины THREADS,
+    а sync-воркер, который обслуживает один запрос, поток событий не принимает """
+    worker_class = os.environ.get('WORKER_CLASS', 'threaded')
+    if worker_class == 'sync':
+        return 0
+    if worker_class == 'threaded':
+        return int(os.environ.get('THREADS', 4)) // 2
+    return 10000
+
+
+def route_name(method, rule):
+    return f'{method} {rule}'
+
+
+def load_limits():
+    """ RATE_LIMITS=off отключает ограничения частоты, остаётся только MAX_IN_FLIGHT """
+    if os.environ.get('RATE_LIMITS') == 'off':
+        return {}
+    limits = {route: dict(params) for route, params in default_limits.items()}
+    for route, params in json.loads(os.environ.get('RATE_LIMITS', '{}')).items():
+        limits.setdefault(route, {}).update(params)
+    return limits
+
+
+class Decision:
+    def __init__(self, allowed, reason=None, retry_after=0.0, ticket=None):
+        self.allowed = allowed
+        self.reason = reason
+        self.retry_after = retry_after
+        # место запроса в общем счётчике, освобождается в leave
+        self.ticket = ticket
+
+    @property
+    def status(self):
+        return 503 if self.reason == 'overload' else 429
+
+    @property
+    def message(self):
+        return "service overloaded" if self.reason == 'overload' else "rate limit exceeded"
+
+    def headers(self):
+        return {"Retry-After": str(max(1, math.ceil(self.retry_after)))}
+
+
+allowed = Decision(True)
+
+
+class Admission:
+    """ Лимиты шлюза; корзины token bucket и счётчики запросов в обработке общие для всех процессов
+    в Redis. При недоступном Redis запросы допускаются: ограничения не должны останавливать шлюз.
+    lease - через сколько секунд место запроса освобождается, если процесс не вызвал leave """
+
+    def __init__(self, redis, service, limits=None, max_in_flight=None, prefix='ratelimit',
+                 lease=None):
+        self.redis = redis
+        self.service = service
+        self.limits = limits if limits is not None else load_limits()
+        self.max_in_flight = max_in_flight if max_in_flight is not None else \
+            int(os.environ.get('MAX_IN_FLIGHT', default_max_in_flight))
+        self.prefix = prefix
+        # запрос не обрабатывается дольше дедлайна шлюза
+        self.lease = lease if lease is not None else \
+            float(os.environ.get('REQUEST_TIMEOUT', 10)) + 5
+        self.in_flight = 0
+        self.route_in_flight = {}
+        self.errors = 0
+        self._shed = {}
+        self._lock = threading.Lock()
+        self._bucket = redis.register_script(token_bucket_script)
+        self._enter = redis.register_script(in_flight_enter_script)
+        self._leave = redis.register_script(in_flight_leave_script)
+        self._routes = {}
+
+    def route_limits(self, route):
+        """ Лимиты маршрута вместе с лимитами "*", которые он не переопределяет """
+        limits = self._routes.get(route)
+        if limits is None:
+            limits = {**self.limits.get('*', {}), **self.limits.get(route, {})}
+            self._routes[route] = limits
+        return limits
+
+    def bucket(self, route, kind, identity):
+        """ (ключи, аргументы) скрипта token bucket или None, если лимита нет """
+        limit = self.route_limits(route).get(kind)
+        if not limit:
+            return None
+        rate, burst = limit
+        key = f'{self.prefix}:{kind}:{route}:{identity}'
+        return [key], [rate, burst, int(time.time() * 1000)]
+
+    def decide(self, route, kind, reply):
+        if reply is None or reply[0]:
+            return allowed
+        return self.shed(route, f'rate_{kind}', int(reply[1]) / 1000)
+
+    def check_rate(self, route, kind, identity):
+        """ kind - user или ip; списывает токен из корзины identity на маршруте route """
+        bucket = self.bucket(route, kind, identity)
+        if bucket is None:
+            return allowed
+        try:
+            reply = self._bucket(keys=bucket[0], args=bucket[1])
+        except RedisError:
+            self.count_error()
+            reply = None
+        return self.decide(route, kind, reply)
+
+    async def check_rate_async(self, route, kind, identity):
+        """ check_rate для клиента redis.asyncio """
+        bucket = self.bucket(route, kind, identity)
+        if bucket is None:
+            return allowed
+        try:
+            reply = await self._bucket(keys=bucket[0], args=bucket[1])
+        except RedisError:
+            self.count_error()
+            reply = None
+        return self.decide(route, kind, reply)
+
+    def in_flight_keys(self, route):
+        """ (ключи, пределы) счётчиков запросов маршрута или None, если маршрут не учитывается """
+        if route in unlimited_routes:
+            return None
+        keys, limits = [f'{self.prefix}:inflight:{self.service}'], [self.max_in_flight]
+        limit = self.route_limits(route).get('concurrency')
+        if limit is not None:
+            keys.append(f'{self.prefix}:inflight:{self.service}:{route}')
+            limits.append(limit)
+        return keys, limits
+
+    def enter_args(self, route):
+        counters = self.in_flight_keys(route)
+        if counters is None:
+            return None
+        keys, limits = counters
+        ticket = uuid.uuid4().hex
+        return ticket, keys, [ticket, int(time.time() * 1000), int(self.lease * 1000), *limits]
+
+    def entered(self, route, ticket, reply):
+        if reply:
+            reason = 'overload' if reply == 1 else 'route_concurrency'
+            return self.shed(route, reason, 1)
+        with self._lock:
+            self.in_flight += 1
+            self.route_in_flight[route] = self.route_in_flight.get(route, 0) + 1
+        return Decision(True, ticket=ticket)
+
+    def enter(self, route):
+        """ Занять место обработки запроса; после ответа нужно вызвать leave(route, decision) """
+        args = self.enter_args(route)
+        if args is None:
+            return allowed
+        ticket, keys, argv = args
+        try:
+            reply = self._enter(keys=keys, args=argv)
+        except RedisError:
+            self.count_error()
+            # место не занято, освобождать нечего
+            ticket, reply = None, 0
+        return self.entered(route, ticket, int(reply))
+
+    async def enter_async(self, route):
+        """ enter для клиента redis.asyncio """
+        args = self.enter_args(route)
+        if args is None:
+            return allowed
+        ticket, keys, argv = args
+        try:
+            reply = await self._enter(keys=keys, args=argv)
+        except RedisError:
+            self.count_error()
+            ticket, reply = None, 0
+        return self.entered(route, ticket, int(reply))
+
+    def left(self, route, decision):
+        """ Ключи, из которых нужно удалить место запроса, или None """
+        counters = self.in_flight_keys(route)
+        if counters is None:
+            return None
+        with self._lock:
+            self.in_flight -= 1
+            self.route_in_flight[route] -= 1
+        return counters[0] if decision.ticket is not None else None
+
+    def leave(self, route, decision):
+        keys = self.left(route, decision)
+        if keys is None:
+            return
+        try:
+            self._leave(keys=keys, args=[decision.ticket])
+        except RedisError:
+            # место освободится по истечении аренды
+            self.count_error()
+
+    async def leave_async(self, route, decision):
+        keys = self.left(route, decision)
+        if keys is None:
+            return
+        try:
+            await self._leave(keys=keys, args=[decision.ticket])
+        except RedisError:
+            self.count_error()
+
+    def shed(self, route, reason, retry_after):
+        with self._lock:
+            counts = self._shed.setdefault(route, {})
+            counts[reason] = counts.get(reason, 0) + 1
+        metrics.observe_shed(self.service, route, reason)
+        return Decision(False, reason, retry_after)
+
+    def count_error(self):
+        with self._lock:
+            self.errors += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "in_flight": self.in_flight,
+                "max_in_flight": self.max_in_flight,
+                "lease": self.lease,
+                "shed": {route: dict(counts) for route, counts in self._shed.items()},
+                "redis_errors": self.errors,
+                "limits": self.limits
+            }
+
@@ -1,69 +1,119 @@
 import functools
+import os
+import queue
 
-from flask import Flask, jsonify, request, make_response
-import requests
+from flask import Flask, Response, jsonify, request, make_response, g
 import json
+import redis as __redis
+
+import live_events
+import logs
+import metrics
+import deadline
+import tracing
+import service_client
+import validation
+from admission import Admission, default_max_streams, exempt_routes, route_name
+from health import register_health, upstream_check
+from token_cache import listen_invalidations, publish_invalidation, token_cache
+from validation import check_params, request_params
 
 
 app = Flask(__name__)
+logs.setup_logging(app, 'api')
+metrics.setup_metrics(app, 'api')
+tracing.setup_tracing(app, 'api')
+validation.setup_json(app)
+# дедлайн запроса, который передаётся всем сервисам цепочки
+deadline.setup_deadline(app, float(os.environ.get('REQUEST_TIMEOUT', 10)))
+service_client.register_breakers(app)
 auth_url = "http://auth:5000"
 shoplist_url = "http://shoplist:5000"
+auth_client = service_client.get_client('auth', auth_url)
+shoplist_client = service_client.get_client('shoplist', shoplist_url)
 json_headers = {'content-type': 'application/json'}
+register_health(app, {"auth": upstream_check(auth_client),
+                      "shoplist": upstream_check(shoplist_client)})
+redis = metrics.instrument_redis(__redis.Redis(host='redis', port=6379, db=2), 'api')
+admission = Admission(redis, 'api')
+# выход из сессии в любом процессе шлюза удаляет токен из кэшей всех процессов
+listen_invalidations(redis)
+# одно соединение pub/sub на процесс для всех подписчиков /shoplist/events
+event_hub = live_events.ThreadEventHub(
+    __redis.Redis(host='redis', port=6379, db=2),
+    queue_size=int(os.environ.get('EVENTS_QUEUE_SIZE', 100)),
+    max_subscribers=int(os.environ.get('EVENTS_MAX_SUBSCRIBERS', default_max_streams())))
+# интервал комментариев-heartbeat, по которым прокси и клиент видят, что соединение живо
+events_heartbeat = float(os.environ.get('EVENTS_HEARTBEAT', 15))
 
 
 def error(message, code):
     return make_response(jsonify({"error": message}), code)
 
 
-def check_params(params_get=None, params_post=None, params_delete=None, params_put=None):
-    def __check_params(func):
-        @functools.wraps(func)
-        def check_params_inner(*args, **kwargs):
-            if request.method == 'GET':
-                for param in params_get:
-                    if not param in request.args:
-                        return error("incorrect GET input", 400)
-            if request.method == 'POST':
-                for param in params_post:
-                    if not param in request.get_json().keys():
-                        return error("incorrect POST input", 400)
-            if request.method == 'DELETE':
-                for param in params_delete:
-                    if not param in request.get_json().keys():
-                        return error("incorrect DELETE input", 400)
-            if request.method == 'PUT':
-                for param in params_put:
-                    if not param in request.get_json().keys():
-                        return error("incorrect PUT input", 400)
-            return func(*args, **kwargs)
-
-        return check_params_inner
-
-    return __check_params
+def upstream_error(r, status=None):
+    """ Ошибка апстрима с его статусом (или status); сообщение - из JSON-тела, если оно есть """
+    message = "upstream error"
+    try:
+        message = r.json().get('error', message)
+    except (ValueError, AttributeError):
+        pass
+    response = error(message, status or r.status_code)
+    if 'Retry-After' in r.headers:
+        response.headers['Retry-After'] = r.headers['Retry-After']
+    return response
+
+
+def rejected(decision):
+    response = error(decision.message, decision.status)
+    response.headers.update(decision.headers())
+    return response
+
+
+def client_ip():
+    # адрес клиента передаёт nginx, шлюз напрямую снаружи недоступен
+    return request.headers.get('X-Real-IP', request.remote_addr)
+
+
+@app.before_request
+def admit_request():
+    """ Лимит одновременных запросов шлюза и частоты запросов с IP - до обращения к апстримам """
+    if request.url_rule is None or request.url_rule.rule in exempt_routes:
+        return None
+    route = route_name(request.method, request.url_rule.rule)
+    decision = admission.enter(route)
+    if not decision.allowed:
+        return rejected(decision)
+    g.admission = (route, decision)
+    decision = admission.check_rate(route, 'ip', client_ip())
+    if not decision.allowed:
+        return rejected(decision)
+    return None
+
+
+@app.teardown_request
+def release_request(exc):
+    entered = g.pop('admission', None)
+    if entered is not None:
+        admission.leave(*entered)
 
 
 def auth_needed(func):
+    """ Проверяет токен один раз на запрос, имя пользователя сохраняется в g.user """
     @functools.wraps(func)
     def check_auth(*args, **kwargs):
-        if request.method == 'GET':
-            app.logger.info('Wrapper GET request')
-            if 'token' in request.args:
-                token = request.args['token']
-                user = check_auth_token(token)
-                if user is None:
-                    return error('invalid token', 400)
-            else:
-                return error('token not set', 400)
-
-        elif request.method == 'POST':
-            app.logger.info("Wrapper POST request")
-            if 'token' in request.get_json():
-                token = request.get_json()['token']
-                user = check_auth_token(token)
-                if user is None:
-                    return error('invalid token', 400)
-            else:
-                return error('token not set', 400)
+        app.logger.debug('Wrapper %s request', request.method)
+        params = request_params()
+        if params is None or 'token' not in params:
+            return error('token not set', 400)
+        user = check_auth_token(params['token'])
+        if user is None:
+            return error('invalid token', 400)
+        g.user = user
+        decision = admission.check_rate(route_name(request.method, request.url_rule.rule),
+                                        'user', user)
+        if not decision.allowed:
+            return rejected(decision)
         return func(*args, **kwargs)
 
     return check_auth
@@ -71,16 +121,24 @@ def auth_needed(func):
 
 def check_auth_token(token):
     """ Проверить токен, возвращает имя пользователя или None """
-    r = requests.get(auth_url, params={"token": token})
-    if 'user' in r.json():
-        return r.json()['user']
+    user = token_cache.get(token)
+    if user is not None:
+        return user
+
+    # отзыв токена во время запроса в auth не должен оставить его в кэше
+    generation = token_cache.generation
+    r = auth_client.get(params={"token": token})
+    body = r.json()
+    if 'user' in body:
+        token_cache.put(token, body['user'], generation)
+        return body['user']
     else:
         return None
 
 
 def get_token(params):
     """ Получить токен авторизации по имени пользователя и паролю """
-    r = requests.post(auth_url, json=params)
+    r = auth_client.post(json=params)
     if r.status_code == 200:
         return r.json()['token']
     else:
@@ -107,12 +165,12 @@ def auth():
 
     # проверяем учетные данные и выдаём токен
     if request.method == 'POST':
-        user = request.get_json()['user']
-        params = {"user": user}
-        if 'password_encrypted' in request.get_json():
-            params['password_encrypted'] = request.get_json()['password_encrypted']
-        elif 'password' in request.get_json():
-            params['password'] = request.get_json()['password']
+        body = request_params()
+        params = {"user": body['user']}
+        if 'password_encrypted' in body:
+            params['password_encrypted'] = body['password_encrypted']
+        elif 'password' in body:
+            params['password'] = body['password']
         else:
             error("no password provided", 400)
         token = get_token(params)
@@ -121,23 +179,56 @@ def auth():
         return jsonify({"token": token})
 
 
+# POST: curl --header "Content-Type: application/json" --request POST --data '{ "token": "...", "all": true}' https://127.0.0.1/logout -k
+@app.route('/logout', methods=['POST'])
+@check_params(params_post=['token'])
+def logout():
+    body = request_params()
+    token = body['token']
+    r = auth_client.post('/logout', json={"token": token, "all": body.get('all', False)})
+    if r.status_code != 200:
+        publish_invalidation(redis, token=token)
+        return upstream_error(r)
+    publish_invalidation(redis, token=token,
+                         user=r.json()['user'] if body.get('all', False) else None)
+    return jsonify({"status": "success", "deleted": r.json()['deleted']})
+
+
 @app.route('/info', methods=['GET'])
 def get_services_metadata():
     """ Получить информацию о настройках сервисов """
-    auth_info = requests.get(auth_url + '/info') # пока только auth
-
-    metadata = {"auth": auth_info.json()}
+    auth_info = auth_client.get('/info')
+    shoplist_info = shoplist_client.get('/info')
+
+    metadata = {"auth": auth_info.json(),
+                "shoplist": shoplist_info.json(),
+                "api": {"token_cache": token_cache.stats(),
+                        "upstreams": service_client.stats(),
+                        "events": event_hub.stats(),
+                        "admission": admission.stats()}}
     return jsonify(metadata)
 
 @app.route('/shoplist', methods=['GET'])
 @auth_needed
 def shoplist_get_items():
-    token = request.args['token']
-    user = check_auth_token(token)
-
-    r = requests.get(shoplist_url, params={"user": user})
+    """ Список покупок с ETag (версия списка); при совпадении If-None-Match - 304 без тела.
+    С параметром since - только изменения списка после этой версии """
+    if 'since' in request.args:
+        r = shoplist_client.get(params={"user": g.user, "since": request.args['since']})
+        return Response(r.content, status=r.status_code, mimetype='application/json')
+
+    headers = {}
+    if 'If-None-Match' in request.headers:
+        headers['If-None-Match'] = request.headers['If-None-Match']
+    r = shoplist_client.get(params={"user": g.user}, headers=headers)
+    if r.status_code == 304:
+        return Response(status=304, headers={"ETag": r.headers['ETag']})
     if r.status_code == 200:
-        return jsonify(r.json())
+        # тело уже сериализовано сервисом shoplist; список, прочитанный не с primary, приходит без ETag
+        etag = {"ETag": r.headers['ETag']} if 'ETag' in r.headers else {}
+        return Response(r.content, mimetype='application/json', headers=etag)
+    if r.status_code >= 500:
+        return upstream_error(r)
     return error("incorrect input", 400)
 
 
@@ -145,58 +236,102 @@ def shoplist_get_items():
 @auth_needed
 @check_params(params_post=['name'], params_delete=['name', 'shop'])
 def shoplist():
-    token   = request.get_json()['token']
-    user    = check_auth_token(token)
-    name    = request.get_json()['name']
+    user    = g.user
+    body    = request_params()
+    name    = body['name']
 
     if request.method == 'POST':
-        if 'shop' in request.get_json():
-            shop = request.get_json()['shop']
-        else:
-            shop = ''
+        shop = body.get('shop', '')
         params = {"user": user, "name": name, "bought": "false", "shop": shop}
-        if 'amount' in request.get_json():
-            params['amount'] = request.get_json()['amount'] 
-        r = requests.post(shoplist_url, json=params)
+        if 'amount' in body:
+            params['amount'] = body['amount']
+        r = shoplist_client.post(json=params)
         if r.status_code == 200:
             return make_response(jsonify({"status": "success"}), 201)
-        return r.json()
+        return upstream_error(r)
 
     elif request.method == 'DELETE':
-        shop = request.get_json()['shop']
+        shop = body['shop']
         params = {"user": user, "name": name, "shop": shop}
-        r = requests.delete(shoplist_url, json=params)
+        r = shoplist_client.delete(json=params)
         if r.status_code == 200:
             return jsonify({"status": "success"})
-        return r.json()
+        return upstream_error(r)
+
 
+# GET: curl "https://127.0.0.1/shoplist/summary?token=..." -k
+@app.route('/shoplist/summary', methods=['GET'])
+@auth_needed
+def shoplist_summary():
+    r = shoplist_client.get('/summary', params={"user": g.user})
+    return Response(r.content, status=r.status_code, mimetype='application/json')
 
 
 @app.route('/shoplist/bought', methods=['POST'])
 @auth_needed
 @check_params(params_post=['name', 'bought'])
 def bought():
-    token = request.get_json()['token']
-    user = check_auth_token(token)
-    name = request.get_json()['name']
-    bought = request.get_json()['bought']
-    if 'shop' in request.get_json():
-        shop = request.get_json()['shop']
-    else:
-        shop = ''
-    r = requests.post(f'{shoplist_url}/bought',
-                      json={"user": user, "name": name, "bought": bought, "shop": shop})
-    return r.json()
+    body = request_params()
+    r = shoplist_client.post('/bought',
+                             json={"user": g.user, "name": body['name'], "bought": body['bought'],
+                                   "shop": body.get('shop', '')})
+    if r.status_code != 200:
+        return upstream_error(r)
+    return Response(r.content, mimetype='application/json')
+
+
+# POST: curl --header "Content-Type: application/json" --request POST --data '{ "token": "...", "operations": [{"op": "add", "name": "milk", "shop": "shop1"}, {"op": "delete", "name": "bread", "shop": ""}]}' https://127.0.0.1/shoplist/batch -k
+@app.route('/shoplist/batch', methods=['POST'])
+@auth_needed
+@check_params(params_post={'operations': list})
+def shoplist_batch():
+    body = request_params()
+    params = {"user": g.user, "operations": body['operations']}
+    if 'ordered' in body:
+        params['ordered'] = body['ordered']
+    r = shoplist_client.post('/batch', json=params)
+    return Response(r.content, status=r.status_code, mimetype='application/json')
+
+
+# GET: curl -N "https://127.0.0.1/shoplist/events?token=..." -k
+@app.route('/shoplist/events', methods=['GET'])
+@auth_needed
+def shoplist_events():
+    """ Поток событий изменения списка пользователя (Server-Sent Events); занимает поток воркера,
+    пока клиент подключен """
+    try:
+        subscription = event_hub.subscribe(g.user)
+    except __redis.RedisError:
+        return error("events unavailable", 503)
+    if subscription is None:
+        return error("too many subscribers", 503)
+
+    def stream():
+        # закрытие соединения клиентом прерывает генератор на очередной записи
+        try:
+            while True:
+                try:
+                    event = subscription.get(events_heartbeat)
+                except queue.Empty:
+                    yield b': heartbeat\n\n'
+                    continue
+                yield f"event: {event.get('type', 'change')}\ndata: ".encode() + \
+                    validation.dumps(event) + b'\n\n'
+        finally:
+            event_hub.unsubscribe(subscription)
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
 @app.route('/register', methods=['POST'])
 @check_params(params_post=['user', 'password'])
 def register():
-    user = request.get_json()['user']
-    password = request.get_json()['password']
-    r = requests.post(url=auth_url + '/register',
-                      json={"user": user, "password": password})
+    body = request_params()
+    r = auth_client.post('/register',
+                         json={"user": body['user'], "password": body['password']})
     if r.status_code != 201: # если юзер в итоге не создался, ошибка
-        return error(r.json()["error"], 400) 
+        # недоступность БД и истёкший дедлайн - не ошибка клиента
+        return upstream_error(r, r.status_code if r.status_code in (503, 504) else 400)
     else:
         return r.json()
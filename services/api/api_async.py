@@ -0,0 +1,481 @@
+""" Шлюз в режиме asyncio (aiohttp): те же маршруты и JSON-ответы, что и в api.py,
+но запросы к апстримам не блокируют процесс, а независимые запросы выполняются параллельно """
+import asyncio
+import functools
+import logging
+import os
+import time
+
+from aiohttp import web
+import redis.asyncio as aioredis
+
+import async_service_client
+import deadline
+import live_events
+import metrics
+import tracing
+import validation
+from admission import Admission, exempt_routes, route_name
+from circuit_breaker import CircuitOpen
+from token_cache import listen_invalidations_async, publish_invalidation_async, token_cache
+
+
+auth_url = "http://auth:5000"
+shoplist_url = "http://shoplist:5000"
+auth_client = async_service_client.get_client('auth', auth_url)
+shoplist_client = async_service_client.get_client('shoplist', shoplist_url)
+logger = logging.getLogger('api')
+routes = web.RouteTableDef()
+# одно соединение pub/sub на процесс для всех подписчиков /shoplist/events
+event_hub = live_events.EventHub(
+    aioredis.Redis(host='redis', port=6379),
+    queue_size=int(os.environ.get('EVENTS_QUEUE_SIZE', 100)),
+    max_subscribers=int(os.environ.get('EVENTS_MAX_SUBSCRIBERS', 10000)))
+redis = aioredis.Redis(host='redis', port=6379, db=2)
+admission = Admission(redis, 'api')
+# дедлайн запроса, который передаётся всем сервисам цепочки
+request_timeout = float(os.environ.get('REQUEST_TIMEOUT', 10))
+# интервал комментариев-heartbeat, по которым прокси и клиент видят, что соединение живо
+events_heartbeat = float(os.environ.get('EVENTS_HEARTBEAT', 15))
+
+
+def json_response(data, status=200):
+    """ Ответ, сериализованный JSON-бэкендом common/validation """
+    return web.Response(body=validation.dumps(data), status=status,
+                        content_type='application/json')
+
+
+def error(message, code):
+    return json_response({"error": message}, status=code)
+
+
+async def get_json(request):
+    """ Тело запроса, разобранное один раз на запрос """
+    if 'json' not in request:
+        try:
+            body = validation.loads(await request.read())
+        except ValueError:
+            body = None
+        request['json'] = body if isinstance(body, dict) else {}
+    return request['json']
+
+
+def check_params(params_get=None, params_post=None, params_delete=None, params_put=None):
+    """ Те же схемы, что и у check_params Flask-сервисов (common/validation) """
+    schemas = validation.compile_schemas(params_get, params_post, params_delete, params_put)
+
+    def __check_params(func):
+        @functools.wraps(func)
+        async def check_params_inner(request):
+            schema = schemas.get(request.method)
+            if schema is not None:
+                if request.method == 'GET':
+                    body = request.query
+                else:
+                    body = await get_json(request)
+                if schema.validate(body) is not None:
+                    return error(f"incorrect {request.method} input", 400)
+            return await func(request)
+
+        return check_params_inner
+
+    return __check_params
+
+
+def upstream_error(r, status=None):
+    """ Ошибка апстрима с его статусом (или status); сообщение - из JSON-тела, если оно есть """
+    message = "upstream error"
+    try:
+        message = r.json().get('error', message)
+    except (ValueError, AttributeError):
+        pass
+    response = error(message, status or r.status_code)
+    if 'Retry-After' in r.headers:
+        response.headers['Retry-After'] = r.headers['Retry-After']
+    return response
+
+
+def rejected(decision):
+    response = error(decision.message, decision.status)
+    response.headers.update(decision.headers())
+    return response
+
+
+def request_route(request):
+    resource = request.match_info.route.resource
+    return route_name(request.method, resource.canonical) if resource is not None else None
+
+
+def auth_needed(func):
+    """ Проверяет токен один раз на запрос, имя пользователя сохраняется в request['user'] """
+    @functools.wraps(func)
+    async def check_auth(request):
+        if request.method == 'GET':
+            params = request.query
+        else:
+            params = await get_json(request)
+
+        if 'token' not in params:
+            return error('token not set', 400)
+        user = await check_auth_token(params['token'])
+        if user is None:
+            return error('invalid token', 400)
+        request['user'] = user
+        decision = await admission.check_rate_async(request_route(request), 'user', user)
+        if not decision.allowed:
+            return rejected(decision)
+        return await func(request)
+
+    return check_auth
+
+
+async def check_auth_token(token):
+    """ Проверить токен, возвращает имя пользователя или None """
+    user = token_cache.get(token)
+    if user is not None:
+        return user
+
+    # отзыв токена во время запроса в auth не должен оставить его в кэше
+    generation = token_cache.generation
+    r = await auth_client.get(params={"token": token})
+    body = r.json()
+    if 'user' in body:
+        token_cache.put(token, body['user'], generation)
+        return body['user']
+    else:
+        return None
+
+
+async def get_token(params):
+    """ Получить токен авторизации по имени пользователя и паролю """
+    r = await auth_client.post(json=params)
+    if r.status_code == 200:
+        return r.json()['token']
+    else:
+        return None
+
+
+@routes.get('/auth')
+@check_params(params_get=['token'])
+async def auth_check(request):
+    token = request.query['token']
+    if not token:
+        return error("token not set", 401)
+
+    user = await check_auth_token(token)
+    if user:
+        return json_response({"user": user})
+    else:
+        return error("invalid token", 401)
+
+
+@routes.post('/auth')
+@check_params(params_post=['user'])
+async def auth_login(request):
+    body = await get_json(request)
+    params = {"user": body['user']}
+    if 'password_encrypted' in body:
+        params['password_encrypted'] = body['password_encrypted']
+    elif 'password' in body:
+        params['password'] = body['password']
+    token = await get_token(params)
+    if token is None:
+        return error("invalid credentials", 401)
+    return json_response({"token": token})
+
+
+@routes.post('/logout')
+@check_params(params_post=['token'])
+async def logout(request):
+    body = await get_json(request)
+    r = await auth_client.post('/logout',
+                               json={"token": body['token'], "all": body.get('all', False)})
+    if r.status_code != 200:
+        await publish_invalidation_async(redis, token=body['token'])
+        return upstream_error(r)
+    await publish_invalidation_async(
+        redis, token=body['token'], user=r.json()['user'] if body.get('all', False) else None)
+    return json_response({"status": "success", "deleted": r.json()['deleted']})
+
+
+@routes.get('/info')
+async def get_services_metadata(request):
+    """ Получить информацию о настройках сервисов, апстримы опрашиваются параллельно """
+    auth_info, shoplist_info = await asyncio.gather(auth_client.get('/info'),
+                                                    shoplist_client.get('/info'))
+
+    metadata = {"auth": auth_info.json(),
+                "shoplist": shoplist_info.json(),
+                "api": {"token_cache": token_cache.stats(),
+                        "upstreams": async_service_client.stats(),
+                        "events": event_hub.stats(),
+                        "admission": admission.stats()}}
+    return json_response(metadata)
+
+
+@routes.get('/healthz')
+async def healthz(request):
+    return json_response({"status": "ok"})
+
+
+@routes.get('/readyz')
+async def readyz(request):
+    """ Апстримы проверяются параллельно """
+    clients = [auth_client, shoplist_client]
+    responses = await asyncio.gather(*[client.get('/healthz') for client in clients],
+                                     return_exceptions=True)
+    results = {}
+    for client, r in zip(clients, responses):
+        if isinstance(r, Exception):
+            results[client.name] = str(r)
+        elif r.status_code != 200:
+            results[client.name] = f"status {r.status_code}"
+        else:
+            results[client.name] = "ok"
+    ready = all(result == "ok" for result in results.values())
+    return json_response({"status": "ok" if ready else "unavailable", "checks": results},
+                         status=200 if ready else 503)
+
+
+@routes.get('/breakers')
+async def breakers_handler(request):
+    return json_response(async_service_client.breakers())
+
+
+@routes.get('/metrics')
+async def metrics_handler(request):
+    body, content_type = metrics.render()
+    return web.Response(body=body, headers={'Content-Type': content_type})
+
+
+@web.middleware
+async def tracing_middleware(request, handler):
+    """ Span на каждый входящий запрос; задача aiohttp получает свою копию контекста """
+    resource = request.match_info.route.resource
+    rule = resource.canonical if resource is not None else request.path
+    span = tracing.start_span(f'{request.method} {rule}', 'server',
+                              request.headers.get(tracing.request_id_header),
+                              request.headers.get(tracing.span_id_header), 'api')
+    token = tracing.current_span.set(span)
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        response.headers[tracing.request_id_header] = span.trace_id
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        span.finish(status)
+        tracing.current_span.reset(token)
+
+
+@web.middleware
+async def deadline_middleware(request, handler):
+    """ Дедлайн запроса (как deadline.setup_deadline у Flask-сервисов) и быстрые ответы,
+    когда он истёк или circuit breaker апстрима открыт """
+    token = deadline.start(deadline.incoming_deadline(
+        request.headers.get(deadline.deadline_header), request_timeout))
+    try:
+        deadline.check()
+        return await handler(request)
+    except deadline.DeadlineExceeded as e:
+        return error(str(e), 504)
+    except CircuitOpen as e:
+        response = error(str(e), 503)
+        response.headers['Retry-After'] = '1'
+        return response
+    finally:
+        deadline.finish(token)
+
+
+@web.middleware
+async def admission_middleware(request, handler):
+    """ Лимит одновременных запросов шлюза и частоты запросов с IP - до обращения к апстримам """
+    route = request_route(request)
+    if route is None or request.match_info.route.resource.canonical in exempt_routes:
+        return await handler(request)
+    entered = await admission.enter_async(route)
+    if not entered.allowed:
+        return rejected(entered)
+    try:
+        decision = await admission.check_rate_async(
+            route, 'ip', request.headers.get('X-Real-IP', request.remote))
+        if not decision.allowed:
+            return rejected(decision)
+        return await handler(request)
+    finally:
+        await admission.leave_async(route, entered)
+
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        # шаблон маршрута, а не путь, чтобы не плодить метки
+        route = request.match_info.route.resource
+        route = route.canonical if route is not None else 'unmatched'
+        metrics.observe_request('api', route, request.method, status, time.perf_counter() - start)
+
+
+@routes.get('/shoplist')
+@auth_needed
+async def shoplist_get_items(request):
+    if 'since' in request.query:
+        r = await shoplist_client.get(params={"user": request['user'],
+                                              "since": request.query['since']})
+        return web.Response(body=r.content, status=r.status_code, content_type='application/json')
+
+    headers = {}
+    if 'If-None-Match' in request.headers:
+        headers['If-None-Match'] = request.headers['If-None-Match']
+    r = await shoplist_client.get(params={"user": request['user']}, headers=headers)
+    if r.status_code == 304:
+        return web.Response(status=304, headers={"ETag": r.headers['ETag']})
+    if r.status_code == 200:
+        etag = {"ETag": r.headers['ETag']} if 'ETag' in r.headers else {}
+        return web.Response(body=r.content, content_type='application/json', headers=etag)
+    if r.status_code >= 500:
+        return upstream_error(r)
+    return error("incorrect input", 400)
+
+
+@routes.post('/shoplist')
+@auth_needed
+@check_params(params_post=['name'])
+async def shoplist_add(request):
+    body = await get_json(request)
+    params = {"user": request['user'], "name": body['name'], "bought": "false",
+              "shop": body.get('shop', '')}
+    if 'amount' in body:
+        params['amount'] = body['amount']
+    r = await shoplist_client.post(json=params)
+    if r.status_code == 200:
+        return json_response({"status": "success"}, status=201)
+    return upstream_error(r)
+
+
+@routes.delete('/shoplist')
+@auth_needed
+@check_params(params_delete=['name', 'shop'])
+async def shoplist_delete(request):
+    body = await get_json(request)
+    params = {"user": request['user'], "name": body['name'], "shop": body['shop']}
+    r = await shoplist_client.delete(json=params)
+    if r.status_code == 200:
+        return json_response({"status": "success"})
+    return upstream_error(r)
+
+
+@routes.get('/shoplist/summary')
+@auth_needed
+async def shoplist_summary(request):
+    r = await shoplist_client.get('/summary', params={"user": request['user']})
+    return web.Response(body=r.content, status=r.status_code, content_type='application/json')
+
+
+@routes.post('/shoplist/bought')
+@auth_needed
+@check_params(params_post=['name', 'bought'])
+async def bought(request):
+    body = await get_json(request)
+    r = await shoplist_client.post('/bought',
+                                   json={"user": request['user'], "name": body['name'],
+                                         "bought": body['bought'], "shop": body.get('shop', '')})
+    if r.status_code != 200:
+        return upstream_error(r)
+    return web.Response(body=r.content, content_type='application/json')
+
+
+@routes.post('/shoplist/batch')
+@auth_needed
+@check_params(params_post={'operations': list})
+async def shoplist_batch(request):
+    body = await get_json(request)
+    params = {"user": request['user'], "operations": body['operations']}
+    if 'ordered' in body:
+        params['ordered'] = body['ordered']
+    r = await shoplist_client.post('/batch', json=params)
+    return web.Response(body=r.content, status=r.status_code, content_type='application/json')
+
+
+# GET: curl -N "https://127.0.0.1/shoplist/events?token=..." -k
+@routes.get('/shoplist/events')
+@auth_needed
+async def shoplist_events(request):
+    """ Поток событий изменения списка пользователя (Server-Sent Events) """
+    try:
+        subscription = await event_hub.subscribe(request['user'])
+    except aioredis.RedisError:
+        return error("events unavailable", 503)
+    if subscription is None:
+        return error("too many subscribers", 503)
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream",
+                                           "Cache-Control": "no-cache",
+                                           "X-Accel-Buffering": "no"})
+    try:
+        await response.prepare(request)
+        while True:
+            try:
+                event = await asyncio.wait_for(subscription.get(), events_heartbeat)
+            except asyncio.TimeoutError:
+                await response.write(b': heartbeat\n\n')
+                continue
+            # write ждёт, пока клиент примет данные; события медленного клиента копятся
+            # только в его очереди
+            await response.write(f"event: {event.get('type', 'change')}\ndata: ".encode() +
+                                 validation.dumps(event) + b'\n\n')
+    except ConnectionResetError:
+        pass
+    finally:
+        await event_hub.unsubscribe(subscription)
+    return response
+
+
+@routes.post('/register')
+@check_params(params_post=['user', 'password'])
+async def register(request):
+    body = await get_json(request)
+    r = await auth_client.post('/register',
+                               json={"user": body['user'], "password": body['password']})
+    if r.status_code != 201: # если юзер в итоге не создался, ошибка
+        # недоступность БД и истёкший дедлайн - не ошибка клиента
+        return upstream_error(r, r.status_code if r.status_code in (503, 504) else 400)
+    else:
+        return json_response(r.json())
+
+
+async def start_invalidations(app):
+    app['invalidations'] = asyncio.ensure_future(listen_invalidations_async(redis))
+
+
+async def close_clients(app):
+    app['invalidations'].cancel()
+    await event_hub.close()
+    await async_service_client.close_all()
+
+
+def create_app():
+    app = web.Application(middlewares=[metrics_middleware, tracing_middleware,
+                                             deadline_middleware, admission_middleware])
+    app.add_routes(routes)
+    app.on_startup.append(start_invalidations)
+    app.on_cleanup.append(close_clients)
+    return app
+
+
+app = create_app()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    web.run_app(app, host='0.0.0.0', port=5000)
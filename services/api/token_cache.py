@@ -0,0 +1,191 @@
+import asyncio
+import collections
+import json
+import logging
+import os
+import threading
+import time
+
+from redis import RedisError
+
+
+# канал, через который процессы шлюза сообщают друг другу об отозванных токенах:
+# {"token": ...} - один токен, {"user": ...} - все токены пользователя
+invalidation_channel = 'token_cache:invalidate'
+logger = logging.getLogger('token_cache')
+
+
+class TokenCache:
+    """ Кэш проверенных токенов: token -> (user, время проверки).
+    Ограничен по размеру (LRU) и по времени жизни записи (TTL).
+    Кэш работает, только пока процесс подписан на invalidation_channel (active): без подписки
+    он не узнает о выходе пользователя через другой процесс шлюза.
+    generation меняется при каждом удалении записей: проверка токена в auth запоминает его до
+    запроса, и put не сохраняет ответ, если за время запроса пришёл отзыв """
+
+    def __init__(self, max_size=10000, ttl=30):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.active = False
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.generation = 0
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token):
+        """ Получить пользователя по токену или None, если записи нет или она устарела """
+        if self.ttl <= 0 or not self.active:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            entry = self._items.get(token)
+            if entry is None:
+                self.misses += 1
+                return None
+            user, checked_at = entry
+            if now - checked_at > self.ttl:
+                del self._items[token]
+                self.misses += 1
+                return None
+            self._items.move_to_end(token)
+            self.hits += 1
+            return user
+
+    def put(self, token, user, generation=None):
+        """ generation - значение self.generation до запроса в auth """
+        if self.ttl <= 0 or not self.active:
+            return
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._items[token] = (user, time.monotonic())
+            self._items.move_to_end(token)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, token):
+        with self._lock:
+            self.generation += 1
+            self._items.pop(token, None)
+
+    def invalidate_user(self, user):
+        """ Удалить все токены пользователя (выход из всех сессий) """
+        with self._lock:
+            self.generation += 1
+            tokens = [token for token, (owner, _) in self._items.items() if owner == user]
+            for token in tokens:
+                del self._items[token]
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._items.clear()
+
+    def apply(self, data):
+        """ Применить сообщение из invalidation_channel """
+        message = json.loads(data)
+        if 'token' in message:
+            self.invalidate(message['token'])
+        if 'user' in message:
+            self.invalidate_user(message['user'])
+        with self._lock:
+            self.invalidations += 1
+
+    def set_active(self, active):
+        """ Подписка установлена или потеряна; сообщения без подписки потеряны, поэтому кэш
+        очищается в обоих случаях """
+        self.clear()
+        self.active = active
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._items),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "active": self.active,
+                "invalidations": self.invalidations,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / total if total else 0.0
+            }
+
+
+# окно, в течение которого проверенный токен считается валидным без запроса в auth;
+# TOKEN_CACHE_TTL=0 отключает кэш между запросами
+token_cache = TokenCache(max_size=int(os.environ.get('TOKEN_CACHE_SIZE', 10000)),
+                         ttl=float(os.environ.get('TOKEN_CACHE_TTL', 30)))
+
+
+def invalidation_message(token=None, user=None):
+    message = {}
+    if token is not None:
+        message['token'] = token
+    if user is not None:
+        message['user'] = user
+    return json.dumps(message)
+
+
+def publish_invalidation(client, token=None, user=None):
+    """ Отозвать токен (или все токены user) в кэшах всех процессов шлюза """
+    token_cache.apply(invalidation_message(token, user))
+    try:
+        client.publish(invalidation_channel, invalidation_message(token, user))
+    except RedisError as e:
+        logger.warning('token invalidation not published: %s', e)
+
+
+async def publish_invalidation_async(client, token=None, user=None):
+    """ publish_invalidation для клиента redis.asyncio """
+    token_cache.apply(invalidation_message(token, user))
+    try:
+        await client.publish(invalidation_channel, invalidation_message(token, user))
+    except RedisError as e:
+        logger.warning('token invalidation not published: %s', e)
+
+
+def listen_invalidations(client, cache=token_cache):
+    """ Фоновый поток процесса: подписка на invalidation_channel с переподключением """
+    def listen():
+        while True:
+            try:
+                pubsub = client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(invalidation_channel)
+                cache.set_active(True)
+                while True:
+                    message = pubsub.get_message(timeout=1.0)
+                    if message is not None and message['type'] == 'message':
+                        cache.apply(message['data'])
+            except RedisError as e:
+                if cache.active:
+                    logger.warning('token invalidation subscription lost: %s', e)
+                cache.set_active(False)
+                time.sleep(1)
+
+    thread = threading.Thread(target=listen, name='token-cache-invalidation', daemon=True)
+    thread.start()
+    return thread
+
+
+async def listen_invalidations_async(client, cache=token_cache):
+    """ listen_invalidations для клиента redis.asyncio: задача, а не поток """
+    while True:
+        try:
+            pubsub = client.pubsub(ignore_subscribe_messages=True)
+            await pubsub.subscribe(invalidation_channel)
+            cache.set_active(True)
+            while True:
+                message = await pubsub.get_message(timeout=1.0)
+                if message is not None and message['type'] == 'message':
+                    cache.apply(message['data'])
+        except RedisError as e:
+            if cache.active:
+                logger.warning('token invalidation subscription lost: %s', e)
+            cache.set_active(False)
+            await asyncio.sleep(1)
@@ -1,26 +1,81 @@
 from flask import Flask, jsonify, request, make_response
 import hashlib
+import json
+import os
 import string
 import random
-import requests
+import time
 import redis as __redis
 
+import logs
+import metrics
+import deadline
+import tracing
+import service_client
+import validation
+from health import register_health, upstream_check
+from validation import check_params, request_params
+
 
 def error(message, code):
     return make_response(jsonify({"error": message}), code)
 
 
 token_ttl = 86400
+# TTL токена продлевается только когда оставшееся время меньше порога, а не на каждую проверку
+token_refresh_threshold = int(os.environ.get('TOKEN_REFRESH_THRESHOLD', token_ttl - 3600))
+# максимальное количество активных сессий пользователя, 0 - без ограничений;
+# новая сессия сверх него вытесняет самую старую
+max_sessions = int(os.environ.get('MAX_SESSIONS', 20))
+# канал, по которому шлюз удаляет отозванные токены из кэшей своих процессов (api/token_cache.py)
+invalidation_channel = 'token_cache:invalidate'
 app = Flask(__name__)
-redis = __redis.Redis(host='redis', port=6379, db=0)
+logs.setup_logging(app, 'auth')
+metrics.setup_metrics(app, 'auth')
+tracing.setup_tracing(app, 'auth')
+validation.setup_json(app)
+deadline.setup_deadline(app)
+service_client.register_breakers(app)
+redis = metrics.instrument_redis(__redis.Redis(host='redis', port=6379, db=0), 'auth')
+
+# KEYS[1] - токен, KEYS[2] - индекс сессий пользователя (sorted set: токен -> время истечения)
+# ARGV: пользователь, ttl, текущее время, максимум сессий
+# возвращает токены вытесненных сессий: сессии с самым ранним временем истечения
+create_session = redis.register_script("""
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', ARGV[3])
+local evicted = {}
+if tonumber(ARGV[4]) > 0 then
+    while redis.call('ZCARD', KEYS[2]) >= tonumber(ARGV[4]) do
+        local oldest = redis.call('ZPOPMIN', KEYS[2])[1]
+        redis.call('DEL', oldest)
+        table.insert(evicted, oldest)
+    end
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+redis.call('ZADD', KEYS[2], tonumber(ARGV[3]) + tonumber(ARGV[2]), KEYS[1])
+redis.call('EXPIRE', KEYS[2], ARGV[2])
+return evicted
+""")
+# KEYS[1] - индекс сессий пользователя; удаляет все его токены, возвращает их количество
+delete_sessions = redis.register_script("""
+local tokens = redis.call('ZRANGE', KEYS[1], 0, -1)
+for _, token in ipairs(tokens) do
+    redis.call('DEL', token)
+end
+redis.call('DEL', KEYS[1])
+return #tokens
+""")
 database_url = 'http://database:5000'
+database_client = service_client.get_client('database', database_url)
+register_health(app, {"redis": redis.ping, "database": upstream_check(database_client)})
 
 
 @app.route('/register', methods=['POST'])
+@check_params(params_post={'user': str, 'password': str})
 def register():
-    user = request.get_json()['user']
-    password = request.get_json()['password']
-    password = encode_password(password)
+    body = request_params()
+    user = body['user']
+    password = encode_password(body['password'])
 
     data = {
         "database": "organizer", "collection": "users",
@@ -35,31 +90,35 @@ def register():
         return error("user exists", 400)
 
     # вносим юзера в БД
-    r = requests.post(database_url + '/', json=data)
+    r = database_client.post('/', json=data)
 
     if r.status_code == 201:
         return jsonify({"token": generate_token(user)}), 201
     elif r.status_code == 400:
         return error("something went wrong", 400)
+    elif r.status_code == 504:
+        return error("deadline exceeded", 504)
+    else:
+        return error("database unavailable", 503)
 
 
 @app.route('/', methods=['GET', 'POST'])
+@check_params(params_post=['user'])
 def auth():
     if request.method == 'POST':
         # войти с именем юзера и паролем
-        user = request.get_json()['user']
-        if 'password_encrypted' in request.get_json():
+        body = request_params()
+        user = body['user']
+        if 'password_encrypted' in body:
             # значит пароль уже пришел зашифрованным
-            password = request.get_json()['password_encrypted']
+            password = body['password_encrypted']
         else:
             # иначе нужно зашифровать
-            password = encode_password(request.get_json()['password'])
+            password = encode_password(body['password'])
             
         if is_password_match(user, password):
             token = generate_token(user)
-            app.logger.info(f'token: {token}')
-            if not token:
-                return error("max tokens exceeded", 400)
+            app.logger.debug('token issued for %s', user)
             return jsonify({"token": token})
         return error("invalid credentials", 401)
 
@@ -75,20 +134,57 @@ def auth():
         else:
             return error("invalid token", 401)
 
+@app.route('/logout', methods=['POST'])
+def logout():
+    # завершить сессию токена или, при "all" = true, все сессии его владельца
+    body = request_params()
+    if body is None or 'token' not in body:
+        return error("no token provided", 400)
+    token = body['token']
+    user = get_user_by_token(token, refresh=False)
+    if not user:
+        return error("invalid token", 401)
+
+    if body.get('all', False):
+        deleted = delete_sessions(keys=[sessions_key(user)])
+    else:
+        deleted = delete_session(user, token)
+    return jsonify({"status": "success", "user": user, "deleted": deleted})
+
+
 @app.route('/info', methods=['GET'])
 def get_service_info():
-    return jsonify({"token_ttl": token_ttl})
+    return jsonify({"token_ttl": token_ttl,
+                    "token_refresh_threshold": token_refresh_threshold,
+                    "max_sessions": max_sessions,
+                    "upstreams": service_client.stats()})
+
+
+def sessions_key(user):
+    return f'sessions:{user}'
+
 
 def generate_token(user):
+    """ Создать сессию одним запросом к Redis; сверх max_sessions вытесняются самые старые """
     letters = string.ascii_letters
     token = ''.join(random.choice(letters) for i in range(50))
-    redis.set(token, user)
-    redis.expire(token, token_ttl)
+    evicted = create_session(keys=[token, sessions_key(user)],
+                             args=[user, token_ttl, time.time(), max_sessions])
+    for old_token in evicted:
+        app.logger.info('session of %s evicted by a new login', user)
+        redis.publish(invalidation_channel, json.dumps({"token": old_token.decode()}))
     return token
 
 
+def delete_session(user, token):
+    pipe = redis.pipeline()
+    pipe.delete(token)
+    pipe.zrem(sessions_key(user), token)
+    return pipe.execute()[0]
+
+
 def get_user_by_name(user):
-    r = requests.get(database_url, 
+    r = database_client.get(
         params = {
             "database":     "organizer",
             "collection":   "users",
@@ -103,8 +199,8 @@ def get_user_by_name(user):
 
 def is_password_match(user, password_encoded):
     user = get_user_by_name(user)
-    app.logger.info(f'{user["user"]}: {user["password"]}')
     if user:
+        app.logger.debug('password check for %s', user["user"])
         if user['password'] == password_encoded:
             return True
     return False
@@ -114,11 +210,19 @@ def encode_password(password):
     return hashlib.md5(password.encode()).hexdigest()
 
 
-def get_user_by_token(token):
-    user = redis.get(token)
-    if user:
-        redis.expire(token, token_ttl)
-        user = user.decode()
-        return user
-    else:
+def get_user_by_token(token, refresh=True):
+    pipe = redis.pipeline(transaction=False)
+    pipe.get(token)
+    pipe.ttl(token)
+    user, ttl = pipe.execute()
+    if not user:
         return None
+    user = user.decode()
+
+    if refresh and ttl < token_refresh_threshold:
+        pipe = redis.pipeline()
+        pipe.expire(token, token_ttl)
+        pipe.zadd(sessions_key(user), {token: time.time() + token_ttl}, xx=True)
+        pipe.expire(sessions_key(user), token_ttl)
+        pipe.execute()
+    return user
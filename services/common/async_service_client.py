@@ -0,0 +1,164 @@
+""" Асинхронный (aiohttp) вариант service_client для шлюза в режиме asyncio.
+Для каждого апстрима держится свой пул keep-alive соединений и свой circuit breaker """
+import asyncio
+import json
+import os
+import time
+
+import aiohttp
+
+import deadline
+import metrics
+import tracing
+from circuit_breaker import CircuitBreaker
+
+
+# в asyncio-режиме один процесс держит тысячи запросов, поэтому пул по умолчанию больше
+pool_size = int(os.environ.get('SERVICE_POOL_SIZE', 100))
+connect_timeout = float(os.environ.get('SERVICE_CONNECT_TIMEOUT', 2))
+read_timeout = float(os.environ.get('SERVICE_READ_TIMEOUT', 30))
+
+_clients = {}
+
+
+class ServiceResponse:
+    """ Ответ апстрима с тем же интерфейсом, что и у requests.Response (status_code, json()) """
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class AsyncServiceClient:
+    """ Клиент одного апстрима; сессия создаётся при первом запросе внутри event loop """
+
+    def __init__(self, name, base_url, pool_size=pool_size,
+                 timeout=(connect_timeout, read_timeout)):
+        self.name = name
+        self.base_url = base_url.rstrip('/')
+        self.pool_size = pool_size
+        self.timeout = aiohttp.ClientTimeout(sock_connect=timeout[0], sock_read=timeout[1])
+        self.requests = 0
+        self.errors = 0
+        self.connections = 0
+        self.reused = 0
+        self._session = None
+        self.breaker = CircuitBreaker(name)
+
+    def url(self, path=''):
+        if path and not path.startswith('/'):
+            path = '/' + path
+        return self.base_url + (path or '/')
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            trace = aiohttp.TraceConfig()
+            trace.on_connection_create_end.append(self._on_connection_create)
+            trace.on_connection_reuseconn.append(self._on_connection_reuse)
+            connector = aiohttp.TCPConnector(limit=self.pool_size)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout,
+                                                  trace_configs=[trace])
+        return self._session
+
+    async def _on_connection_create(self, session, context, params):
+        self.connections += 1
+
+    async def _on_connection_reuse(self, session, context, params):
+        self.reused += 1
+
+    async def request(self, method, path='', params=None, **kwargs):
+        left = deadline.remaining()
+        if left is not None:
+            if left <= 0:
+                raise deadline.DeadlineExceeded("deadline exceeded")
+            kwargs['timeout'] = aiohttp.ClientTimeout(total=left,
+                                                      sock_connect=self.timeout.sock_connect,
+                                                      sock_read=self.timeout.sock_read)
+        probe = self.breaker.before_call()
+        self.requests += 1
+        span = tracing.start_span(f'{method} {self.name} {path or "/"}', 'client')
+        kwargs['headers'] = {**(kwargs.get('headers') or {}), **tracing.outgoing_headers(span),
+                             **deadline.outgoing_headers()}
+        start = time.perf_counter()
+        status = 'error'
+        try:
+            async with self._get_session().request(method, self.url(path), params=params,
+                                                   **kwargs) as r:
+                content = await r.read()
+                status = r.status
+                return ServiceResponse(r.status, r.headers, content)
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+            self.errors += 1
+            if isinstance(e, asyncio.TimeoutError) and expired():
+                raise deadline.DeadlineExceeded("deadline exceeded") from e
+            raise
+        except asyncio.CancelledError:
+            # клиент шлюза отключился, апстрим тут ни при чём
+            status = 'cancelled'
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            # ответ, который не успел к дедлайну вызывающего, не говорит о здоровье апстрима
+            failed = status == 'error' or (status != 'cancelled' and status >= 500)
+            self.breaker.after_call(probe, failed and not expired(), seconds)
+            metrics.observe_upstream(span.service, self.name, method, status, seconds)
+            span.finish(status)
+
+    async def get(self, path='', **kwargs):
+        return await self.request('GET', path, **kwargs)
+
+    async def post(self, path='', **kwargs):
+        return await self.request('POST', path, **kwargs)
+
+    async def put(self, path='', **kwargs):
+        return await self.request('PUT', path, **kwargs)
+
+    async def delete(self, path='', **kwargs):
+        return await self.request('DELETE', path, **kwargs)
+
+    def stats(self):
+        return {
+            "url": self.base_url,
+            "requests": self.requests,
+            "errors": self.errors,
+            "connections": self.connections,
+            "reused": self.reused,
+            "pool_size": self.pool_size,
+            "breaker": self.breaker.state
+        }
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+def get_client(name, base_url, **kwargs):
+    """ Вернуть клиент апстрима, создав его при первом обращении """
+    client = _clients.get(name)
+    if client is None:
+        client = AsyncServiceClient(name, base_url, **kwargs)
+        _clients[name] = client
+    return client
+
+
+def expired():
+    left = deadline.remaining()
+    return left is not None and left <= 0
+
+
+def stats():
+    return {client.name: client.stats() for client in _clients.values()}
+
+
+def breakers():
+    return {client.name: client.breaker.stats() for client in _clients.values()}
+
+
+async def close_all():
+    for client in list(_clients.values()):
+        await client.close()
@@ -0,0 +1,138 @@
+""" Circuit breaker для запросов к апстриму.
+
+closed - запросы идут в апстрим, результаты считаются в скользящем окне window секунд.
+Если за окно было не меньше min_calls запросов и доля неудачных (ошибка соединения, таймаут,
+статус 5xx или ответ дольше slow_call секунд) достигла failure_rate, breaker переходит в open:
+запросы сразу завершаются CircuitOpen без обращения к апстриму.
+Через open_seconds breaker переходит в half_open и пропускает не больше probes пробных запросов
+одновременно; после probes успешных подряд он снова closed, после неудачного - снова open,
+а время open удваивается (не больше max_open_seconds) """
+import os
+import threading
+import time
+
+import metrics
+
+
+failure_rate = float(os.environ.get('BREAKER_FAILURE_RATE', 0.5))
+min_calls = int(os.environ.get('BREAKER_MIN_CALLS', 20))
+window = int(os.environ.get('BREAKER_WINDOW', 10))
+slow_call = float(os.environ.get('BREAKER_SLOW_CALL', 5))
+open_seconds = float(os.environ.get('BREAKER_OPEN_SECONDS', 5))
+max_open_seconds = float(os.environ.get('BREAKER_MAX_OPEN_SECONDS', 60))
+probes = int(os.environ.get('BREAKER_PROBES', 3))
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, name, failure_rate=failure_rate, min_calls=min_calls,
+                 window=window, slow_call=slow_call, open_seconds=open_seconds,
+                 max_open_seconds=max_open_seconds, probes=probes):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.slow_call = slow_call
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.probes = probes
+        self.state = 'closed'
+        self.rejected = 0
+        self.opened = 0
+        self._lock = threading.Lock()
+        # окно по секундам: [секунда, запросов, неудачных]
+        self._buckets = [[0, 0, 0] for _ in range(window)]
+        self._open_until = 0.0
+        self._open_for = open_seconds
+        self._probing = 0
+        self._probe_successes = 0
+
+    def before_call(self):
+        """ CircuitOpen, если запрос в апстрим сейчас не нужно отправлять.
+        Возвращает True для пробного запроса в half_open; результат передаётся в after_call """
+        with self._lock:
+            if self.state == 'open':
+                if time.monotonic() < self._open_until:
+                    self.rejected += 1
+                    raise CircuitOpen(f"circuit open for {self.name}")
+                self._set_state('half_open')
+            if self.state == 'half_open':
+                if self._probing >= self.probes:
+                    self.rejected += 1
+                    raise CircuitOpen(f"circuit half-open for {self.name}")
+                self._probing += 1
+                return True
+            return False
+
+    def after_call(self, probe, failed, seconds):
+        failed = failed or seconds >= self.slow_call
+        with self._lock:
+            if probe:
+                if self.state != 'half_open':
+                    return
+                self._probing -= 1
+                if failed:
+                    self._open(self._open_for * 2)
+                else:
+                    self._probe_successes += 1
+                    if self._probe_successes >= self.probes:
+                        self._set_state('closed')
+                        self._open_for = self.open_seconds
+                        self._reset_window()
+                return
+            if self.state != 'closed':
+                # ответ на запрос, отправленный до перехода в open
+                return
+
+            second = int(time.monotonic())
+            bucket = self._buckets[second % self.window]
+            if bucket[0] != second:
+                bucket[:] = [second, 0, 0]
+            bucket[1] += 1
+            bucket[2] += failed
+            if failed:
+                calls, failures = self._totals(second)
+                if calls >= self.min_calls and failures >= calls * self.failure_rate:
+                    self._open(self.open_seconds)
+
+    def _totals(self, second):
+        calls = failures = 0
+        for bucket_second, bucket_calls, bucket_failures in self._buckets:
+            if second - bucket_second < self.window:
+                calls += bucket_calls
+                failures += bucket_failures
+        return calls, failures
+
+    def _reset_window(self):
+        for bucket in self._buckets:
+            bucket[:] = [0, 0, 0]
+
+    def _open(self, seconds):
+        self._open_for = min(seconds, self.max_open_seconds)
+        self._open_until = time.monotonic() + self._open_for
+        self.opened += 1
+        self._set_state('open')
+
+    def _set_state(self, state):
+        self.state = state
+        self._probing = 0
+        self._probe_successes = 0
+        metrics.observe_breaker(self.name, state)
+
+    def stats(self):
+        with self._lock:
+            calls, failures = self._totals(int(time.monotonic()))
+            return {
+                "state": self.state,
+                "calls": calls,
+                "failures": failures,
+                "window": self.window,
+                "opened": self.opened,
+                "rejected": self.rejected,
+                "open_for": self._open_for if self.state != 'closed' else 0,
+                "retry_in": max(self._open_until - time.monotonic(), 0)
+                if self.state == 'open' else 0
+            }
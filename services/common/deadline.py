@@ -0,0 +1,101 @@
+""" Дедлайн запроса, общий для всей цепочки сервисов.
+
+Шлюз назначает запросу дедлайн (REQUEST_TIMEOUT секунд), service_client передаёт апстриму
+оставшееся время в заголовке X-Request-Timeout (в миллисекундах) и ограничивает им таймаут
+запроса. Сервис, получивший заголовок, продолжает тот же дедлайн: запрос с истёкшим временем
+сразу получает 504, а service_client не отправляет запросы после дедлайна (DeadlineExceeded).
+Оставшееся время считается по монотонным часам каждого процесса, поэтому расхождение часов
+между контейнерами не влияет на дедлайн """
+import contextlib
+import contextvars
+import time
+
+from flask import g, jsonify, make_response, request
+
+
+deadline_header = 'X-Request-Timeout'
+
+# момент time.monotonic(), после которого работа над запросом не нужна; None - без дедлайна
+current_deadline = contextvars.ContextVar('current_deadline', default=None)
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+def remaining():
+    """ Сколько секунд осталось до дедлайна текущего запроса или None, если дедлайна нет """
+    deadline = current_deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def check():
+    """ DeadlineExceeded, если время текущего запроса истекло """
+    left = remaining()
+    if left is not None and left <= 0:
+        raise DeadlineExceeded("deadline exceeded")
+
+
+@contextlib.contextmanager
+def suspended():
+    """ Работа, которую после начала нужно довести до конца независимо от дедлайна
+    (например, запись версии списка после изменения элементов) """
+    token = current_deadline.set(None)
+    try:
+        yield
+    finally:
+        current_deadline.reset(token)
+
+
+def outgoing_headers():
+    """ Заголовок с оставшимся временем для запроса к апстриму """
+    left = remaining()
+    if left is None:
+        return {}
+    return {deadline_header: str(max(int(left * 1000), 0))}
+
+
+def incoming_deadline(value, default_timeout=None):
+    """ Дедлайн по значению заголовка (мс) или по default_timeout (с); None - без дедлайна """
+    if value is not None:
+        try:
+            return time.monotonic() + int(value) / 1000
+        except ValueError:
+            pass
+    if default_timeout:
+        return time.monotonic() + default_timeout
+    return None
+
+
+def start(deadline):
+    """ Установить дедлайн текущего запроса, возвращает токен для finish """
+    return current_deadline.set(deadline)
+
+
+def finish(token):
+    current_deadline.reset(token)
+
+
+def setup_deadline(app, default_timeout=None):
+    """ Дедлайн каждого входящего запроса Flask-приложения; default_timeout задаёт дедлайн
+    запросам без заголовка (шлюз), у остальных сервисов такие запросы выполняются без него """
+    @app.before_request
+    def start_deadline():
+        g.deadline_token = start(incoming_deadline(request.headers.get(deadline_header),
+                                                   default_timeout))
+        left = remaining()
+        if left is not None and left <= 0:
+            return make_response(jsonify({"error": "deadline exceeded"}), 504)
+        return None
+
+    @app.teardown_request
+    def finish_deadline(exc):
+        token = g.pop('deadline_token', None)
+        if token is not None:
+            finish(token)
+
+    @app.errorhandler(DeadlineExceeded)
+    def deadline_exceeded(e):
+        return make_response(jsonify({"error": str(e) or "deadline exceeded"}), 504)
@@ -0,0 +1,49 @@
+""" Общая конфигурация gunicorn для всех сервисов:
+gunicorn -c /common/gunicorn_conf.py <module>:app """
+import multiprocessing
+import os
+import shutil
+
+
+# модель воркеров: sync - процесс на запрос, threaded - потоки в процессе,
+# gevent - зелёные потоки, aiohttp - для шлюза в режиме asyncio (api_async:app)
+worker_classes = {
+    'sync': 'sync',
+    'threaded': 'gthread',
+    'gevent': 'gevent',
+    'aiohttp': 'aiohttp.GunicornWebWorker'
+}
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+worker_class = worker_classes[os.environ.get('WORKER_CLASS', 'threaded')]
+workers = int(os.environ.get('WORKERS', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('THREADS', 4))
+worker_connections = int(os.environ.get('WORKER_CONNECTIONS', 1000))
+timeout = int(os.environ.get('WORKER_TIMEOUT', 60))
+# время на завершение начатых запросов после SIGTERM
+graceful_timeout = int(os.environ.get('GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.environ.get('KEEPALIVE', 5))
+loglevel = os.environ.get('LOG_LEVEL', 'info')
+accesslog = '-'
+errorlog = '-'
+
+
+def on_starting(server):
+    """ Каталог метрик воркеров очищается при каждом старте """
+    directory = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if directory:
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+
+
+def child_exit(server, worker):
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
+
+
+def worker_exit(server, worker):
+    """ Закрыть пулы соединений к апстримам при остановке воркера """
+    import sys
+    if 'service_client' in sys.modules:
+        sys.modules['service_client'].close_all()
@@ -0,0 +1,36 @@
+""" Эндпоинты /healthz (процесс жив) и /readyz (зависимости сервиса отвечают) """
+from flask import jsonify
+
+
+def register_health(app, checks):
+    """ checks - словарь имя зависимости -> функция, которая бросает исключение, если зависимость недоступна """
+
+    @app.route('/healthz', methods=['GET'])
+    def healthz():
+        return jsonify({"status": "ok"})
+
+    @app.route('/readyz', methods=['GET'])
+    def readyz():
+        ready, results = run_checks(checks)
+        return jsonify({"status": "ok" if ready else "unavailable",
+                        "checks": results}), 200 if ready else 503
+
+
+def run_checks(checks):
+    ready = True
+    results = {}
+    for name, check in checks.items():
+        try:
+            check()
+            results[name] = "ok"
+        except Exception as e:
+            ready = False
+            results[name] = str(e)
+    return ready, results
+
+
+def upstream_check(client):
+    """ Проверка апстрима по его /healthz через service_client """
+    def check():
+        client.get('/healthz', timeout=(1, 2)).raise_for_status()
+    return check
@@ -0,0 +1,247 @@
+""" События изменения списков покупок через Redis pub/sub.
+
+Сервис shoplist публикует событие в канал пользователя после каждого изменения его списка
+(`publish`). Шлюз держит одно соединение pub/sub на процесс (`EventHub` для asyncio,
+`ThreadEventHub` для потоковых воркеров): оно подписано на каналы
+всех пользователей, у которых в этом процессе есть хотя бы один подписчик, и раздаёт события по
+очередям подписчиков. Очередь ограничена: если клиент не успевает читать, накопленные события
+заменяются одним событием resync, после которого клиент догружает изменения через /shoplist?since= """
+import asyncio
+import json
+import logging
+import queue
+import threading
+import time
+
+from redis import RedisError
+
+
+channel_prefix = 'shoplist:events:'
+logger = logging.getLogger('live_events')
+
+
+def channel(user):
+    return channel_prefix + user
+
+
+def publish(client, user, event):
+    """ Отправить событие подписчикам списка user; ошибка Redis не прерывает изменение списка """
+    try:
+        return client.publish(channel(user), json.dumps(event))
+    except RedisError as e:
+        logger.warning('event for %s not published: %s', user, e)
+        return None
+
+
+class Subscription:
+    queue_class = asyncio.Queue
+    full_error = asyncio.QueueFull
+    empty_error = asyncio.QueueEmpty
+
+    def __init__(self, user, queue_size):
+        self.user = user
+        self.queue = self.queue_class(maxsize=queue_size)
+        self.dropped = 0
+
+    def push(self, event):
+        """ Не ждёт клиента: при переполненной очереди её содержимое заменяется событием resync """
+        try:
+            self.queue.put_nowait(event)
+        except self.full_error:
+            try:
+                while True:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+            except self.empty_error:
+                pass
+            self.dropped += 1
+            self.queue.put_nowait({"type": "resync"})
+
+    async def get(self):
+        return await self.queue.get()
+
+
+class ThreadSubscription(Subscription):
+    """ Подписка с потокобезопасной очередью: события кладёт поток чтения pub/sub """
+    queue_class = queue.Queue
+    full_error = queue.Full
+    empty_error = queue.Empty
+
+    def get(self, timeout=None):
+        """ Следующее событие; queue.Empty, если за timeout секунд событий не было """
+        return self.queue.get(timeout=timeout)
+
+
+class EventHub:
+    """ Подписки всех клиентов процесса поверх одного соединения pub/sub (клиент redis.asyncio) """
+
+    def __init__(self, redis, queue_size=100, max_subscribers=10000):
+        self.redis = redis
+        self.queue_size = queue_size
+        self.max_subscribers = max_subscribers
+        self.subscribers = {}
+        self.delivered = 0
+        self.dropped = 0
+        self.rejected = 0
+        self._pubsub = None
+        self._reader = None
+
+    def count(self):
+        return sum(len(subscriptions) for subscriptions in self.subscribers.values())
+
+    async def subscribe(self, user):
+        """ Новая подписка на события списка user или None, если подписчиков слишком много """
+        if self.count() >= self.max_subscribers:
+            self.rejected += 1
+            return None
+        if self._pubsub is None:
+            self._pubsub = self.redis.pubsub()
+        subscription = Subscription(user, self.queue_size)
+        subscriptions = self.subscribers.setdefault(user, set())
+        subscriptions.add(subscription)
+        if len(subscriptions) == 1:
+            try:
+                await self._pubsub.subscribe(channel(user))
+            except RedisError:
+                # остальные подписчики пользователя, если они появились за время ожидания, остаются
+                self._discard(subscription)
+                raise
+        if self._reader is None or self._reader.done():
+            self._reader = asyncio.ensure_future(self._read())
+        # события после этого уже дойдут до клиента, пропущенные до подписки он догружает сам
+        subscription.push({"type": "subscribed"})
+        return subscription
+
+    def _discard(self, subscription):
+        """ Убрать подписку; True, если у пользователя больше нет подписчиков в процессе """
+        subscriptions = self.subscribers.get(subscription.user)
+        if subscriptions is None or subscription not in subscriptions:
+            return False
+        subscriptions.discard(subscription)
+        self.dropped += subscription.dropped
+        if subscriptions:
+            return False
+        del self.subscribers[subscription.user]
+        return True
+
+    async def unsubscribe(self, subscription):
+        if self._discard(subscription):
+            try:
+                await self._pubsub.unsubscribe(channel(subscription.user))
+            except RedisError as e:
+                logger.warning('unsubscribe %s failed: %s', subscription.user, e)
+
+    def dispatch(self, message):
+        user = message['channel'].decode()[len(channel_prefix):]
+        event = json.loads(message['data'])
+        for subscription in self.subscribers.get(user, ()):
+            subscription.push(event)
+            self.delivered += 1
+
+    def resync_all(self, error):
+        # соединение восстанавливается со всеми каналами, но события за это время потеряны
+        logger.warning('pub/sub connection lost: %s', error)
+        for subscriptions in list(self.subscribers.values()):
+            for subscription in list(subscriptions):
+                subscription.push({"type": "resync"})
+
+    async def _read(self):
+        """ Чтение событий, пока в процессе есть подписчики """
+        while self.subscribers:
+            try:
+                message = await self._pubsub.get_message(ignore_subscribe_messages=True,
+                                                         timeout=1.0)
+            except RedisError as e:
+                self.resync_all(e)
+                await asyncio.sleep(1)
+                continue
+            if message is not None and message['type'] == 'message':
+                self.dispatch(message)
+
+    async def close(self):
+        if self._reader is not None:
+            self._reader.cancel()
+        if self._pubsub is not None:
+            await self._pubsub.close()
+
+    def stats(self):
+        return {
+            "users": len(self.subscribers),
+            "subscribers": self.count(),
+            "max_subscribers": self.max_subscribers,
+            "queue_size": self.queue_size,
+            "delivered": self.delivered,
+            "dropped": self.dropped + sum(subscription.dropped
+                                          for subscriptions in self.subscribers.values()
+                                          for subscription in subscriptions),
+            "rejected": self.rejected
+        }
+
+
+class ThreadEventHub(EventHub):
+    """ EventHub для шлюза на потоках (клиент redis): соединение pub/sub процесса читает фоновый
+    поток, клиенты ждут событий в своих потоках """
+
+    def __init__(self, redis, queue_size=100, max_subscribers=10000):
+        super().__init__(redis, queue_size, max_subscribers)
+        self._lock = threading.Lock()
+
+    def subscribe(self, user):
+        with self._lock:
+            if self.count() >= self.max_subscribers:
+                self.rejected += 1
+                return None
+            if self._pubsub is None:
+                self._pubsub = self.redis.pubsub()
+            subscription = ThreadSubscription(user, self.queue_size)
+            subscriptions = self.subscribers.setdefault(user, set())
+            subscriptions.add(subscription)
+            if len(subscriptions) == 1:
+                try:
+                    self._pubsub.subscribe(channel(user))
+                except RedisError:
+                    self._discard(subscription)
+                    raise
+            if self._reader is None:
+                self._reader = threading.Thread(target=self._read, name='live-events',
+                                                daemon=True)
+                self._reader.start()
+        subscription.push({"type": "subscribed"})
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            if self._discard(subscription):
+                try:
+                    self._pubsub.unsubscribe(channel(subscription.user))
+                except RedisError as e:
+                    logger.warning('unsubscribe %s failed: %s', subscription.user, e)
+
+    def dispatch(self, message):
+        with self._lock:
+            super().dispatch(message)
+
+    def _read(self):
+        """ Поток чтения событий; завершается, когда в процессе не остаётся подписчиков """
+        while True:
+            with self._lock:
+                if not self.subscribers:
+                    self._reader = None
+                    return
+            try:
+                message = self._pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except RedisError as e:
+                with self._lock:
+                    self.resync_all(e)
+                time.sleep(1)
+                continue
+            if message is not None and message['type'] == 'message':
+                self.dispatch(message)
+
+    def close(self):
+        if self._pubsub is not None:
+            self._pubsub.close()
+
+    def stats(self):
+        with self._lock:
+            return super().stats()
@@ -0,0 +1,43 @@
+""" Транспорт service_client, который вызывает WSGI-приложение апстрима в том же процессе:
+без сокетов, пула соединений и разбора HTTP. Запрос проходит через те же обработчики Flask,
+поэтому ответы и статусы совпадают с распределённым режимом.
+service_client.get_client('auth', auth_url).mount_local(auth.app) """
+import json
+
+import requests
+from werkzeug.test import Client
+
+
+class LocalResponse:
+    """ Ответ с интерфейсом requests.Response, который используют сервисы """
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode()
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f'{self.status_code} local upstream error', response=self)
+
+
+class LocalDispatcher:
+    def __init__(self, app):
+        self.app = app
+        self.client = Client(app)
+
+    def request(self, method, path, params=None, json=None, data=None, headers=None, **kwargs):
+        # timeout и прочие параметры сетевого запроса здесь не нужны
+        response = self.client.open(path or '/', method=method, query_string=params,
+                                    json=json, data=data, headers=headers)
+        try:
+            return LocalResponse(response.status_code, response.headers, response.get_data())
+        finally:
+            response.close()
@@ -0,0 +1,154 @@
+""" Общий слой логирования сервисов.
+
+- сообщения форматируются лениво (logger.info('... %s', value)) и не в потоке запроса:
+  записи складываются в ограниченную очередь, форматирование и вывод делает отдельный поток;
+- вывод в JSON, по одной записи на строку;
+- записи ниже WARNING можно сэмплировать по маршрутам: решение принимается один раз на запрос,
+  поэтому у выбранного запроса видны все записи;
+- уровень и частоты сэмплирования читаются из файла LOG_CONFIG и перечитываются при его изменении,
+  без перезапуска сервиса """
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import time
+
+from flask import g, has_request_context, request
+
+import tracing
+
+
+log_config_path = os.environ.get('LOG_CONFIG', '/common/logging.json')
+log_level = os.environ.get('LOG_LEVEL', 'INFO').upper()
+queue_size = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+# как часто проверять, изменился ли файл конфигурации, в секундах
+reload_interval = 5
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        data = {
+            "time": time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)),
+            "level": record.levelname,
+            "service": getattr(record, 'service', record.name),
+            "endpoint": getattr(record, 'endpoint', None),
+            "request_id": getattr(record, 'request_id', None),
+            "message": record.getMessage()
+        }
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """ Не блокирует запрос: при переполненной очереди запись отбрасывается """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # форматирование выполнит поток QueueListener; очередь внутрипроцессная,
+        # поэтому запись не нужно сериализовать заранее
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogConfig:
+    """ Уровень логирования и частоты сэмплирования по маршрутам (endpoint Flask -> доля от 0 до 1) """
+
+    def __init__(self, service, logger, path=log_config_path):
+        self.service = service
+        self.logger = logger
+        self.path = path
+        self.level = log_level
+        self.sampling = {}
+        self._mtime = None
+        self._checked = 0
+
+    def refresh(self):
+        """ Перечитать файл, если он изменился; проверка не чаще раза в reload_interval секунд """
+        now = time.monotonic()
+        if now - self._checked < reload_interval:
+            return
+        self._checked = now
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return
+        if mtime == self._mtime:
+            return
+        self._mtime = mtime
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            self.logger.error('logging config %s not loaded: %s', self.path, e)
+            return
+        # секция сервиса переопределяет общие настройки
+        service_data = data.get('services', {}).get(self.service, {})
+        self.apply(service_data.get('level', data.get('level', log_level)),
+                   {**data.get('sampling', {}), **service_data.get('sampling', {})})
+
+    def apply(self, level, sampling):
+        self.level = level.upper()
+        self.sampling = sampling
+        self.logger.setLevel(self.level)
+
+    def sample_rate(self, endpoint):
+        return self.sampling.get(endpoint, self.sampling.get('*', 1.0))
+
+
+class RequestFilter(logging.Filter):
+    """ Добавляет к записи сервис и маршрут, отбрасывает записи запросов, не попавших в выборку """
+
+    def __init__(self, service):
+        super().__init__()
+        self.service = service
+
+    def filter(self, record):
+        record.service = self.service
+        record.request_id = tracing.current_request_id()
+        if not has_request_context():
+            return True
+        record.endpoint = request.endpoint
+        return record.levelno >= logging.WARNING or g.get('log_sampled', True)
+
+
+def setup_logging(app, service):
+    """ Подключить к app.logger очередь с JSON-выводом, сэмплирование и перечитывание конфигурации """
+    logger = app.logger
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+
+    log_queue = queue.Queue(maxsize=queue_size)
+    handler = DroppingQueueHandler(log_queue)
+    handler.addFilter(RequestFilter(service))
+    output = logging.StreamHandler()
+    output.setFormatter(JsonFormatter())
+    listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    logger.addHandler(handler)
+    logger.propagate = False
+    config = LogConfig(service, logger)
+    config.apply(log_level, {})
+    config.refresh()
+
+    @app.before_request
+    def sample_request():
+        config.refresh()
+        rate = config.sample_rate(request.endpoint)
+        g.log_sampled = rate >= 1 or random.random() < rate
+
+    app.extensions['logs'] = {"config": config, "handler": handler}
+    return config
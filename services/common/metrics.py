@@ -0,0 +1,155 @@
+""" Метрики в формате Prometheus: входящие запросы по маршрутам, запросы к апстримам,
+команды Redis и MongoDB, обращения к кэшам, отклонённые шлюзом запросы, переходы circuit
+breaker, размер пакетов групповой записи в MongoDB. Под gunicorn с несколькими воркерами метрики процессов собираются через
+PROMETHEUS_MULTIPROC_DIR """
+import os
+import time
+
+from flask import Response, g, request
+from prometheus_client import (CollectorRegistry, Counter, Histogram, CONTENT_TYPE_LATEST,
+                               REGISTRY, generate_latest, multiprocess)
+
+
+# границы подобраны под внутренние запросы: от долей миллисекунды до таймаута апстрима
+buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+request_count = Counter('http_requests_total', 'Входящие HTTP-запросы',
+                        ['service', 'route', 'method', 'status'])
+request_latency = Histogram('http_request_duration_seconds', 'Время обработки входящего запроса',
+                            ['service', 'route', 'method', 'status'], buckets=buckets)
+upstream_latency = Histogram('upstream_request_duration_seconds', 'Время запроса к другому сервису',
+                             ['service', 'upstream', 'method', 'status'], buckets=buckets)
+redis_latency = Histogram('redis_command_duration_seconds', 'Время команды Redis',
+                          ['service', 'command', 'status'], buckets=buckets)
+mongo_latency = Histogram('mongo_command_duration_seconds', 'Время команды MongoDB',
+                          ['service', 'command', 'status'], buckets=buckets)
+# event: hit, miss, error, evicted, stale (запись отброшена, список изменился), too_large
+cache_events = Counter('cache_events_total', 'Обращения к кэшам сервисов',
+                       ['service', 'cache', 'event'])
+# reason: rate_user, rate_ip, route_concurrency, overload
+shed_requests = Counter('shed_requests_total', 'Запросы, отклонённые ограничениями шлюза',
+                        ['service', 'route', 'reason'])
+# переходы circuit breaker апстрима: open, half_open, closed
+breaker_transitions = Counter('circuit_breaker_transitions_total',
+                              'Переходы circuit breaker запросов к апстриму', ['upstream', 'state'])
+write_batch_size = Histogram('mongo_write_batch_size', 'Операций записи в одном групповом bulk_write',
+                             ['service', 'collection'],
+                             buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512))
+
+
+def observe_request(service, route, method, status, seconds):
+    request_count.labels(service, route, method, status).inc()
+    request_latency.labels(service, route, method, status).observe(seconds)
+
+
+def observe_upstream(service, upstream, method, status, seconds):
+    upstream_latency.labels(service, upstream, method, status).observe(seconds)
+
+
+def observe_cache(service, cache, event, amount=1):
+    cache_events.labels(service, cache, event).inc(amount)
+
+
+def observe_shed(service, route, reason):
+    shed_requests.labels(service, route, reason).inc()
+
+
+def observe_breaker(upstream, state):
+    breaker_transitions.labels(upstream, state).inc()
+
+
+def observe_write_batch(service, collection, size):
+    write_batch_size.labels(service, collection).observe(size)
+
+
+def render():
+    """ Тело и content-type ответа /metrics """
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def setup_metrics(app, service):
+    """ Замер всех запросов Flask-приложения и эндпоинт /metrics """
+    @app.before_request
+    def start_timer():
+        g.metrics_start = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        start = g.get('metrics_start')
+        if start is not None:
+            # шаблон маршрута, а не путь, чтобы не плодить метки
+            route = request.url_rule.rule if request.url_rule else 'unmatched'
+            observe_request(service, route, request.method, response.status_code,
+                            time.perf_counter() - start)
+        return response
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics_handler():
+        body, content_type = render()
+        return Response(body, mimetype=content_type)
+
+
+def instrument_redis(client, service):
+    """ Замер каждой команды (в том числе EVALSHA скриптов) и каждого pipeline клиента redis-py """
+    execute_command = client.execute_command
+    create_pipeline = client.pipeline
+
+    def timed_execute_command(*args, **options):
+        start = time.perf_counter()
+        status = 'ok'
+        try:
+            return execute_command(*args, **options)
+        except Exception:
+            status = 'error'
+            raise
+        finally:
+            redis_latency.labels(service, str(args[0]).upper(), status).observe(
+                time.perf_counter() - start)
+
+    def timed_pipeline(*args, **kwargs):
+        pipe = create_pipeline(*args, **kwargs)
+        execute = pipe.execute
+
+        def timed_execute(*args, **kwargs):
+            start = time.perf_counter()
+            status = 'ok'
+            try:
+                return execute(*args, **kwargs)
+            except Exception:
+                status = 'error'
+                raise
+            finally:
+                redis_latency.labels(service, 'PIPELINE', status).observe(
+                    time.perf_counter() - start)
+
+        pipe.execute = timed_execute
+        return pipe
+
+    client.execute_command = timed_execute_command
+    client.pipeline = timed_pipeline
+    return client
+
+
+def mongo_listener(service):
+    """ Замер команд pymongo: MongoClient(..., event_listeners=[mongo_listener(service)]).
+    pymongo установлен только в сервисе database, поэтому импортируется здесь """
+    from pymongo import monitoring
+
+    class MongoCommandListener(monitoring.CommandListener):
+        def started(self, event):
+            pass
+
+        def succeeded(self, event):
+            mongo_latency.labels(service, event.command_name, 'ok').observe(
+                event.duration_micros / 1e6)
+
+        def failed(self, event):
+            mongo_latency.labels(service, event.command_name, 'error').observe(
+                event.duration_micros / 1e6)
+
+    return MongoCommandListener()
@@ -0,0 +1,219 @@
+""" Общий HTTP-клиент для запросов между сервисами.
+Для каждого апстрима держится свой пул keep-alive соединений и свой circuit breaker;
+таймаут запроса ограничивается дедлайном входящего запроса (common/deadline) """
+import os
+import threading
+import time
+
+import requests
+from flask import jsonify, make_response
+from requests.adapters import HTTPAdapter
+from urllib3 import HTTPConnectionPool, HTTPSConnectionPool
+
+import deadline
+import metrics
+import tracing
+from circuit_breaker import CircuitBreaker, CircuitOpen
+
+
+pool_size = int(os.environ.get('SERVICE_POOL_SIZE', 20))
+connect_timeout = float(os.environ.get('SERVICE_CONNECT_TIMEOUT', 2))
+read_timeout = float(os.environ.get('SERVICE_READ_TIMEOUT', 30))
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+class CountingPoolMixin:
+    """ Пул соединений urllib3, который считает, сколько запросов получили из пула открытое
+    соединение (reused) и сколько открыли новое (connections) """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.reused = 0
+        self.opened = 0
+        self._counters_lock = threading.Lock()
+
+    def _get_conn(self, timeout=None):
+        conn = super()._get_conn(timeout)
+        # соединение без сокета - новое или закрытое пулом после обрыва, оно будет открыто заново
+        reused = conn.sock is not None
+        with self._counters_lock:
+            if reused:
+                self.reused += 1
+            else:
+                self.opened += 1
+        return conn
+
+
+class CountingHTTPConnectionPool(CountingPoolMixin, HTTPConnectionPool):
+    pass
+
+
+class CountingHTTPSConnectionPool(CountingPoolMixin, HTTPSConnectionPool):
+    pass
+
+
+class CountingAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": CountingHTTPConnectionPool,
+                                                   "https": CountingHTTPSConnectionPool}
+
+
+class ServiceClient:
+    """ Клиент одного апстрима (например, http://database:5000) """
+
+    def __init__(self, name, base_url, pool_size=pool_size,
+                 timeout=(connect_timeout, read_timeout)):
+        self.name = name
+        self.base_url = base_url.rstrip('/')
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.requests = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._adapter = CountingAdapter(pool_connections=1, pool_maxsize=pool_size,
+                                    pool_block=False, max_retries=0)
+        self._session = requests.Session()
+        self._session.mount('http://', self._adapter)
+        self._session.mount('https://', self._adapter)
+        self._local = None
+        self.breaker = CircuitBreaker(name)
+
+    def url(self, path=''):
+        if path and not path.startswith('/'):
+            path = '/' + path
+        return self.base_url + (path or '/')
+
+    def request(self, method, path='', **kwargs):
+        kwargs['timeout'] = request_timeout(kwargs.get('timeout', self.timeout))
+        probe = self.breaker.before_call()
+        with self._lock:
+            self.requests += 1
+        span = tracing.start_span(f'{method} {self.name} {path or "/"}', 'client')
+        kwargs['headers'] = {**(kwargs.get('headers') or {}), **tracing.outgoing_headers(span),
+                             **deadline.outgoing_headers()}
+        start = time.perf_counter()
+        status = 'error'
+        try:
+            if self._local is not None:
+                r = self._local.request(method, self.url(path)[len(self.base_url):], **kwargs)
+            else:
+                r = self._session.request(method, self.url(path), **kwargs)
+            status = r.status_code
+            return r
+        except requests.RequestException as e:
+            with self._lock:
+                self.errors += 1
+            if isinstance(e, requests.Timeout) and expired():
+                raise deadline.DeadlineExceeded("deadline exceeded") from e
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            # ответ, который не успел к дедлайну вызывающего, не говорит о здоровье апстрима
+            failed = (status == 'error' or status >= 500) and not expired()
+            self.breaker.after_call(probe, failed, seconds)
+            metrics.observe_upstream(span.service, self.name, method, status, seconds)
+            span.finish(status)
+
+    def get(self, path='', **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path='', **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def put(self, path='', **kwargs):
+        return self.request('PUT', path, **kwargs)
+
+    def delete(self, path='', **kwargs):
+        return self.request('DELETE', path, **kwargs)
+
+    def mount_local(self, app):
+        """ Отправлять запросы в WSGI-приложение апстрима в этом же процессе, без сети """
+        from local_transport import LocalDispatcher
+        self._local = LocalDispatcher(app)
+
+    def stats(self):
+        """ Сколько запросов ушло в апстрим, сколько из них открыли новое соединение и сколько
+        переиспользовали открытое (по счётчикам пулов urllib3) """
+        pools = self._adapter.poolmanager.pools
+        connections = reused = 0
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                connections += pool.opened
+                reused += pool.reused
+        return {
+            "url": self.base_url,
+            "requests": self.requests,
+            "errors": self.errors,
+            "connections": connections,
+            "reused": reused,
+            "pool_size": self.pool_size,
+            "local": self._local is not None,
+            "breaker": self.breaker.state
+        }
+
+    def close(self):
+        self._session.close()
+
+
+def request_timeout(timeout):
+    """ Таймаут запроса (connect, read), не больше времени до дедлайна текущего запроса """
+    left = deadline.remaining()
+    if left is None:
+        return timeout
+    if left <= 0:
+        raise deadline.DeadlineExceeded("deadline exceeded")
+    if isinstance(timeout, tuple):
+        return tuple(min(value, left) for value in timeout)
+    return min(timeout, left)
+
+
+def expired():
+    left = deadline.remaining()
+    return left is not None and left <= 0
+
+
+def get_client(name, base_url, **kwargs):
+    """ Вернуть клиент апстрима, создав его при первом обращении """
+    with _clients_lock:
+        client = _clients.get(name)
+        if client is None:
+            client = ServiceClient(name, base_url, **kwargs)
+            _clients[name] = client
+        return client
+
+
+def stats():
+    with _clients_lock:
+        clients = list(_clients.values())
+    return {client.name: client.stats() for client in clients}
+
+
+def close_all():
+    with _clients_lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
+
+
+def breakers():
+    with _clients_lock:
+        clients = list(_clients.values())
+    return {client.name: client.breaker.stats() for client in clients}
+
+
+def register_breakers(app):
+    """ GET /breakers - состояние circuit breaker каждого апстрима; пока breaker апстрима открыт,
+    запросы, которым он нужен, сразу получают 503 """
+    @app.route('/breakers', methods=['GET'])
+    def breakers_handler():
+        return jsonify(breakers())
+
+    @app.errorhandler(CircuitOpen)
+    def circuit_open(e):
+        response = make_response(jsonify({"error": str(e)}), 503)
+        response.headers['Retry-After'] = '1'
+        return response
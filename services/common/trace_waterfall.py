@@ -0,0 +1,78 @@
+""" Восстановить водопад запроса по span-ам из NDJSON-файлов трассировки:
+python trace_waterfall.py <request_id> [файл ...]   (по умолчанию /traces/spans.ndjson
+и его ротированная часть /traces/spans.ndjson.1) """
+import json
+import os
+import sys
+
+
+bar_width = 40
+default_paths = ['/traces/spans.ndjson.1', '/traces/spans.ndjson']
+
+
+def load_spans(request_id, paths):
+    spans = []
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                span = json.loads(line)
+                if span['trace_id'] == request_id:
+                    spans.append(span)
+    return spans
+
+
+def build_tree(spans):
+    """ Дочерние span-ы по parent_id, отсортированные по времени начала """
+    ids = {span['span_id'] for span in spans}
+    children = {}
+    roots = []
+    for span in sorted(spans, key=lambda span: span['start']):
+        if span['parent_id'] in ids:
+            children.setdefault(span['parent_id'], []).append(span)
+        else:
+            roots.append(span)
+    return roots, children
+
+
+def render(spans):
+    roots, children = build_tree(spans)
+    begin = min(span['start'] for span in spans)
+    end = max(span['start'] + span['duration_ms'] / 1000 for span in spans)
+    total = max(end - begin, 1e-9)
+    lines = []
+
+    def walk(span, depth):
+        offset = span['start'] - begin
+        left = int(offset / total * bar_width)
+        width = max(int(span['duration_ms'] / 1000 / total * bar_width), 1)
+        bar = ' ' * left + '#' * width
+        label = '  ' * depth + f"{span['service']}: {span['name']}"
+        lines.append(f"{label:<60} {offset * 1000:9.2f}ms {span['duration_ms']:9.2f}ms "
+                     f"{str(span['status']):>5} |{bar:<{bar_width}}|")
+        for child in children.get(span['span_id'], []):
+            walk(child, depth + 1)
+
+    for root in roots:
+        walk(root, 0)
+    return '\n'.join(lines)
+
+
+def main(args):
+    if not args:
+        print(__doc__)
+        return 1
+    request_id, paths = args[0], args[1:] or [path for path in default_paths
+                                                         if os.path.exists(path)]
+    spans = load_spans(request_id, paths)
+    if not spans:
+        print(f'no spans for request {request_id}')
+        return 1
+    print(render(spans))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,210 @@
+""" Сквозная трассировка запросов между сервисами.
+
+Идентификатор запроса (X-Request-Id) и родительский span (X-Span-Id) передаются в заголовках
+каждого запроса через service_client. Каждый сервис пишет span входящего запроса и span каждого
+запроса к апстриму; span-ы отдаются экспортеру (TRACE_EXPORTER):
+- file (по умолчанию) - NDJSON в TRACE_FILE, работает без сети; файл может быть общим для всех сервисов.
+  Запрос только кладёт span в очередь процесса, файл пишет фоновый поток
+- none - трассировка выключена
+- <module>:<class> - свой экспортер с методом export(span) """
+import contextvars
+import fcntl
+import importlib
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+
+from flask import g, request
+
+
+request_id_header = 'X-Request-Id'
+span_id_header = 'X-Span-Id'
+
+trace_exporter = os.environ.get('TRACE_EXPORTER', 'file')
+trace_file = os.environ.get('TRACE_FILE', '/traces/spans.ndjson')
+# размер файла, после которого он переименовывается в <TRACE_FILE>.1 (0 - без ограничения)
+trace_file_max_bytes = int(os.environ.get('TRACE_FILE_MAX_BYTES', 50 * 1024 * 1024))
+# span-ы, которые не успел записать фоновый поток, сверх этого количества отбрасываются
+trace_queue_size = int(os.environ.get('TRACE_QUEUE_SIZE', 10000))
+
+current_span = contextvars.ContextVar('current_span', default=None)
+
+
+class Span:
+    def __init__(self, name, service, trace_id=None, parent_id=None, kind='server'):
+        self.name = name
+        self.trace_id = trace_id or uuid.uuid4().hex
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.kind = kind
+        self.service = service
+        self.start = time.time()
+        self._started = time.perf_counter()
+        self.duration = None
+        self.status = None
+
+    def finish(self, status=None):
+        self.duration = time.perf_counter() - self._started
+        self.status = status
+        exporter.export(self)
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "service": self.service,
+            "name": self.name,
+            "kind": self.kind,
+            "start": self.start,
+            "duration_ms": round(self.duration * 1000, 3),
+            "status": self.status
+        }
+
+
+class NullExporter:
+    def export(self, span):
+        pass
+
+
+class FileExporter:
+    """ Дописывает span-ы в NDJSON-файл, одна строка на span.
+    Файл пишет фоновый поток процесса, запрос только кладёт span в ограниченную очередь;
+    при переполнении очереди или ошибке записи span-ы отбрасываются (счётчик dropped).
+    Файл больше max_bytes переименовывается в <path>.1 (одним процессом из всех, которые пишут
+    в него), предыдущий <path>.1 удаляется """
+
+    def __init__(self, path=trace_file, max_bytes=trace_file_max_bytes, queue_size=trace_queue_size):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._writer_pid = None
+        self._file = None
+
+    def export(self, span):
+        if self._writer_pid != os.getpid():
+            # поток запускается в каждом процессе: после fork поток родителя не существует
+            self._start_writer()
+        try:
+            self._queue.put_nowait(span.to_dict())
+        except queue.Full:
+            self.dropped += 1
+
+    def _start_writer(self):
+        with self._lock:
+            if self._writer_pid == os.getpid():
+                return
+            self._writer_pid = os.getpid()
+            self._file = None
+            threading.Thread(target=self._write_spans, name='trace-exporter', daemon=True).start()
+
+    def _write_spans(self):
+        while True:
+            spans = [self._queue.get()]
+            # всё, что накопилось в очереди, записывается одним вызовом write
+            while len(spans) < 1000:
+                try:
+                    spans.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.write(''.join(json.dumps(span) + '\n' for span in spans))
+            except (OSError, ValueError):
+                self.dropped += len(spans)
+                self._file = None
+
+    def write(self, data):
+        if self._file is not None and not self._is_current():
+            # файл переименовал другой процесс
+            self._file.close()
+            self._file = None
+        if self._file is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            # O_APPEND: строки нескольких процессов не перемешиваются
+            self._file = open(self.path, 'a')
+        if self.max_bytes and os.fstat(self._file.fileno()).st_size + len(data) > self.max_bytes:
+            self._rotate()
+        self._file.write(data)
+        self._file.flush()
+
+    def _rotate(self):
+        """ Файл общий для процессов всех сервисов: переименование выполняется под блокировкой
+        <path>.lock, и только если файл ещё не переименовал другой процесс, иначе второе
+        переименование заменило бы только что сохранённый <path>.1 """
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if self._is_current():
+                os.replace(self.path, self.path + '.1')
+        self._file.close()
+        self._file = open(self.path, 'a')
+
+    def _is_current(self):
+        try:
+            return os.stat(self.path).st_ino == os.fstat(self._file.fileno()).st_ino
+        except FileNotFoundError:
+            return False
+
+
+def load_exporter(name):
+    if name == 'none':
+        return NullExporter()
+    if name == 'file':
+        return FileExporter()
+    module_name, class_name = name.split(':')
+    return getattr(importlib.import_module(module_name), class_name)()
+
+
+exporter = load_exporter(trace_exporter)
+
+
+def start_span(name, kind='server', trace_id=None, parent_id=None, service=None):
+    """ Начать span; без trace_id span продолжает текущую трассу (или начинает новую).
+    Без service span относится к сервису текущего span """
+    parent = current_span.get()
+    if trace_id is None and parent is not None:
+        trace_id, parent_id = parent.trace_id, parent.span_id
+    if service is None:
+        service = parent.service if parent is not None else 'unknown'
+    return Span(name, service, trace_id, parent_id, kind)
+
+
+def outgoing_headers(span):
+    """ Заголовки для запроса к апстриму в рамках span """
+    return {request_id_header: span.trace_id, span_id_header: span.span_id}
+
+
+def current_request_id():
+    span = current_span.get()
+    return span.trace_id if span is not None else None
+
+
+def setup_tracing(app, service):
+    """ Span на каждый входящий запрос Flask-приложения, X-Request-Id возвращается в ответе """
+    @app.before_request
+    def start_request_span():
+        rule = request.url_rule.rule if request.url_rule else request.path
+        span = start_span(f'{request.method} {rule}', 'server',
+                          request.headers.get(request_id_header),
+                          request.headers.get(span_id_header), service)
+        g.trace_span = span
+        g.trace_token = current_span.set(span)
+
+    @app.after_request
+    def add_request_id(response):
+        span = g.get('trace_span')
+        if span is not None:
+            response.headers[request_id_header] = span.trace_id
+            span.status = response.status_code
+        return response
+
+    @app.teardown_request
+    def finish_request_span(exc):
+        span = g.pop('trace_span', None)
+        if span is not None:
+            span.finish(span.status if exc is None else 500)
+            current_span.reset(g.pop('trace_token'))
@@ -0,0 +1,128 @@
+""" Проверка параметров запросов и быстрый JSON для всех сервисов.
+
+`check_params` описывает обязательные параметры маршрута по методам; схемы компилируются один раз
+при объявлении маршрута, а тело запроса разбирается один раз на запрос (`request_params`).
+Параметр схемы - имя или пара имя -> тип (или кортеж типов), например
+`check_params(params_get=['user'], params_post={'user': str, 'operations': list})`.
+
+JSON кодируется и разбирается через orjson, если он установлен, иначе - стандартным json.
+`setup_json(app)` подключает тот же бэкенд к jsonify и request.get_json Flask-приложения """
+import functools
+import json
+
+from flask import g, jsonify, make_response, request
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+backend = 'orjson' if orjson is not None else 'json'
+
+
+def dumps(data, default=None):
+    """ JSON в байтах; default - преобразование типов, которые не умеет бэкенд """
+    if orjson is not None:
+        try:
+            # даты передаются в default, как и в стандартном json: формат задаёт вызывающий
+            return orjson.dumps(data, default=default,
+                                option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME)
+        except TypeError:
+            # например, числа больше 64 бит: их умеет только стандартный json
+            pass
+    return json.dumps(data, default=default, separators=(',', ':')).encode()
+
+
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """ jsonify и request.get_json через dumps/loads модуля; типы, которые не умеет orjson,
+    сериализуются как в стандартном провайдере Flask """
+
+    def dumps(self, obj, **kwargs):
+        if kwargs:
+            return super().dumps(obj, **kwargs)
+        return dumps(obj, default=self.default).decode()
+
+    def loads(self, s, **kwargs):
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dumps(obj, default=self.default) + b'\n',
+                                        mimetype=self.mimetype)
+
+
+def setup_json(app):
+    app.json = FastJSONProvider(app)
+
+
+class Schema:
+    """ Скомпилированная схема параметров: множество обязательных имён и проверки типов """
+
+    def __init__(self, params):
+        self.required = frozenset(params)
+        self.types = ()
+        if isinstance(params, dict):
+            types = []
+            for name, kind in params.items():
+                if kind is None:
+                    continue
+                kinds = kind if isinstance(kind, tuple) else (kind,)
+                # bool - подкласс int, но как число не принимается
+                types.append((name, kinds, bool in kinds))
+            self.types = tuple(types)
+
+    def validate(self, params):
+        """ None, если параметры подходят, иначе имя первого неправильного параметра """
+        if not self.required <= params.keys():
+            return next(name for name in self.required if name not in params)
+        for name, kinds, allow_bool in self.types:
+            value = params[name]
+            if not isinstance(value, kinds) or (not allow_bool and isinstance(value, bool)):
+                return name
+        return None
+
+
+def compile_schemas(params_get=None, params_post=None, params_delete=None, params_put=None):
+    """ Метод -> Schema; метод без схемы не проверяется """
+    schemas = {'GET': params_get, 'POST': params_post, 'DELETE': params_delete, 'PUT': params_put}
+    return {method: Schema(params) for method, params in schemas.items() if params}
+
+
+def request_params():
+    """ Параметры текущего запроса: аргументы строки запроса для GET, иначе JSON-объект тела.
+    Тело разбирается один раз на запрос; None, если это не JSON-объект """
+    if request.method == 'GET':
+        return request.args
+    if 'request_params' not in g:
+        body = request.get_json(silent=True)
+        g.request_params = body if isinstance(body, dict) else None
+    return g.request_params
+
+
+def check_params(params_get=None, params_post=None, params_delete=None, params_put=None):
+    schemas = compile_schemas(params_get, params_post, params_delete, params_put)
+
+    def __check_params(func):
+        @functools.wraps(func)
+        def check_params_inner(*args, **kwargs):
+            schema = schemas.get(request.method)
+            if schema is not None:
+                params = request_params()
+                if params is None or schema.validate(params) is not None:
+                    return make_response(
+                        jsonify({"error": f"incorrect {request.method} input"}), 400)
+            return func(*args, **kwargs)
+
+        return check_params_inner
+
+    return __check_params
@@ -1,134 +1,756 @@
-from pymongo import MongoClient
-import functools
+from bson import ObjectId, json_util
+from pymongo import MongoClient, ASCENDING, IndexModel, InsertOne, UpdateOne, UpdateMany, DeleteOne, DeleteMany, ReturnDocument, WriteConcern
+from pymongo.errors import BulkWriteError, ConfigurationError, DuplicateKeyError, OperationFailure, PyMongoError, WriteConcernError, WriteError
+from pymongo.read_preferences import Nearest, Primary, PrimaryPreferred, Secondary, SecondaryPreferred
 import json
-from flask import Flask, jsonify, request, make_response
+import os
+import threading
+from flask import Flask, Response, g, jsonify, request, make_response
+import pymongo
 import copy, requests
 
-client = MongoClient('mongo', 27017, username='root', password='root')
+import deadline
+import logs
+import metrics
+import tracing
+import validation
+from health import register_health
+from validation import check_params, request_params
+from write_coalescer import WriteCoalescer
+
+# параметры MongoClient из переменных окружения: переменная -> (параметр, преобразование);
+# не заданные переменные оставляют значения pymongo по умолчанию
+client_options = {
+    # пул соединений с каждым членом replica set
+    'MONGO_MAX_POOL_SIZE': ('maxPoolSize', int),
+    'MONGO_MIN_POOL_SIZE': ('minPoolSize', int),
+    'MONGO_MAX_IDLE_TIME_MS': ('maxIdleTimeMS', int),
+    'MONGO_WAIT_QUEUE_TIMEOUT_MS': ('waitQueueTimeoutMS', int),
+    # таймауты
+    'MONGO_CONNECT_TIMEOUT_MS': ('connectTimeoutMS', int),
+    'MONGO_SOCKET_TIMEOUT_MS': ('socketTimeoutMS', int),
+    'MONGO_SERVER_SELECTION_TIMEOUT_MS': ('serverSelectionTimeoutMS', int),
+    # сжатие: zlib, zstd (нужен zstandard), snappy (нужен python-snappy) через запятую
+    'MONGO_COMPRESSORS': ('compressors', str),
+    'MONGO_ZLIB_COMPRESSION_LEVEL': ('zlibCompressionLevel', int),
+    # replica set и настройки чтения и записи по умолчанию для всех коллекций
+    'MONGO_REPLICA_SET': ('replicaSet', str),
+    'MONGO_READ_PREFERENCE': ('readPreference', str),
+    'MONGO_MAX_STALENESS_SECONDS': ('maxStalenessSeconds', int),
+    'MONGO_WRITE_CONCERN': ('w', lambda value: int(value) if value.isdigit() else value),
+    'MONGO_JOURNAL': ('journal', lambda value: value == 'true'),
+    'MONGO_WTIMEOUT_MS': ('wTimeoutMS', int)
+}
+# read preference и write concern по умолчанию для отдельных коллекций:
+# "database.collection" -> {"read_preference": ..., "write_concern": ...}, формат как в запросе
+collection_settings = json.loads(os.environ.get('MONGO_COLLECTION_SETTINGS', '{}'))
+read_preferences = {
+    'primary': Primary,
+    'primaryPreferred': PrimaryPreferred,
+    'secondary': Secondary,
+    'secondaryPreferred': SecondaryPreferred,
+    'nearest': Nearest
+}
+
+
+def mongo_client():
+    """ MongoClient по MONGO_URI или по MONGO_HOST, MONGO_PORT, MONGO_USERNAME, MONGO_PASSWORD """
+    options = {option: convert(os.environ[name])
+               for name, (option, convert) in client_options.items() if name in os.environ}
+    listeners = [metrics.mongo_listener('database')]
+    if 'MONGO_URI' in os.environ:
+        return MongoClient(os.environ['MONGO_URI'], event_listeners=listeners, **options)
+    return MongoClient(os.environ.get('MONGO_HOST', 'mongo'),
+                       int(os.environ.get('MONGO_PORT', 27017)),
+                       username=os.environ.get('MONGO_USERNAME', 'root'),
+                       password=os.environ.get('MONGO_PASSWORD', 'root'),
+                       event_listeners=listeners, **options)
+
+
+client = mongo_client()
+# групповая запись одиночных операций: окно ожидания в миллисекундах (0 - выключена)
+# и максимальное количество операций в одном bulk_write
+write_coalescer = WriteCoalescer(client, 'database',
+                                 window=float(os.environ.get('WRITE_COALESCE_WINDOW_MS', 0)) / 1000,
+                                 max_ops=int(os.environ.get('WRITE_COALESCE_MAX_OPS', 100)))
 
 app = Flask(__name__)
-app.debug = True
+logs.setup_logging(app, 'database')
+metrics.setup_metrics(app, 'database')
+tracing.setup_tracing(app, 'database')
+validation.setup_json(app)
+deadline.setup_deadline(app)
+register_health(app, {"mongo": lambda: client.admin.command('ping')})
+
+# параметры GET-запроса, которые не попадают в условие поиска
+service_params = ['database', 'collection', 'stream', 'batch_size', 'limit', 'after',
+                  'read_preference']
+# операторы, разрешённые в атрибуте "update" PUT-запроса
+update_operators = {'$set', '$inc', '$setOnInsert', '$unset', '$min', '$max'}
+# стадии, разрешённые в "pipeline" запроса /query: только чтение и группировка внутри коллекции
+pipeline_stages = {'$match', '$project', '$group', '$sort', '$limit', '$skip', '$count', '$unwind'}
+# операторы, которые не принимаются нигде в /query: выполнение кода, запись и чтение других коллекций
+forbidden_operators = {'$where', '$function', '$accumulator', '$out', '$merge', '$lookup',
+                       '$graphLookup', '$unionWith'}
+# максимальное количество документов в ответе /query и время выполнения запроса в MongoDB
+query_max_limit = 1000
+query_max_time_ms = 5000
+
+# индексы, которые создаются при старте сервиса: (database, collection) -> список индексов
+indexes = {
+    ('organizer', 'users'): [
+        IndexModel([('user', ASCENDING)], name='user_unique', unique=True)
+    ],
+    ('organizer', 'shoplist'): [
+        # покрывает и поиск по (user, name, shop), и поиск по одному user (префикс индекса)
+        IndexModel([('user', ASCENDING), ('name', ASCENDING), ('shop', ASCENDING)],
+                   name='user_name_shop_unique', unique=True),
+        IndexModel([('user', ASCENDING), ('version', ASCENDING)], name='user_version')
+    ],
+    ('organizer', 'shoplist_tombstones'): [
+        IndexModel([('user', ASCENDING), ('name', ASCENDING), ('shop', ASCENDING)],
+                   name='user_name_shop_unique', unique=True),
+        IndexModel([('user', ASCENDING), ('version', ASCENDING)], name='user_version')
+    ],
+    ('organizer', 'shoplist_versions'): [
+        IndexModel([('user', ASCENDING)], name='user_unique', unique=True)
+    ]
+}
+# запросы, которые выполняются на каждый запрос пользователя; проверяются через GET /admin/explain
+hot_queries = [
+    ('organizer', 'users', {"user": ""}),
+    ('organizer', 'shoplist', {"user": ""}),
+    ('organizer', 'shoplist', {"user": "", "name": "", "shop": ""}),
+    ('organizer', 'shoplist_versions', {"user": ""}),
+    ('organizer', 'shoplist', {"user": "", "version": {"$gt": 0}}),
+    ('organizer', 'shoplist_tombstones', {"user": "", "version": {"$gt": 0}})
+]
+
+
+class IncorrectSettings(Exception):
+    pass
 
 
 def error(message, code):
     return make_response(jsonify({"error": message}), code)
 
 
-def check_params(params_get=None, params_post=None, params_delete=None, params_put=None):
-    def __check_params(func):
-        @functools.wraps(func)
-        def check_params_inner(*args, **kwargs):
-            if request.method == 'GET':
-                for param in params_get:
-                    if not param in request.args:
-                        return error("incorrect GET input", 400)
-            if request.method == 'POST':
-                for param in params_post:
-                    if not param in request.get_json().keys():
-                        return error("incorrect POST input", 400)
-            if request.method == 'DELETE':
-                for param in params_delete:
-                    if not param in request.get_json().keys():
-                        return error("incorrect DELETE input", 400)
-            if request.method == 'PUT':
-                for param in params_put:
-                    if not param in request.get_json().keys():
-                        return error("incorrect PUT input", 400)
-            return func(*args, **kwargs)
-
-        return check_params_inner
-
-    return __check_params
+@app.errorhandler(IncorrectSettings)
+def incorrect_settings(e):
+    return error(str(e), 400)
+
+
+def parse_read_preference(value):
+    """ ReadPreference из имени режима или {"mode", "max_staleness", "tags"}; None - по умолчанию """
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = {"mode": value}
+    if not isinstance(value, dict) or value.get('mode') not in read_preferences:
+        raise IncorrectSettings("incorrect read_preference")
+    mode = read_preferences[value['mode']]
+    if mode is Primary:
+        if value.keys() != {'mode'}:
+            raise IncorrectSettings("incorrect read_preference")
+        return Primary()
+    try:
+        return mode(tag_sets=value.get('tags'), max_staleness=value.get('max_staleness', -1))
+    except (TypeError, ValueError, ConfigurationError):
+        raise IncorrectSettings("incorrect read_preference")
+
+
+def parse_write_concern(value):
+    """ WriteConcern из значения w (число или "majority") или {"w", "j", "wtimeout"}.
+    Число может прийти строкой (параметр GET-запроса); другие строки MongoDB считает именем
+    набора тегов, поэтому они не принимаются """
+    if value is None:
+        return None
+    if not isinstance(value, dict):
+        value = {"w": value}
+    if not value.keys() <= {'w', 'j', 'wtimeout'}:
+        raise IncorrectSettings("incorrect write_concern")
+    w = value.get('w')
+    if isinstance(w, str) and w.isdigit():
+        value = {**value, "w": int(w)}
+    elif w is not None and w != 'majority' and (not isinstance(w, int) or isinstance(w, bool)):
+        raise IncorrectSettings("incorrect write_concern")
+    try:
+        return WriteConcern(**value)
+    except (TypeError, ValueError, ConfigurationError):
+        raise IncorrectSettings("incorrect write_concern")
+
+
+def get_collection(db_name, collection_name, params=None):
+    """ Коллекция с read preference и write concern из параметров запроса, иначе из
+    collection_settings, иначе с настройками клиента """
+    settings = collection_settings.get(f'{db_name}.{collection_name}', {})
+    params = params or {}
+    read_preference = params.get('read_preference', settings.get('read_preference'))
+    write_concern = params.get('write_concern', settings.get('write_concern'))
+    return client[db_name].get_collection(
+        collection_name,
+        read_preference=parse_read_preference(read_preference),
+        write_concern=parse_write_concern(write_concern))
+
+
+def coalesced_bulk(collection, operation, *args, **kwargs):
+    """ Одиночная операция (InsertOne, DeleteMany) через write_coalescer; ошибка операции и
+    ошибка write concern - BulkWriteError с теми же details, что у insert_many и bulk_write """
+    try:
+        return write_coalescer.write(collection, operation, *args, **kwargs)
+    except WriteError as e:
+        raise BulkWriteError({"writeErrors": [{"index": 0, "code": e.code,
+                                               "errmsg": e.details.get('errmsg')}]})
+    except WriteConcernError as e:
+        details = {"writeErrors": [], "writeConcernErrors": [e.details]}
+        if operation is InsertOne:
+            details['nInserted'] = 1
+        else:
+            details['nRemoved'] = e.partial_result.deleted_count
+        raise BulkWriteError(details)
+
+
+def update_one(collection, query, update, upsert=False):
+    """ update_one через write_coalescer, если групповая запись включена """
+    if write_coalescer.accepts(collection):
+        return write_coalescer.write(collection, UpdateOne, query, update, upsert=upsert)
+    return collection.update_one(query, update, upsert=upsert)
+
+
+def accepted():
+    """ Ответ на запись с write concern w=0: MongoDB не подтверждает её, результат неизвестен """
+    return make_response(jsonify({"status": "accepted"}), 202)
+
+
+@app.before_request
+def start_mongo_timeout():
+    """ Все команды MongoDB запроса ограничены временем до его дедлайна (timeout pymongo) """
+    left = deadline.remaining()
+    if left is not None:
+        g.mongo_timeout = pymongo.timeout(left)
+        g.mongo_timeout.__enter__()
+
+
+@app.teardown_request
+def finish_mongo_timeout(exc):
+    scope = g.pop('mongo_timeout', None)
+    if scope is not None:
+        scope.__exit__(None, None, None)
+
+
+@app.errorhandler(PyMongoError)
+def mongo_error(e):
+    if e.timeout:
+        return error("deadline exceeded", 504)
+    return error(str(e), 500)
 
 
 # GET:      curl "http://127.0.0.1:5002?collection=shoplist&database=organizer"
+# STREAM:   curl "http://127.0.0.1:5002?collection=users&database=organizer&stream=true&batch_size=500&limit=10000&after=5f8d0d55b54764421b7156c9"
 # POST:     curl --header "Content-Type: application/json" --request POST --data '{ "collection": "shoplist", "database": "organizer", "data": [{"name":"test4", "user": "zaqwer101"}]}' http://127.0.0.1:5002 -k
 # DELETE:   curl --header "Content-Type: application/json" --request DELETE --data '{"collection": "shoplist", "database": "organizer", "data": [{"user": "zaqwer1011"}] }' "http://127.0.0.1:5002" -k
 # PUT:      curl --header "Content-Type: application/json" --request PUT --data '{ "collection": "shoplist", "database": "organizer", "query": {"name": "test6"}, "data": {"name": "test228"} }' http://127.0.0.1:5002 -k
+# BULK:     curl --header "Content-Type: application/json" --request POST --data '{ "collection": "shoplist", "database": "organizer", "ordered": false, "operations": [{"op": "insert", "data": {"name": "test7"}}, {"op": "delete", "query": {"name": "test6"}}] }' http://127.0.0.1:5002/bulk -k
+# UPSERT:   curl --header "Content-Type: application/json" --request PUT --data '{ "collection": "shoplist", "database": "organizer", "query": {"name": "test6"}, "update": {"$inc": {"amount": 1}}, "upsert": true }' http://127.0.0.1:5002 -k
+# COUNTER:  curl --header "Content-Type: application/json" --request PUT --data '{ "collection": "counters", "database": "organizer", "query": {"name": "test6"}, "update": {"$inc": {"value": 1}}, "upsert": true, "return_document": "after" }' http://127.0.0.1:5002 -k
 @app.route('/', methods=['GET', 'POST', 'DELETE', 'PUT'])
 @check_params(params_get=['database', 'collection'],
-              params_post=['database', 'collection', 'data'],
-              params_delete=['database', 'collection', 'data'],
-              params_put=['database', 'collection',
-                          'query',  # условие, какие элементы меняем
-                          'data'])  # на что меняем
+              params_post={'database': str, 'collection': str, 'data': list},
+              params_delete={'database': str, 'collection': str, 'data': list},
+              params_put={'database': str, 'collection': str,
+                          'query': dict})  # условие, какие элементы меняем; data или update - на что меняем
 def database_handler():
     # получаем данные из БД
     # query=get
     if request.method == 'GET':
-        service_params = ['database', 'collection']
         db_name = request.args['database']
         collection_name = request.args['collection']
         query = {}
-        result = []
 
         for arg in request.args.keys():
             if arg not in service_params:
                 query[arg] = request.args[arg]
-                
-        app.logger.info(f'GET query: {query}')
-        db = client[db_name]
-        collection = db[collection_name]
-
-        for elem in collection.find(query):
-            elem['id'] = str(elem['_id'])
-            del elem['_id']
-            app.logger.info(f'  Elem: {elem}')
-            result.append(elem)
+
+        app.logger.info('GET query: %s', query)
+        collection = get_collection(db_name, collection_name, request.args)
+
+        try:
+            cursor = find_page(collection, query, request.args)
+        except ValueError as e:
+            return error(str(e), 400)
+
+        if request.args.get('stream') == 'true':
+            return stream_response(cursor)
+
+        result = [document_to_json(elem) for elem in cursor]
         if len(result) == 0:
             return error("not found", 404)
-        return jsonify(result)  # статус 200 по умолчанию
+        response = jsonify(result)  # статус 200 по умолчанию
+        if 'limit' in request.args and len(result) == int(request.args['limit']):
+            # страница заполнена целиком, следующую можно запросить с after=<id последнего элемента>
+            response.headers['X-Next-Cursor'] = result[-1]['id']
+        return response
 
 
     # вносим данные в БД
     elif request.method == 'POST':
-        db_name = request.get_json()['database']
-        collection_name = request.get_json()['collection']
-        db = client[db_name]
-        collection = db[collection_name]
-        data = request.get_json()['data']
-        app.logger.info(f'POST data: {data}')
+        body = request_params()
+        collection = get_collection(body['database'], body['collection'], body)
+        data = body['data']
+        app.logger.info('POST %d elements', len(data))
+        app.logger.debug('POST data: %s', data)
 
         if len(data) != 0:
-            out = []
-            for elem in request.get_json()['data']:
-                app.logger.info(f'   Elem: {elem}')
-                out.append(str(collection.insert_one(elem).inserted_id))
+            ordered = bool(body.get('ordered', True))
+            try:
+                if len(data) == 1 and write_coalescer.accepts(collection):
+                    result = coalesced_bulk(collection, InsertOne, data[0])
+                    inserted_ids = [result.inserted_id]
+                else:
+                    result = collection.insert_many(data, ordered=ordered)
+                    inserted_ids = result.inserted_ids
+            except BulkWriteError as e:
+                return bulk_response(data, e.details, ordered, documents=data)
+            if not result.acknowledged:
+                return accepted()
+            out = [str(inserted_id) for inserted_id in inserted_ids]
             return make_response(jsonify({"output": out}), 201)  # объект создан
         else:
             return error("empty data", 400)
 
 
     elif request.method == 'DELETE':
-        db_name = request.get_json()['database']
-        collection_name = request.get_json()['collection']
-        db = client[db_name]
-        collection = db[collection_name]
-        data = request.get_json()['data']
-        app.logger.info(f'DELETE data: {data}')
+        body = request_params()
+        collection = get_collection(body['database'], body['collection'], body)
+        data = body['data']
+        app.logger.info('DELETE data: %s', data)
 
         if len(data) != 0:
-            for elem in request.get_json()['data']:
-                count = collection.delete_many(elem).deleted_count
-            return make_response(jsonify({"status": "success", "deleted": count}), 201)
+            ordered = bool(body.get('ordered', True))
+            operations = [DeleteMany(elem) for elem in data]
+            try:
+                if len(data) == 1 and write_coalescer.accepts(collection):
+                    result = coalesced_bulk(collection, DeleteMany, data[0])
+                else:
+                    result = collection.bulk_write(operations, ordered=ordered)
+            except BulkWriteError as e:
+                return bulk_response(operations, e.details, ordered)
+            if not result.acknowledged:
+                return accepted()
+            return make_response(jsonify({"status": "success", "deleted": result.deleted_count}),
+                                 201)
         else:
             return error("empty data", 400)
 
 
     elif request.method == 'PUT':
-        db_name = request.get_json()['database']
-        collection_name = request.get_json()['collection']
-        db = client[db_name]
-        collection = db[collection_name]
-        app.logger.info(f'PUT query: {request.get_json()["query"]}')
-        app.logger.info(f'PUT data: {request.get_json()["data"]}')
-
-        result = collection.update_one(
-            request.get_json()['query'],
-            {"$set": request.get_json()['data']}
+        body = request_params()
+        collection = get_collection(body['database'], body['collection'], body)
+        query = body['query']
+        app.logger.info('PUT query: %s', query)
+
+        if 'update' in body:
+            # атомарное изменение операторами MongoDB, опционально с созданием элемента
+            update = body['update']
+            upsert = bool(body.get('upsert', False))
+            app.logger.info('PUT update: %s, upsert: %s', update, upsert)
+            if not update or not set(update.keys()) <= update_operators:
+                return error("incorrect update operators", 400)
+            if 'return_document' in body:
+                return find_and_update(collection, query, update, upsert, body['return_document'])
+            return update_element(collection, query, update, upsert)
+
+        if 'data' not in body:
+            return error("incorrect PUT input", 400)
+        app.logger.info('PUT data: %s', body['data'])
+
+        result = update_one(
+            collection,
+            query,
+            {"$set": body['data']}
         )
 
+        if not result.acknowledged:
+            return accepted()
         if result.modified_count > 0:
             return jsonify({"status": "success"})
         else:
             return error("not found", 404)
+
+
+# POST: операции разных типов одним bulk_write
+@app.route('/bulk', methods=['POST'])
+@check_params(params_post={'database': str, 'collection': str, 'operations': list})
+def bulk_handler():
+    body = request_params()
+    collection = get_collection(body['database'], body['collection'], body)
+    ordered = bool(body.get('ordered', True))
+    app.logger.info('BULK %d operations, ordered: %s', len(body['operations']), ordered)
+
+    try:
+        operations = [build_operation(op) for op in body['operations']]
+        # bulk_write проставляет _id прямо во вставляемых документах
+        documents = [op['data'] if op['op'] == 'insert' else None
+                     for op in body['operations']]
+    except ValueError as e:
+        return error(str(e), 400)
+    if len(operations) == 0:
+        return error("empty operations", 400)
+
+    try:
+        result = collection.bulk_write(operations, ordered=ordered)
+        if not result.acknowledged:
+            return accepted()
+        details = result.bulk_api_result
+    except BulkWriteError as e:
+        details = e.details
+    except OperationFailure as e:
+        return error(str(e), 400)
+    return bulk_response(operations, details, ordered, documents)
+
+
+# FIND:      curl --header "Content-Type: application/json" --request POST --data '{ "collection": "shoplist", "database": "organizer", "filter": {"user": "zaqwer101", "bought": "false"}, "projection": ["name", "shop"], "sort": [["name", 1]], "limit": 10 }' http://127.0.0.1:5002/query
+# COUNT:     curl --header "Content-Type: application/json" --request POST --data '{ "collection": "shoplist", "database": "organizer", "filter": {"user": "zaqwer101"}, "count": true }' http://127.0.0.1:5002/query
+# AGGREGATE: curl --header "Content-Type: application/json" --request POST --data '{ "collection": "shoplist", "database": "organizer", "pipeline": [{"$match": {"user": "zaqwer101"}}, {"$group": {"_id": "$shop", "amount": {"$sum": "$amount"}}}] }' http://127.0.0.1:5002/query
+@app.route('/query', methods=['POST'])
+@check_params(params_post={'database': str, 'collection': str})
+def query_handler():
+    """ Типизированный запрос: условие и проекция в JSON, сортировка, limit, подсчёт и
+    ограниченный aggregation pipeline выполняются в MongoDB, наружу уходят только нужные поля """
+    body = request_params()
+    collection = get_collection(body['database'], body['collection'], body)
+    try:
+        if 'pipeline' in body:
+            return json_response({"result": run_pipeline(collection, body['pipeline'])})
+        return json_response(run_find(collection, body))
+    except ValueError as e:
+        return error(str(e), 400)
+    except OperationFailure as e:
+        return error(str(e), 400)
+
+
+def check_operators(value):
+    """ ValueError, если в условии или выражении есть запрещённый оператор """
+    if isinstance(value, dict):
+        for key, elem in value.items():
+            if key in forbidden_operators:
+                raise ValueError(f"operator {key} is not allowed")
+            check_operators(elem)
+    elif isinstance(value, list):
+        for elem in value:
+            check_operators(elem)
+
+
+def query_limit(value):
+    if not isinstance(value, int) or isinstance(value, bool) or value <= 0:
+        raise ValueError("incorrect limit")
+    return min(value, query_max_limit)
+
+
+def run_find(collection, body):
+    """ find или count_documents по атрибутам filter, projection, sort, skip, limit, count """
+    query = body.get('filter', {})
+    if not isinstance(query, dict):
+        raise ValueError("incorrect filter")
+    check_operators(query)
+    app.logger.info('QUERY filter: %s', query)
+
+    if body.get('count'):
+        return {"count": collection.count_documents(query, maxTimeMS=query_max_time_ms)}
+
+    projection = body.get('projection')
+    if isinstance(projection, list):
+        projection = {field: 1 for field in projection}
+    if projection is not None:
+        # в проекции find допустимы выражения агрегации, поэтому принимаются только
+        # включение и исключение полей
+        if not isinstance(projection, dict) or \
+                not all(value in (0, 1) for value in projection.values()):
+            raise ValueError("incorrect projection")
+        check_operators(projection)
+    cursor = collection.find(query, projection).max_time_ms(query_max_time_ms)
+    if 'sort' in body:
+        try:
+            cursor = cursor.sort([(field, int(direction)) for field, direction in body['sort']])
+        except (TypeError, ValueError):
+            raise ValueError("incorrect sort")
+    if 'skip' in body:
+        if not isinstance(body['skip'], int) or body['skip'] < 0:
+            raise ValueError("incorrect skip")
+        cursor = cursor.skip(body['skip'])
+    cursor = cursor.limit(query_limit(body.get('limit', query_max_limit)))
+    return {"result": [document_to_json(elem) if '_id' in elem else elem for elem in cursor]}
+
+
+def run_pipeline(collection, pipeline):
+    """ aggregate только из стадий pipeline_stages; результат ограничен query_max_limit """
+    if not isinstance(pipeline, list) or len(pipeline) == 0:
+        raise ValueError("incorrect pipeline")
+    for stage in pipeline:
+        if not isinstance(stage, dict) or len(stage) != 1 or \
+                next(iter(stage)) not in pipeline_stages:
+            raise ValueError(f"stage {stage} is not allowed")
+    check_operators(pipeline)
+    app.logger.info('QUERY pipeline: %s', pipeline)
+    pipeline = pipeline + [{"$limit": query_max_limit}]
+    return list(collection.aggregate(pipeline, maxTimeMS=query_max_time_ms))
+
+
+# GET: curl "http://127.0.0.1:5002/changes?collection=shoplist&database=organizer&user=zaqwer101&since=10"
+@app.route('/changes', methods=['GET'])
+@check_params(params_get=['database', 'collection', 'since'])
+def changes_handler():
+    """ Документы с атрибутом version больше since в порядке возрастания версии """
+    collection = get_collection(request.args['database'], request.args['collection'],
+                                request.args)
+    query = {arg: value for arg, value in request.args.items()
+             if arg not in ('database', 'collection', 'since', 'limit', 'read_preference')}
+    try:
+        query['version'] = {"$gt": int(request.args['since'])}
+        limit = int(request.args.get('limit', 0))
+    except ValueError:
+        return error("incorrect since or limit", 400)
+    app.logger.info('CHANGES query: %s', query)
+
+    cursor = collection.find(query).sort('version', ASCENDING).limit(limit)
+    return jsonify([document_to_json(elem) for elem in cursor])
+
+
+def build_operation(op):
+    """ Операция bulk_write из элемента запроса:
+    {"op": "insert", "data"}, {"op": "update", "query", "update", "upsert", "multi"}, {"op": "delete", "query", "multi"} """
+    kind = op.get('op')
+    if kind == 'insert' and isinstance(op.get('data'), dict):
+        return InsertOne(op['data'])
+    if kind == 'update' and isinstance(op.get('query'), dict) and op.get('update'):
+        if not set(op['update'].keys()) <= update_operators:
+            raise ValueError("incorrect update operators")
+        operation = UpdateMany if op.get('multi', False) else UpdateOne
+        return operation(op['query'], op['update'], upsert=bool(op.get('upsert', False)))
+    if kind == 'delete' and isinstance(op.get('query'), dict):
+        operation = DeleteMany if op.get('multi', True) else DeleteOne
+        return operation(op['query'])
+    raise ValueError(f"incorrect operation: {op}")
+
+
+def bulk_response(operations, details, ordered, documents=None):
+    """ Результат по каждой операции и суммарные счетчики; 400, если были ошибки """
+    upserted = {elem['index']: str(elem['_id']) for elem in details.get('upserted', [])}
+    errors = {elem['index']: elem['errmsg'] for elem in details.get('writeErrors', [])}
+    first_error = min(errors) if errors else None
+
+    results = []
+    for index, operation in enumerate(operations):
+        if index in errors:
+            results.append({"index": index, "status": "error", "error": errors[index]})
+        elif ordered and first_error is not None and index > first_error:
+            # в ordered-режиме операции после первой ошибки не выполняются
+            results.append({"index": index, "status": "skipped"})
+        else:
+            result = {"index": index, "status": "success"}
+            if documents is not None and documents[index] is not None:
+                result['inserted'] = str(documents[index]['_id'])
+            if index in upserted:
+                result['upserted'] = upserted[index]
+            results.append(result)
+
+    body = {
+        "status": "error" if errors else "success",
+        "inserted": details.get('nInserted', 0),
+        "upserted": details.get('nUpserted', 0),
+        "matched": details.get('nMatched', 0),
+        "modified": details.get('nModified', 0),
+        "deleted": details.get('nRemoved', 0),
+        "results": results
+    }
+    return make_response(jsonify(body), 400 if errors else 200)
+
+
+def ensure_indexes():
+    """ Создать объявленные индексы, возвращает созданные индексы или ошибку по каждой коллекции """
+    result = {}
+    for (db_name, collection_name), models in indexes.items():
+        key = f'{db_name}.{collection_name}'
+        try:
+            result[key] = client[db_name][collection_name].create_indexes(models)
+            app.logger.info('Indexes for %s: %s', key, result[key])
+        except PyMongoError as e:
+            app.logger.error('Indexes for %s not created: %s', key, e)
+            result[key] = {"error": str(e)}
+    return result
+
+
+def explain_summary(collection, query, sort=None):
+    """ Этапы выигравшего плана запроса и использованные индексы """
+    cursor = collection.find(query)
+    if sort:
+        cursor = cursor.sort(sort)
+    explain = cursor.explain()
+    plan = explain['queryPlanner']['winningPlan']
+    plan = plan.get('queryPlan', plan)
+
+    stages, index_names = [], []
+    plans = [plan]
+    while plans:
+        stage = plans.pop()
+        stages.append(stage['stage'])
+        if 'indexName' in stage:
+            index_names.append(stage['indexName'])
+        if 'inputStage' in stage:
+            plans.append(stage['inputStage'])
+        plans.extend(stage.get('inputStages', []))
+
+    return {
+        "namespace": explain['queryPlanner'].get('namespace'),
+        "query": query,
+        "stages": stages,
+        "indexes": index_names,
+        "collscan": 'COLLSCAN' in stages,
+        "explain": explain
+    }
+
+
+def json_response(data, code=200):
+    """ Ответ с BSON-типами (ObjectId, даты), которые не умеет jsonify """
+    return Response(validation.dumps(data, default=json_util.default), status=code,
+                    mimetype='application/json')
+
+
+# GET:      curl "http://127.0.0.1:5002/admin/indexes?database=organizer&collection=shoplist"
+# POST:     curl --request POST http://127.0.0.1:5002/admin/indexes
+@app.route('/admin/indexes', methods=['GET', 'POST'])
+@check_params(params_get=['database', 'collection'], params_post=[])
+def indexes_handler():
+    if request.method == 'GET':
+        collection = client[request.args['database']][request.args['collection']]
+        return json_response(collection.index_information())
+
+    if request.method == 'POST':
+        return json_response(ensure_indexes())
+
+
+# GET:      curl "http://127.0.0.1:5002/admin/writes"
+@app.route('/admin/writes', methods=['GET'])
+def writes_handler():
+    """ Статистика групповой записи процесса """
+    return json_response(write_coalescer.stats())
+
+
+# GET:      curl "http://127.0.0.1:5002/admin/explain"
+# POST:     curl --header "Content-Type: application/json" --request POST --data '{ "collection": "shoplist", "database": "organizer", "query": {"user": "zaqwer101"} }' http://127.0.0.1:5002/admin/explain
+@app.route('/admin/explain', methods=['GET', 'POST'])
+@check_params(params_get=[], params_post=['database', 'collection', 'query'])
+def explain_handler():
+    # планы всех горячих запросов сервиса
+    if request.method == 'GET':
+        return json_response([explain_summary(client[db_name][collection_name], query)
+                              for db_name, collection_name, query in hot_queries])
+
+    if request.method == 'POST':
+        body = request_params()
+        collection = client[body['database']][body['collection']]
+        sort = body.get('sort')
+        try:
+            summary = explain_summary(collection, body['query'],
+                                      [tuple(elem) for elem in sort] if sort else None)
+        except OperationFailure as e:
+            return error(str(e), 400)
+        return json_response(summary)
+
+
+def find_page(collection, query, args):
+    """ Курсор по query с учетом batch_size, limit и after (keyset-пагинация по _id) """
+    cursor = collection.find(query)
+    if 'after' in args or 'limit' in args:
+        # страницы продолжаются с _id, поэтому порядок должен быть по нему
+        if 'after' in args:
+            if not ObjectId.is_valid(args['after']):
+                raise ValueError("incorrect cursor")
+            cursor = collection.find({"$and": [query, {"_id": {"$gt": ObjectId(args['after'])}}]})
+        cursor = cursor.sort('_id', ASCENDING)
+    try:
+        if 'batch_size' in args:
+            cursor = cursor.batch_size(int(args['batch_size']))
+        if 'limit' in args:
+            cursor = cursor.limit(int(args['limit']))
+    except ValueError:
+        raise ValueError("incorrect batch_size or limit")
+    return cursor
+
+
+def document_to_json(elem):
+    elem['id'] = str(elem['_id'])
+    del elem['_id']
+    return elem
+
+
+def stream_response(cursor):
+    """ NDJSON-ответ: документы отдаются по мере чтения курсора, без сборки списка в памяти.
+    id последнего полученного документа - токен для продолжения с after=<id> """
+    first = next(cursor, None)
+    if first is None:
+        cursor.close()
+        return error("not found", 404)
+
+    def generate():
+        try:
+            yield validation.dumps(document_to_json(first), default=str) + b'\n'
+            for elem in cursor:
+                yield validation.dumps(document_to_json(elem), default=str) + b'\n'
+        finally:
+            cursor.close()
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
+
+def update_element(collection, query, update, upsert):
+    """ update_one с операторами; 201 - если элемент был создан, 404 - если ничего не найдено """
+    try:
+        try:
+            result = update_one(collection, query, update, upsert)
+        except DuplicateKeyError:
+            # параллельный upsert успел создать элемент, теперь он найдётся по query
+            result = update_one(collection, query, update, upsert)
+    except OperationFailure as e:
+        return error(str(e), 400)
+
+    if not result.acknowledged:
+        return accepted()
+    if result.upserted_id is not None:
+        return make_response(jsonify({"status": "success",
+                                      "upserted": str(result.upserted_id)}), 201)
+    if result.matched_count == 0:
+        return error("not found", 404)
+    return jsonify({"status": "success",
+                    "matched": result.matched_count,
+                    "modified": result.modified_count})
+
+
+def find_and_update(collection, query, update, upsert, return_document):
+    """ find_one_and_update: документ до ("before") или после ("after") изменения в "document".
+    Не проходит через write_coalescer: результат нужен сразу и только этому запросу """
+    if return_document not in ('before', 'after'):
+        return error("incorrect return_document", 400)
+    if not collection.write_concern.acknowledged:
+        return error("return_document needs an acknowledged write concern", 400)
+    which = ReturnDocument.BEFORE if return_document == 'before' else ReturnDocument.AFTER
+    try:
+        try:
+            document = collection.find_one_and_update(query, update, upsert=upsert,
+                                                      return_document=which)
+        except DuplicateKeyError:
+            document = collection.find_one_and_update(query, update, upsert=upsert,
+                                                      return_document=which)
+    except OperationFailure as e:
+        return error(str(e), 400)
+
+    if document is not None:
+        return jsonify({"status": "success", "document": document_to_json(document)})
+    if upsert and return_document == 'before':
+        # документа не было, он создан этим запросом
+        return make_response(jsonify({"status": "success", "document": None}), 201)
+    return error("not found", 404)
+
+
+# MongoDB может подниматься дольше сервиса, поэтому индексы создаются в фоне
+threading.Thread(target=ensure_indexes, daemon=True).start()
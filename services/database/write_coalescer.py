@@ -0,0 +1,163 @@
+""" Групповая запись (group commit): одиночные записи разных запросов в одну коллекцию,
+пришедшие в течение window секунд (или до max_ops операций), выполняются одним
+MongoClient.bulk_write вместо отдельного запроса к MongoDB на каждую.
+
+Первая запись пакета ждёт окно и выполняет bulk_write, остальные ждут его завершения.
+bulk_write выполняется с verbose_results, поэтому каждая запись получает свой результат
+(InsertOneResult, UpdateResult, DeleteResult) или свою ошибку. Пакет неупорядоченный: записи
+пакета пришли одновременно, и ошибка одной не отменяет остальные. Клиентский bulk_write
+поддерживается начиная с MongoDB 8.0, на более старом сервере записи выполняются по одной """
+import contextvars
+import threading
+import time
+
+import pymongo
+from pymongo.errors import (ClientBulkWriteException, DuplicateKeyError, OperationFailure,
+                            PyMongoError, WriteConcernError, WriteError)
+
+import deadline
+import metrics
+
+
+# wire version MongoDB 8.0, с которой сервер поддерживает команду bulkWrite
+bulk_write_wire_version = 25
+
+
+class PendingWrite:
+    def __init__(self, model):
+        self.model = model
+        # дедлайн запроса: bulk_write ограничивается самым поздним дедлайном записей пакета
+        self.deadline = deadline.current_deadline.get()
+        self.result = None
+        self.error = None
+
+
+class Batch:
+    def __init__(self, collection):
+        self.collection = collection
+        self.writes = []
+        self.full = threading.Event()
+        self.done = threading.Event()
+
+
+class WriteCoalescer:
+    def __init__(self, client, service, window, max_ops):
+        self.client = client
+        self.service = service
+        self.window = window
+        self.max_ops = max_ops
+        self.batches = 0
+        self.writes = 0
+        self.errors = 0
+        self._supported = None
+        self._lock = threading.Lock()
+        # (коллекция, write concern) -> собираемый пакет
+        self._pending = {}
+
+    def accepts(self, collection):
+        """ Можно ли выполнить запись в collection через групповой bulk_write: включено окно,
+        сервер поддерживает bulkWrite и запись подтверждается (с w=0 нет результатов операций) """
+        if self.window <= 0 or not collection.write_concern.acknowledged:
+            return False
+        if self._supported is None:
+            try:
+                hello = self.client.admin.command('hello')
+            except PyMongoError:
+                return False
+            self._supported = hello.get('maxWireVersion', 0) >= bulk_write_wire_version
+        return self._supported
+
+    def write(self, collection, operation, *args, **kwargs):
+        """ Выполнить operation(*args, **kwargs) (InsertOne, UpdateOne, DeleteMany) в общем пакете
+        коллекции; возвращает результат операции или бросает её ошибку """
+        key = (collection.full_name, tuple(sorted(collection.write_concern.document.items())))
+        pending = PendingWrite(operation(*args, namespace=collection.full_name, **kwargs))
+        with self._lock:
+            batch = self._pending.get(key)
+            leader = batch is None
+            if leader:
+                batch = self._pending[key] = Batch(collection)
+            batch.writes.append(pending)
+            if len(batch.writes) >= self.max_ops:
+                del self._pending[key]
+                batch.full.set()
+
+        if leader:
+            batch.full.wait(self.window)
+            with self._lock:
+                if self._pending.get(key) is batch:
+                    del self._pending[key]
+            # пустой контекст: pymongo.timeout запроса первой записи не ограничивает весь пакет
+            contextvars.Context().run(self.flush, batch)
+        else:
+            batch.done.wait()
+
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def flush(self, batch):
+        """ Один bulk_write для всех записей пакета; результат или ошибка - в каждой записи """
+        try:
+            deadlines = [write.deadline for write in batch.writes]
+            timeout = None if None in deadlines else max(deadlines) - time.monotonic()
+            if timeout is not None and timeout <= 0:
+                raise deadline.DeadlineExceeded("deadline exceeded")
+            with pymongo.timeout(timeout):
+                result = self.client.bulk_write([write.model for write in batch.writes],
+                                                ordered=False, verbose_results=True,
+                                                write_concern=batch.collection.write_concern)
+            self.assign(batch, result)
+        except ClientBulkWriteException as e:
+            self.assign(batch, e.partial_result, e.write_errors, e.write_concern_errors, e.error)
+        except (PyMongoError, deadline.DeadlineExceeded) as e:
+            for write in batch.writes:
+                write.error = e
+        finally:
+            with self._lock:
+                self.batches += 1
+                self.writes += len(batch.writes)
+                self.errors += sum(write.error is not None for write in batch.writes)
+            metrics.observe_write_batch(self.service, batch.collection.full_name,
+                                        len(batch.writes))
+            batch.done.set()
+
+    def assign(self, batch, result, write_errors=(), write_concern_errors=(), error=None):
+        """ Разложить результат bulk_write по записям пакета """
+        results = {}
+        if result is not None:
+            results.update(result.insert_results)
+            results.update(result.update_results)
+            results.update(result.delete_results)
+        errors = {elem['idx']: elem for elem in write_errors or ()}
+        # записи выполнены, но не подтверждены так, как требует write concern
+        concern = write_concern_errors[0] if write_concern_errors else None
+
+        for index, write in enumerate(batch.writes):
+            if index in errors:
+                elem = errors[index]
+                error_class = DuplicateKeyError if elem.get('code') == 11000 else WriteError
+                write.error = error_class(elem.get('errmsg'), elem.get('code'), elem)
+            elif index in results:
+                write.result = results[index]
+                if concern is not None:
+                    write.error = WriteConcernError(concern.get('errmsg'), concern.get('code'),
+                                                    concern)
+                    # как у ClientBulkWriteException: результат выполненной операции
+                    write.error.partial_result = write.result
+            else:
+                # bulk_write прервался до этой операции
+                write.error = error if isinstance(error, Exception) else \
+                    OperationFailure("write was not executed")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "window": self.window,
+                "max_ops": self.max_ops,
+                "supported": self._supported,
+                "batches": self.batches,
+                "writes": self.writes,
+                "errors": self.errors,
+                "average_batch": self.writes / self.batches if self.batches else 0
+            }
@@ -0,0 +1,20 @@
+""" Режим монолита: api, auth, shoplist и database работают в одном процессе.
+Запросы между сервисами не уходят в сеть, а вызывают обработчики соседнего приложения напрямую
+(common/local_transport.py), поэтому ответы и статусы те же, что и в распределённом режиме.
+Наружу доступен только шлюз: gunicorn -c /common/gunicorn_conf.py monolith:app """
+import api
+import auth
+import database
+import shoplist
+import service_client
+
+
+def mount_local_upstreams():
+    service_client.get_client('auth', api.auth_url).mount_local(auth.app)
+    service_client.get_client('shoplist', api.shoplist_url).mount_local(shoplist.app)
+    # один клиент 'database' общий для auth и shoplist
+    service_client.get_client('database', shoplist.database_url).mount_local(database.app)
+
+
+mount_local_upstreams()
+app = api.app
@@ -1,46 +1,92 @@
-import functools
-from flask import Flask, jsonify, request, make_response
-import requests, json
+import contextlib
+from flask import Flask, Response, jsonify, request, make_response
+import json
+import os
+import time
+import redis as __redis
+
+import deadline
+import live_events
+import logs
+import metrics
+import tracing
+import service_client
+import validation
+from health import register_health, upstream_check
+from shoplist_cache import ShoplistCache
+from validation import check_params, request_params
 
 database = 'organizer'
 collection = 'shoplist'
+# версия списка пользователя: {"user", "version", "next", "done", "stable", "reserved_at"},
+# см. list_change
+versions_collection = 'shoplist_versions'
+# записи об удалённых элементах {"user", "name", "shop", "version"} для синхронизации изменений
+tombstones_collection = 'shoplist_tombstones'
+# записи об удалении хранятся для последних TOMBSTONE_RETENTION версий списка; клиент с более
+# старой версией получает 410 и загружает список целиком
+tombstone_retention = int(os.environ.get('TOMBSTONE_RETENTION', 1000))
+# раз в сколько версий удалять устаревшие записи об удалении
+compact_every = 100
+# через сколько секунд незавершённое изменение списка считается прерванным (процесс сервиса
+# завершился посреди изменения); должно быть больше времени любого изменения
+list_change_timeout = float(os.environ.get('LIST_CHANGE_TIMEOUT', 60))
 database_url = 'http://database:5000'
 default_database_params = {"database": database, "collection": collection}
 json_headers = {'content-type': 'application/json'}
+# максимальное количество операций в одном запросе /batch
+max_batch_size = 500
+# read preference MongoDB для чтения списков и сводки (например, secondaryPreferred), по умолчанию
+# primary для списков и настройки сервиса БД для сводки. Версия списка, изменения для
+# синхронизации и поиск элементов перед изменением всегда читаются с primary явно, независимо
+# от MONGO_COLLECTION_SETTINGS сервиса БД: член replica set может отставать от неё, поэтому
+# список, прочитанный не с primary, не кэшируется и отдаётся без ETag
+list_read_preference = os.environ.get('SHOPLIST_READ_PREFERENCE', 'primary')
+list_read_options = {"read_preference": list_read_preference} \
+    if list_read_preference != 'primary' else {}
+primary_read_options = {"read_preference": "primary"}
+# write concern изменений списка: элементы и версия подтверждаются большинством членов
+# replica set, иначе после смены primary версия могла бы остаться без откаченных изменений
+list_write_concern = os.environ.get('SHOPLIST_WRITE_CONCERN', 'majority')
+change_write_options = {"write_concern": int(list_write_concern)
+                        if list_write_concern.isdigit() else list_write_concern}
+# удаление устаревших записей об удалении не ждёт подтверждения большинства членов replica set
+compact_write_concern = {"w": 1}
+database_client = service_client.get_client('database', database_url)
 
 app = Flask(__name__)
-app.debug = True
+logs.setup_logging(app, 'shoplist')
+metrics.setup_metrics(app, 'shoplist')
+tracing.setup_tracing(app, 'shoplist')
+validation.setup_json(app)
+deadline.setup_deadline(app)
+service_client.register_breakers(app)
+register_health(app, {"database": upstream_check(database_client)})
+redis = metrics.instrument_redis(__redis.Redis(host='redis', port=6379, db=1), 'shoplist')
+# SHOPLIST_CACHE_TTL=0 отключает кэш списков
+shoplist_cache = ShoplistCache(redis, 'shoplist',
+                               ttl=int(os.environ.get('SHOPLIST_CACHE_TTL', 300)),
+                               max_bytes=int(os.environ.get('SHOPLIST_CACHE_MAX_BYTES',
+                                                            64 * 1024 * 1024)))
+
+
+class ListBusy(Exception):
+    pass
+
+
+class BatchFailed(Exception):
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
 
 
 def error(message, code):
     return make_response(jsonify({"error": message}), code)
 
 
-def check_params(params_get=None, params_post=None, params_delete=None, params_put=None):
-    def __check_params(func):
-        @functools.wraps(func)
-        def check_params_inner(*args, **kwargs):
-            if request.method == 'GET':
-                for param in params_get:
-                    if not param in request.args:
-                        return error("incorrect GET input", 400)
-            if request.method == 'POST':
-                for param in params_post:
-                    if not param in request.get_json().keys():
-                        return error("incorrect POST input", 400)
-            if request.method == 'DELETE':
-                for param in params_delete:
-                    if not param in request.get_json().keys():
-                        return error("incorrect DELETE input", 400)
-            if request.method == 'PUT':
-                for param in params_put:
-                    if not param in request.get_json().keys():
-                        return error("incorrect PUT input", 400)
-            return func(*args, **kwargs)
-
-        return check_params_inner
-
-    return __check_params
+@app.errorhandler(ListBusy)
+def list_busy(e):
+    return error(str(e) or "list is busy", 503)
 
 
 @app.route('/', methods=['GET', 'POST', 'DELETE'])
@@ -50,136 +96,508 @@ def check_params(params_get=None, params_post=None, params_delete=None, params_p
 def shoplist():
     if request.method == 'GET':
         user = request.args['user']
-        app.logger.info(f"GET / params: {request.args}")
-        return get_items_by_user(user)
+        app.logger.info("GET / params: %s", request.args)
+        if 'since' in request.args:
+            try:
+                since = int(request.args['since'])
+            except ValueError:
+                return error("incorrect since", 400)
+            return get_changes(user, since)
+        return get_items_by_user(user, request.if_none_match)
 
     if request.method == 'POST':
-        user = request.get_json()['user']
-        name = request.get_json()['name']
-        shop = request.get_json()['shop']
-
-        amount = 1
-        if 'amount' in request.get_json():
-            amount = request.get_json()['amount']
-        app.logger.info(f"POST / params: " + str(request.get_json()))
-        r = add_item(user, name, amount, shop)
-        if r.status_code == 201:
+        body = request_params()
+        user, name, shop = body['user'], body['name'], body['shop']
+        amount = body.get('amount', 1)
+        app.logger.info("POST / params: %s", body)
+        with list_change(user, [{"op": "add", "name": name, "shop": shop}]) as version:
+            r = add_item(user, name, amount, shop, version)
+        if r.status_code in (200, 201):
             return r.json()
         else:
             return error("item not created", r.status_code)
 
     if request.method == 'DELETE':
-        user = request.get_json()['user']
-        name = request.get_json()['name']
-        shop = request.get_json()['shop']
-        app.logger.info("DELETE / params: " + str(request.get_json()))
-        r = database_request({"name": name, "user": user, "shop": shop}, 'DELETE')
+        body = request_params()
+        user, name, shop = body['user'], body['name'], body['shop']
+        app.logger.info("DELETE / params: %s", body)
+        ops = [{"op": "delete", "name": name, "shop": shop}]
+        with list_change(user, ops) as version:
+            r = delete_item(user, name, shop, version)
+            if r.status_code == 201 and not r.json().get('deleted'):
+                ops.clear()
+        if not ops:
+            return error("item not found", 404)
         return r.json()
 
+# POST: curl --header "Content-Type: application/json" --request POST --data '{ "user": "zaqwer101", "operations": [{"op": "add", "name": "milk"}, {"op": "bought", "name": "milk", "bought": "true"}]}' http://127.0.0.1:5003/batch
+@app.route('/batch', methods=['POST'])
+@check_params(params_post={'user': str, 'operations': list})
+def batch():
+    """ Несколько операций add/delete/bought одним bulk-запросом к БД """
+    body = request_params()
+    user = body['user']
+    operations = body['operations']
+    ordered = bool(body.get('ordered', True))
+    if len(operations) == 0:
+        return error("empty operations", 400)
+    if len(operations) > max_batch_size:
+        return error(f"too many operations, max {max_batch_size}", 400)
+    app.logger.info("POST /batch: %d operations for %s", len(operations), user)
+
+    # для bought нужно знать, существует ли элемент: один запрос только по нужным именам
+    existing = None
+    names = [op['name'] for op in operations
+             if isinstance(op, dict) and op.get('op') == 'bought' and 'name' in op]
+    if names:
+        existing = find_existing(user, names)
+
+    results = [None] * len(operations)
+    events = []
+    try:
+        with list_change(user, events) as version:
+            bulk, bulk_indexes = [], []
+            for index, op in enumerate(operations):
+                try:
+                    bulk.append(batch_operation(user, op, existing, version))
+                    bulk_indexes.append(index)
+                except ValueError as e:
+                    results[index] = {"index": index, "status": "error", "error": str(e)}
+                    if ordered:
+                        # как и в ordered bulk_write, операции после ошибки не выполняются
+                        for skipped in range(index + 1, len(operations)):
+                            results[skipped] = {"index": skipped, "status": "skipped"}
+                        break
+
+            if bulk:
+                body = bulk_request(bulk, ordered)
+                tombstones = []
+                for index, operation, result in zip(bulk_indexes, bulk, body['results']):
+                    results[index] = {"index": index, "status": result['status']}
+                    if 'error' in result:
+                        results[index]['error'] = result['error']
+                        continue
+                    if result['status'] != 'success':
+                        continue
+                    query = operation['query']
+                    event = {"op": operations[index]['op'], "name": query['name'],
+                             "shop": query['shop']}
+                    if event['op'] == 'bought':
+                        event['bought'] = operations[index]['bought']
+                    events.append(event)
+                    if operation['op'] == 'delete':
+                        tombstones.append(tombstone_operation(query, version))
+                if tombstones:
+                    database_request({"operations": tombstones, "ordered": False}, 'BULK',
+                                     tombstones_collection, options=change_write_options)
+    except BatchFailed as e:
+        return error(str(e), e.status)
+
+    failed = any(result['status'] != 'success' for result in results)
+    return jsonify({"status": "error" if failed else "success", "results": results})
+
+
+def bulk_request(bulk, ordered):
+    """ Ответ /bulk сервиса БД с результатами операций; BatchFailed, если результатов нет.
+    Исключение выходит из list_change: изменение, результат которого неизвестен, поднимает
+    версию списка, но событие с пустым списком операций не отправляется """
+    r = database_request({"operations": bulk, "ordered": ordered}, 'BULK',
+                         options=change_write_options)
+    body = None
+    if r.headers.get('Content-Type', '').startswith('application/json'):
+        try:
+            body = r.json()
+        except ValueError:
+            pass
+    if r.status_code in (200, 400) and isinstance(body, dict) and 'results' in body:
+        return body
+    message = body.get('error', 'batch failed') if isinstance(body, dict) else 'batch failed'
+    raise BatchFailed(message, r.status_code if r.status_code >= 400 else 502)
+
+
+def batch_operation(user, op, existing, version):
+    """ Операция /bulk сервиса БД для элемента batch; existing - множество (name, shop) или None """
+    if not isinstance(op, dict) or 'name' not in op:
+        raise ValueError("incorrect operation")
+    name = op['name']
+
+    if op.get('op') == 'add':
+        shop = op.get('shop', '')
+        if existing is not None:
+            existing.add((name, shop))
+        return {"op": "update", "query": {"user": user, "name": name, "shop": shop},
+                "update": {"$inc": {"amount": op.get('amount', 1)},
+                           "$set": {"version": version},
+                           "$setOnInsert": {"bought": "false"}},
+                "upsert": True}
+
+    if op.get('op') == 'delete':
+        if 'shop' not in op:
+            raise ValueError("incorrect DELETE input")
+        if existing is not None:
+            existing.discard((name, op['shop']))
+        return {"op": "delete", "query": {"user": user, "name": name, "shop": op['shop']}}
+
+    if op.get('op') == 'bought':
+        if 'bought' not in op:
+            raise ValueError("incorrect bought input")
+        shop = op.get('shop', '')
+        if existing is not None and (name, shop) not in existing:
+            raise ValueError("item not found")
+        return {"op": "update", "query": {"user": user, "name": name, "shop": shop},
+                "update": {"$set": {"bought": op['bought'], "version": version}}}
+
+    raise ValueError("incorrect operation")
+
+
+def tombstone_operation(query, version):
+    """ Операция /bulk: запись об удалении элемента query с версией version """
+    return {"op": "update", "query": query, "update": {"$set": {"version": version}},
+            "upsert": True}
+
+
+# GET: curl "http://127.0.0.1:5003/summary?user=zaqwer101"
+@app.route('/summary', methods=['GET'])
+@check_params(params_get=['user'])
+def summary():
+    """ Количество элементов, сумма amount и количество некупленных по каждому магазину;
+    считается в MongoDB, сами элементы не передаются """
+    user = request.args['user']
+    pipeline = [
+        {"$match": {"user": user}},
+        {"$group": {"_id": "$shop",
+                    "items": {"$sum": 1},
+                    "amount": {"$sum": "$amount"},
+                    "unbought": {"$sum": {"$cond": [{"$eq": ["$bought", "true"]}, 0, 1]}}}},
+        {"$sort": {"_id": 1}}
+    ]
+    r = database_request({"pipeline": pipeline}, 'QUERY', options=list_read_options)
+    if r.status_code != 200:
+        return error("incorrect params", 400)
+    shops = [{"shop": elem['_id'], "items": elem['items'], "amount": elem['amount'],
+              "unbought": elem['unbought']} for elem in r.json()['result']]
+    return jsonify({"shops": shops,
+                    "items": sum(shop['items'] for shop in shops),
+                    "unbought": sum(shop['unbought'] for shop in shops)})
+
+
+@app.route('/info', methods=['GET'])
+def get_service_info():
+    return jsonify({"upstreams": service_client.stats(), "cache": shoplist_cache.stats()})
+
+
 @app.route('/bought', methods=['POST'])
 @check_params(params_post=['user', 'name', 'bought', 'shop'])
 def set_bought():
-    user = request.json['user']
-    name = request.json['name']
-    bought = request.json['bought']
-    shop = request.json['shop']
+    body = request_params()
+    user, name, bought, shop = body['user'], body['name'], body['bought'], body['shop']
 
-    if change_bought(user, name, shop, bought):
+    ops = [{"op": "bought", "name": name, "shop": shop, "bought": bought}]
+    with list_change(user, ops) as version:
+        if not change_bought(user, name, shop, bought, version):
+            ops.clear()
+    if ops:
         return jsonify({"status": "success"})
     else:
         return error("item not found", 404)
 
 
-def add_item(user, name, amount, shop):
-    item = get_item_by_name(user, name, shop)
-    if item:  # значит такой элемент уже есть в БД
-        app.logger.info(f'Item "{name}" found in database')
-        data = {}
-        data['query'] = {"user": user, "name": name, "shop": shop}
-        data['data'] = {"amount": item["amount"] + amount}
-        r = database_request(data, 'PUT')
-    else:  # значит нужно добавить новый элемент
-        app.logger.info(f'Add new item "{name}" to database')
-        r = database_request({"user": user, "name": name, "amount": amount, "bought": "false", "shop": shop}, 'POST')
-    return r
+def add_item(user, name, amount, shop, version):
+    """ Добавить элемент или увеличить amount существующего одним атомарным запросом """
+    app.logger.info('Add item "%s" to database', name)
+    data = {}
+    data['query'] = {"user": user, "name": name, "shop": shop}
+    data['update'] = {"$inc": {"amount": amount},
+                      "$set": {"version": version},
+                      "$setOnInsert": {"bought": "false"}}
+    data['upsert'] = True
+    return database_request(data, 'PUT', options=change_write_options)
 
 
-def change_bought(user, name, shop, bought):
-    item = get_item_by_name(user, name, shop)
-    if item:
-        if item['bought'] == bought:
-            return True
-        data = {}
-        data['query'] = {"user": user, "name": name, "shop": shop}
-        data['data'] = {"bought": bought}
-        r = database_request(data, 'PUT')
-        return True
-    else:
-        return False
+def change_bought(user, name, shop, bought, version):
+    data = {}
+    data['query'] = {"user": user, "name": name, "shop": shop}
+    data['update'] = {"$set": {"bought": bought, "version": version}}
+    r = database_request(data, 'PUT', options=change_write_options)
+    return r.status_code == 200
+
+
+def delete_item(user, name, shop, version):
+    """ Удалить элемент и оставить запись об удалении для синхронизации изменений """
+    query = {"user": user, "name": name, "shop": shop}
+    r = database_request(query, 'DELETE', options=change_write_options)
+    if r.status_code == 201 and r.json().get('deleted'):
+        database_request({"query": query, "update": {"$set": {"version": version}},
+                          "upsert": True}, 'PUT', tombstones_collection,
+                         options=change_write_options)
+    return r
 
 
 def get_item_by_name(user, name, shop):
     """ Найти элемент пользователя с такими параметрами """
-    data = {"user": user, "name": name, "shop": shop}
-    app.logger.info(f'get_item_by_name(): Item to found: {data}')
-    r = database_request(data, 'GET')
-    app.logger.info(f'get_item_by_name(): DB GET response: {r.json()}')
-    if r.status_code == 400:
-        error("incorrect params", 400)
-    if r.status_code == 404:
+    data = {"filter": {"user": user, "name": name, "shop": shop}, "limit": 1}
+    app.logger.debug('get_item_by_name(): Item to found: %s', data)
+    r = database_request(data, 'QUERY', options=primary_read_options)
+    app.logger.debug('get_item_by_name(): DB QUERY status: %s', r.status_code)
+    if r.status_code != 200 or not r.json()['result']:
         return None
-    item = r.json()[0]
-    return item
+    return r.json()['result'][0]
+
+
+def find_existing(user, names):
+    """ Множество (name, shop) элементов пользователя с указанными именами; читаются только эти поля """
+    data = {"filter": {"user": user, "name": {"$in": names}},
+            "projection": {"_id": 0, "name": 1, "shop": 1}}
+    r = database_request(data, 'QUERY', options=primary_read_options)
+    if r.status_code != 200:
+        return set()
+    return {(item['name'], item['shop']) for item in r.json()['result']}
 
 
 def get_item_by_id(user, id):
     """ Найти элемент по его ID """
     data = {"user": user, "_id": id}
-    app.logger.info(f'get_item_by_id(): Item to found: {data}')
-    r = database_request(data, 'GET')
-    app.logger.info(f'get_item_by_id(): DB GET response: {r.json()}')
+    app.logger.debug('get_item_by_id(): Item to found: %s', data)
+    r = database_request(data, 'GET', options=primary_read_options)
+    app.logger.debug('get_item_by_id(): DB GET status: %s', r.status_code)
 
 
-def get_items_by_user(user):
-    """ Получить список всех элементов пользователя """
-    r = database_request({"user": user}, 'GET')
-    app.logger.info(r.json())
-    app.logger.info(r.status_code)
+def get_version(user):
+    """ (версия, settled) списка пользователя или (None, None) при ошибке БД.
+    settled - ни одно изменение списка не выполняется: элементы совпадают с версией, список можно
+    кэшировать и отдавать с ETag. Пока изменения выполняются, возвращается версия, до которой
+    включительно все изменения уже записаны (см. list_change) """
+    r = database_request({"user": user}, 'GET', versions_collection, options=primary_read_options)
     if r.status_code == 404:
-        return jsonify([])
-    if r.status_code == 400:
+        return 0, True
+    if r.status_code != 200:
+        return None, None
+    versions = r.json()[0]
+    version = versions.get('version', 0)
+    if versions.get('done', 0) >= versions.get('next', 0) or \
+            time.time() - versions.get('reserved_at', 0) > list_change_timeout:
+        return version, True
+    return min(version, versions.get('stable', 0)), False
+
+
+class Reservation:
+    """ Номер изменения списка, полученный reserve_version """
+
+    def __init__(self, version, quiet, lost):
+        self.version = version
+        # до этого изменения все предыдущие уже завершились
+        self.quiet = quiet
+        # количество прерванных изменений, которые засчитываются завершёнными вместе с этим
+        self.lost = lost
+
+
+def reserve_version(user):
+    """ Следующий номер изменения списка: атомарный $inc в shoplist_versions """
+    now = time.time()
+    r = database_request({"query": {"user": user},
+                          "update": {"$inc": {"next": 1}, "$set": {"reserved_at": now}},
+                          "upsert": True, "return_document": "before"}, 'PUT',
+                         versions_collection, options=change_write_options)
+    if r is None or r.status_code not in (200, 201):
+        raise ListBusy("list version is unavailable")
+    before = r.json()['document'] or {}
+    reserved, done = before.get('next', 0), before.get('done', 0)
+    # последнее изменение до этого начато раньше list_change_timeout и не завершено:
+    # все незавершённые изменения прерваны
+    stale = done < reserved and now - before.get('reserved_at', now) > list_change_timeout
+    return Reservation(reserved + 1, done == reserved or stale, reserved - done if stale else 0)
+
+
+def complete_version(user, reservation, applied):
+    """ Завершить изменение: засчитать его в done и, если список изменён (applied), поднять версию """
+    version = reservation.version
+    update = {"$inc": {"done": 1 + reservation.lost}, "$max": {}}
+    if applied:
+        update['$max']['version'] = version
+    if reservation.quiet:
+        update['$max']['stable'] = version
+    if not update['$max']:
+        del update['$max']
+    r = database_request({"query": {"user": user}, "update": update}, 'PUT',
+                         versions_collection, options=change_write_options)
+    if r is None or r.status_code not in (200, 202):
+        app.logger.error('list version %s of %s not saved: %s', version, user,
+                         r.status_code if r is not None else None)
+        raise ListBusy("list version is not saved")
+
+
+@contextlib.contextmanager
+def list_change(user, ops):
+    """ Изменение списка пользователя: with list_change(user, ops) as version.
+    Изменения одного пользователя выполняются параллельно, без блокировки: каждое получает номер
+    атомарным $inc счётчика next в shoplist_versions, помечает им изменённые элементы и после
+    изменения увеличивает счётчик завершённых done и version ($max).
+    Пока done < next, читатели получают версию stable - номер последнего изменения, до начала
+    которого все предыдущие уже завершились, поэтому ответ с версией N содержит все изменения
+    до N включительно. Изменение, не завершённое за list_change_timeout, считается прерванным.
+    После завершения подписчикам списка уходит событие с версией и операциями ops
+    (список можно дополнять и очищать внутри блока). Если к концу блока ops пуст (ничего не найдено),
+    версия списка не меняется, кэш не сбрасывается и событие не отправляется; блок, завершившийся
+    исключением, считается изменившим список.
+    Дедлайн запроса учитывается только до получения номера: начатое изменение доводится до конца,
+    чтобы оно было засчитано. Если номер получить или засчитать не удалось - ошибка 503 """
+    deadline.check()
+    with deadline.suspended():
+        reservation = reserve_version(user)
+        version = reservation.version
+        applied = True
+        try:
+            yield version
+            applied = bool(ops)
+        finally:
+            try:
+                complete_version(user, reservation, applied)
+            finally:
+                if applied:
+                    shoplist_cache.invalidate(user)
+        if not applied:
+            return
+        live_events.publish(redis, user, {"type": "change", "version": version, "ops": ops})
+        if version % compact_every == 0:
+            compact_tombstones(user, version)
+
+
+def compact_tombstones(user, version):
+    """ Удалить записи об удалении, которые не нужны ни одному допустимому since """
+    horizon = version - tombstone_retention
+    if horizon > 0:
+        database_request({"user": user, "version": {"$lte": horizon}}, 'DELETE',
+                         tombstones_collection, options={"write_concern": compact_write_concern})
+
+
+def get_changes(user, since):
+    """ Изменения списка после версии since: созданные и изменённые элементы в "items",
+    удалённые в "deleted". Версия читается до изменений, поэтому ни одно изменение до неё не теряется """
+    version, settled = get_version(user)
+    if version is None:
         return error("incorrect params", 400)
-    return jsonify(r.json())
+    if not settled:
+        # клиент мог узнать о версии из события раньше, чем завершились предыдущие изменения
+        since = min(since, version)
+    if since > version or since < version - tombstone_retention:
+        return error("unknown version, reload the list", 410)
+
+    changes = {"version": version, "items": [], "deleted": []}
+    if since < version:
+        items = database_request({"user": user, "since": since}, 'CHANGES',
+                                 options=primary_read_options)
+        deleted = database_request({"user": user, "since": since}, 'CHANGES', tombstones_collection,
+                                   options=primary_read_options)
+        if items.status_code != 200 or deleted.status_code != 200:
+            return error("incorrect params", 400)
+        changes['items'] = items.json()
+        changes['deleted'] = [{"name": elem['name'], "shop": elem['shop'], "version": elem['version']}
+                              for elem in deleted.json()]
+    return jsonify(changes)
 
 
-def database_request(params, request_method):
-    """ Сделать запрос к сервису БД """
-    app.logger.info(params)
+def load_items(user, if_none_match=None):
+    """ (версия, сериализованный список) из кэша или из БД; (None, None) при ошибке запроса к БД.
+    Если версия совпала с If-None-Match, элементы из БД не читаются и вместо списка возвращается None.
+    Список, прочитанный не с primary или во время изменения, возвращается без версии """
+    if list_read_options:
+        return None, read_items(user)
+
+    entry, generation = shoplist_cache.get(user)
+    if entry is not None:
+        version, data = entry.split(b'\n', 1)
+        return int(version), data
+
+    version, settled = get_version(user)
+    if version is None:
+        return None, None
+    if not settled:
+        # список меняется: элементы могут быть новее версии
+        return None, read_items(user)
+    if if_none_match is not None and if_none_match.contains(str(version)):
+        return version, None
+
+    data = read_items(user)
+    if data is None:
+        return None, None
+    # в кэше версия хранится первой строкой перед списком
+    shoplist_cache.put(user, str(version).encode() + b'\n' + data, generation)
+    return version, data
+
+
+def read_items(user):
+    """ Сериализованный список элементов пользователя из БД или None при ошибке запроса """
+    r = database_request({"user": user}, 'GET', options=list_read_options or primary_read_options)
+    app.logger.debug('read_items(): DB GET status: %s', r.status_code)
+    if r.status_code == 404:
+        return b'[]'
+    if r.status_code == 200:
+        # список уже сериализован сервисом БД, повторно он не разбирается
+        return r.content
+    return None
+
+
+def get_items_by_user(user, if_none_match=None):
+    """ Получить список всех элементов пользователя; ETag - версия списка """
+    version, data = load_items(user, if_none_match)
+    if data is not None and version is None:
+        return Response(data, mimetype='application/json')
+    if version is None:
+        return error("incorrect params", 400)
+    if if_none_match is not None and if_none_match.contains(str(version)):
+        response = Response(status=304)
+    else:
+        response = Response(data, mimetype='application/json')
+    response.set_etag(str(version))
+    return response
+
+
+def database_request(params, request_method, collection_name=collection, options=None):
+    """ Сделать запрос к сервису БД; options - read_preference и write_concern запроса """
+    app.logger.debug('database_request(%s): %s', request_method, params)
+    options = options or {}
     if request_method == 'POST':
         data = [params]
-        query = {"database": database, "collection": collection, "data": data}
-        app.logger.info(query)
-        r = requests.post(database_url, json=query, headers=json_headers)
+        query = {"database": database, "collection": collection_name, "data": data, **options}
+        r = database_client.post(json=query, headers=json_headers)
 
     if request_method == 'GET':
         if not 'database' in params:
             params['database'] = database
         if not 'collection' in params:
-            params['collection'] = collection
-        r = requests.get(database_url, params=params, headers=json_headers)
+            params['collection'] = collection_name
+        r = database_client.get(params={**params, **options}, headers=json_headers)
+
+    if request_method == 'QUERY':
+        r = database_client.post('/query', json={"database": database,
+                                                 "collection": collection_name, **params,
+                                                 **options})
+
+    if request_method == 'CHANGES':
+        r = database_client.get('/changes', params={"database": database,
+                                                    "collection": collection_name, **params,
+                                                    **options})
 
     if request_method == 'PUT':
-        if not 'query' in params or not 'data' in params:
+        if not 'query' in params or not ('data' in params or 'update' in params):
             app.logger.error("data or query param for PUT request is empty")
             return None
-        r = requests.put(database_url, json={"database": database,
-                                             "collection": collection,
-                                             "query": params['query'],
-                                             "data": params['data']})
+        data = {"database": database, "collection": collection_name, "query": params['query']}
+        for key in ('data', 'update', 'upsert', 'return_document'):
+            if key in params:
+                data[key] = params[key]
+        r = database_client.put(json={**data, **options})
+
+    if request_method == 'BULK':
+        r = database_client.post('/bulk', json={"database": database,
+                                                "collection": collection_name,
+                                                "operations": params['operations'],
+                                                "ordered": params.get('ordered', True),
+                                                **options})
 
     if request_method == 'DELETE':
         data = [params]
-        r = requests.delete(database_url, json={"database": database,
-                                                "collection": collection,
-                                                "data": data})
+        r = database_client.delete(json={"database": database,
+                                         "collection": collection_name,
+                                         "data": data, **options})
     return r
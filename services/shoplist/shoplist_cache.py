@@ -0,0 +1,151 @@
+import threading
+import time
+
+from redis import RedisError
+
+import metrics
+
+
+# KEYS[1] - запись кэша, KEYS[2] - поколение кэша пользователя, KEYS[3] - индекс записей
+# (sorted set: ключ -> время истечения), KEYS[4] - размеры записей (hash), KEYS[5] - общий размер
+# ARGV: данные, ttl, текущее время, лимит памяти в байтах, поколение на момент чтения из БД
+# возвращает количество вытесненных записей или -1, если список изменился после чтения
+put_script = """
+if (redis.call('GET', KEYS[2]) or '0') ~= ARGV[5] then
+    return -1
+end
+local expired = redis.call('ZRANGEBYSCORE', KEYS[3], '-inf', ARGV[3])
+for _, key in ipairs(expired) do
+    redis.call('DECRBY', KEYS[5], redis.call('HGET', KEYS[4], key) or 0)
+    redis.call('HDEL', KEYS[4], key)
+end
+redis.call('ZREMRANGEBYSCORE', KEYS[3], '-inf', ARGV[3])
+
+local size = string.len(ARGV[1])
+local old = tonumber(redis.call('HGET', KEYS[4], KEYS[1]) or 0)
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+redis.call('ZADD', KEYS[3], tonumber(ARGV[3]) + tonumber(ARGV[2]), KEYS[1])
+redis.call('HSET', KEYS[4], KEYS[1], size)
+local total = redis.call('INCRBY', KEYS[5], size - old)
+
+local evicted = 0
+while total > tonumber(ARGV[4]) do
+    local oldest = redis.call('ZRANGE', KEYS[3], 0, 0)[1]
+    if not oldest then
+        break
+    end
+    total = redis.call('DECRBY', KEYS[5], redis.call('HGET', KEYS[4], oldest) or 0)
+    redis.call('DEL', oldest)
+    redis.call('HDEL', KEYS[4], oldest)
+    redis.call('ZREM', KEYS[3], oldest)
+    evicted = evicted + 1
+end
+return evicted
+"""
+# KEYS как у put_script; увеличивает поколение и удаляет запись
+invalidate_script = """
+local generation = redis.call('INCR', KEYS[2])
+local size = redis.call('HGET', KEYS[4], KEYS[1])
+if size then
+    redis.call('DECRBY', KEYS[5], size)
+    redis.call('HDEL', KEYS[4], KEYS[1])
+end
+redis.call('ZREM', KEYS[3], KEYS[1])
+redis.call('DEL', KEYS[1])
+return generation
+"""
+
+
+class ShoplistCache:
+    """ Кэш сериализованного списка покупок пользователя в Redis.
+    Запись живёт ttl секунд; при превышении max_bytes вытесняются самые старые записи.
+    Каждое изменение списка увеличивает поколение пользователя и удаляет запись, а запись
+    сохраняется, только если поколение не изменилось с момента чтения из БД: параллельное
+    чтение не может вернуть в кэш устаревший список """
+
+    def __init__(self, redis, service, ttl=300, max_bytes=64 * 1024 * 1024, prefix='shoplist'):
+        self.redis = redis
+        self.service = service
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.prefix = prefix
+        self.index_key = f'{prefix}:cache:index'
+        self.sizes_key = f'{prefix}:cache:sizes'
+        self.total_key = f'{prefix}:cache:bytes'
+        self._put = redis.register_script(put_script)
+        self._invalidate = redis.register_script(invalidate_script)
+        self._counts = {"hit": 0, "miss": 0, "error": 0, "evicted": 0, "stale": 0, "too_large": 0}
+        self._lock = threading.Lock()
+
+    def key(self, user):
+        return f'{self.prefix}:cache:{user}'
+
+    def generation_key(self, user):
+        return f'{self.prefix}:generation:{user}'
+
+    def keys(self, user):
+        return [self.key(user), self.generation_key(user), self.index_key, self.sizes_key,
+                self.total_key]
+
+    def count(self, event, amount=1):
+        with self._lock:
+            self._counts[event] += amount
+        metrics.observe_cache(self.service, 'shoplist', event, amount)
+
+    def get(self, user):
+        """ (данные или None, поколение); поколение нужно передать в put после чтения из БД """
+        if self.ttl <= 0:
+            return None, None
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.get(self.key(user))
+            pipe.get(self.generation_key(user))
+            data, generation = pipe.execute()
+        except RedisError:
+            # кэш не должен мешать чтению: при недоступном Redis список читается из БД
+            self.count('error')
+            return None, None
+        self.count('hit' if data is not None else 'miss')
+        return data, (generation or b'0').decode()
+
+    def put(self, user, data, generation):
+        if self.ttl <= 0 or generation is None:
+            return
+        if len(data) > self.max_bytes:
+            self.count('too_large')
+            return
+        try:
+            evicted = self._put(keys=self.keys(user),
+                                args=[data, self.ttl, int(time.time()), self.max_bytes, generation])
+        except RedisError:
+            self.count('error')
+            return
+        if evicted < 0:
+            self.count('stale')
+        elif evicted:
+            self.count('evicted', evicted)
+
+    def invalidate(self, user):
+        """ Вызывается после каждого изменения списка пользователя """
+        try:
+            return self._invalidate(keys=self.keys(user))
+        except RedisError:
+            # запись устареет не позже, чем через ttl
+            self.count('error')
+            return None
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self._counts)
+        total = counts['hit'] + counts['miss']
+        try:
+            size = int(self.redis.get(self.total_key) or 0)
+        except RedisError:
+            size = None
+        return {
+            "ttl": self.ttl,
+            "max_bytes": self.max_bytes,
+            "bytes": size,
+            **counts,
+            "hit_ratio": counts['hit'] / total if total else 0.0
+        }
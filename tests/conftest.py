@@ -0,0 +1,21 @@
+""" Тесты, которые запускают код сервисов в процессе, без docker-compose: модули сервисов
+импортируются напрямую, Redis и MongoDB заменяются на fakeredis и mongomock (benchmarks/stack.py) """
+import os
+import sys
+
+import pytest
+
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+for name in ('common', 'api', 'auth', 'shoplist', 'database'):
+    path = os.path.join(root, 'services', name)
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+
+@pytest.fixture(scope='session')
+def stack():
+    """ Все сервисы в одном процессе: имя -> Flask-приложение """
+    sys.path.insert(0, os.path.join(root, 'benchmarks'))
+    from stack import build_stack
+    return build_stack()
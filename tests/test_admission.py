@@ -0,0 +1,158 @@
+""" Допуск запросов в шлюз: token bucket, перегрузка шлюза, лимиты маршрутов и RATE_LIMITS """
+import time
+
+import fakeredis
+import pytest
+from redis import ConnectionError
+
+import admission
+from admission import Admission, load_limits
+
+
+def make_admission(limits, max_in_flight=10, redis=None, lease=None):
+    redis = redis or fakeredis.FakeRedis(server=fakeredis.FakeServer())
+    return Admission(redis, 'test', limits=limits, max_in_flight=max_in_flight, lease=lease)
+
+
+def test_token_bucket():
+    gate = make_admission({"*": {"user": [1, 2]}})
+    assert gate.check_rate('GET /shoplist', 'user', 'u1').allowed
+    assert gate.check_rate('GET /shoplist', 'user', 'u1').allowed
+
+    decision = gate.check_rate('GET /shoplist', 'user', 'u1')
+    assert not decision.allowed
+    assert decision.status == 429
+    assert decision.reason == 'rate_user'
+    assert decision.headers() == {"Retry-After": "1"}
+    # корзины разных пользователей и маршрутов независимы
+    assert gate.check_rate('GET /shoplist', 'user', 'u2').allowed
+    assert gate.check_rate('POST /shoplist', 'user', 'u1').allowed
+    assert gate.stats()['shed'] == {"GET /shoplist": {"rate_user": 1}}
+
+
+def test_rate_not_limited_without_redis(monkeypatch):
+    gate = make_admission({"*": {"ip": [1, 1]}})
+
+    def unavailable(*args, **kwargs):
+        raise ConnectionError("redis is down")
+
+    monkeypatch.setattr(gate, '_bucket', unavailable)
+    assert gate.check_rate('GET /shoplist', 'ip', '10.0.0.1').allowed
+    assert gate.check_rate('GET /shoplist', 'ip', '10.0.0.1').allowed
+    assert gate.stats()['redis_errors'] == 2
+
+
+def test_overload():
+    gate = make_admission({}, max_in_flight=2)
+    assert gate.enter('GET /shoplist').allowed
+    second = gate.enter('POST /shoplist')
+    assert second.allowed
+
+    decision = gate.enter('GET /shoplist')
+    assert decision.status == 503
+    assert decision.reason == 'overload'
+    assert 'Retry-After' in decision.headers()
+
+    gate.leave('POST /shoplist', second)
+    assert gate.enter('GET /shoplist').allowed
+    assert gate.stats()['in_flight'] == 2
+
+
+def test_limit_shared_by_processes():
+    """ Предел общий для всех процессов шлюза: счётчик в Redis """
+    redis = fakeredis.FakeRedis(server=fakeredis.FakeServer())
+    first = make_admission({}, max_in_flight=2, redis=redis)
+    second = make_admission({}, max_in_flight=2, redis=redis)
+    entered = first.enter('GET /shoplist')
+    assert entered.allowed
+    assert second.enter('GET /shoplist').allowed
+    assert first.enter('GET /shoplist').reason == 'overload'
+    assert second.enter('GET /shoplist').reason == 'overload'
+
+    first.leave('GET /shoplist', entered)
+    assert second.enter('GET /shoplist').allowed
+
+
+def test_lease_expires():
+    """ Место процесса, который не освободил его (например, завершился), истекает через lease """
+    gate = make_admission({}, max_in_flight=1, lease=0.2)
+    assert gate.enter('GET /shoplist').allowed
+    assert not gate.enter('GET /shoplist').allowed
+    time.sleep(0.3)
+    assert gate.enter('GET /shoplist').allowed
+
+
+def test_concurrency_without_redis(monkeypatch):
+    gate = make_admission({}, max_in_flight=1)
+
+    def unavailable(*args, **kwargs):
+        raise ConnectionError("redis is down")
+
+    monkeypatch.setattr(gate, '_enter', unavailable)
+    monkeypatch.setattr(gate, '_leave', unavailable)
+    decisions = [gate.enter('GET /shoplist') for _ in range(3)]
+    assert all(decision.allowed for decision in decisions)
+    for decision in decisions:
+        gate.leave('GET /shoplist', decision)
+    assert gate.stats()['in_flight'] == 0
+    assert gate.stats()['redis_errors'] == 3
+
+
+def test_route_concurrency():
+    gate = make_admission({"POST /shoplist/batch": {"concurrency": 1}})
+    entered = gate.enter('POST /shoplist/batch')
+    assert entered.allowed
+
+    decision = gate.enter('POST /shoplist/batch')
+    assert decision.status == 429
+    assert decision.reason == 'route_concurrency'
+    # другие маршруты ограничены только общим пределом
+    assert gate.enter('GET /shoplist').allowed
+
+    gate.leave('POST /shoplist/batch', entered)
+    assert gate.enter('POST /shoplist/batch').allowed
+
+
+def test_event_stream_not_counted():
+    # RATE_LIMITS=off не должен включать учёт потоков событий
+    gate = make_admission({}, max_in_flight=1)
+    streams = [gate.enter('GET /shoplist/events') for _ in range(5)]
+    assert all(decision.allowed for decision in streams)
+    assert gate.stats()['in_flight'] == 0
+    assert gate.enter('GET /shoplist').allowed
+    gate.leave('GET /shoplist/events', streams[0])
+    assert gate.stats()['in_flight'] == 1
+
+
+def test_load_limits(monkeypatch):
+    monkeypatch.setenv('RATE_LIMITS', 'off')
+    assert load_limits() == {}
+
+    monkeypatch.setenv('RATE_LIMITS', '{"*": {"ip": null}, "POST /shoplist": {"concurrency": 5}}')
+    limits = load_limits()
+    assert limits['*'] == {"user": [20, 40], "ip": None}
+    assert limits['POST /shoplist'] == {"concurrency": 5}
+    assert limits['POST /auth'] == admission.default_limits['POST /auth']
+
+    gate = make_admission(limits)
+    assert gate.route_limits('POST /shoplist') == {"user": [20, 40], "ip": None, "concurrency": 5}
+    assert gate.bucket('POST /shoplist', 'ip', '10.0.0.1') is None
+
+
+def test_default_max_in_flight(monkeypatch):
+    # предел не зависит от модели воркеров: он общий для всех процессов шлюза
+    monkeypatch.delenv('MAX_IN_FLIGHT', raising=False)
+    assert make_admission({}, max_in_flight=None).max_in_flight == admission.default_max_in_flight
+    monkeypatch.setenv('MAX_IN_FLIGHT', '50')
+    assert make_admission({}, max_in_flight=None).max_in_flight == 50
+
+
+def test_gateway_overload(stack, monkeypatch):
+    import api
+    monkeypatch.setattr(api.admission, 'max_in_flight', 0)
+    client = stack['api'].test_client()
+
+    response = client.get('/shoplist', query_string={"token": "token"})
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
+    assert client.get('/healthz').status_code == 200
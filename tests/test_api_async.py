@@ -0,0 +1,108 @@
+""" Шлюз в режиме asyncio (api_async.py) поверх сервисов в процессе: запросы к апстримам
+передаются в их Flask-приложения через local_transport, Redis - fakeredis.aioredis """
+import asyncio
+import uuid
+
+import pytest
+
+pytest.importorskip('aiohttp')
+from aiohttp.test_utils import TestClient, TestServer
+
+
+@pytest.fixture(scope='module')
+def api_async(stack):
+    import fakeredis.aioredis
+    import redis.asyncio
+    # клиенты redis.asyncio создаются при импорте модуля
+    redis.asyncio.Redis = fakeredis.aioredis.FakeRedis
+    import api_async
+    return api_async
+
+
+@pytest.fixture
+def local_upstreams(stack, api_async, monkeypatch):
+    from async_service_client import ServiceResponse
+    from local_transport import LocalDispatcher
+
+    for client, app in ((api_async.auth_client, stack['auth']),
+                        (api_async.shoplist_client, stack['shoplist'])):
+        dispatcher = LocalDispatcher(app)
+
+        async def request(method, path='', params=None, dispatcher=dispatcher, **kwargs):
+            r = dispatcher.request(method, path, params=params, json=kwargs.get('json'),
+                                   headers=kwargs.get('headers'))
+            return ServiceResponse(r.status_code, r.headers, r.content)
+
+        monkeypatch.setattr(client, 'request', request)
+
+
+def run(api_async, scenario):
+    """ Выполнить scenario(client) с тестовым сервером шлюза в новом event loop """
+    async def main():
+        async with TestClient(TestServer(api_async.create_app())) as client:
+            await scenario(client)
+
+    asyncio.run(main())
+
+
+async def register(client):
+    user = uuid.uuid4().hex
+    response = await client.post('/register', json={"user": user, "password": "testpassword"})
+    assert response.status == 200
+    return user, (await response.json())['token']
+
+
+def test_shoplist(api_async, local_upstreams):
+    async def scenario(client):
+        user, token = await register(client)
+        response = await client.post('/shoplist', json={"token": token, "name": "milk"})
+        assert response.status == 201
+
+        response = await client.get('/shoplist', params={"token": token})
+        assert response.status == 200
+        assert [item['name'] for item in await response.json()] == ['milk']
+        etag = response.headers['ETag']
+        response = await client.get('/shoplist', params={"token": token},
+                                    headers={"If-None-Match": etag})
+        assert response.status == 304
+
+        version = int(etag.strip('"'))
+        await client.post('/shoplist', json={"token": token, "name": "bread"})
+        response = await client.get('/shoplist', params={"token": token, "since": version})
+        content = await response.json()
+        assert [item['name'] for item in content['items']] == ['bread']
+
+    run(api_async, scenario)
+
+
+def test_logout_invalidates(api_async, local_upstreams):
+    async def scenario(client):
+        user, token = await register(client)
+        assert (await client.get('/shoplist', params={"token": token})).status == 200
+        assert api_async.token_cache.get(token) == user
+
+        assert (await client.post('/logout', json={"token": token})).status == 200
+        assert api_async.token_cache.get(token) is None
+        assert (await client.get('/shoplist', params={"token": token})).status == 400
+
+    run(api_async, scenario)
+
+
+def test_health(api_async, local_upstreams):
+    async def scenario(client):
+        assert (await client.get('/healthz')).status == 200
+        response = await client.get('/readyz')
+        assert response.status == 200
+        assert (await response.json())['checks'] == {"auth": "ok", "shoplist": "ok"}
+
+    run(api_async, scenario)
+
+
+def test_invalid_token(api_async, local_upstreams):
+    async def scenario(client):
+        assert (await client.get('/shoplist')).status == 400
+        response = await client.get('/shoplist', params={"token": "missing"})
+        assert response.status == 400
+        assert await response.json() == {"error": "invalid token"}
+
+    run(api_async, scenario)
@@ -0,0 +1,82 @@
+""" /batch сервиса shoplist: остановка на первой ошибке в ordered-режиме, ответы /bulk без
+результатов операций и без JSON """
+import uuid
+
+import pytest
+
+import live_events
+
+
+@pytest.fixture
+def shoplist(stack):
+    import shoplist
+    return shoplist
+
+
+class FakeResponse:
+    def __init__(self, status_code, content, content_type):
+        self.status_code = status_code
+        self.content = content
+        self.headers = {"Content-Type": content_type}
+
+    def json(self):
+        raise ValueError("not json")
+
+
+def run_batch(shoplist, user, operations, **params):
+    response = shoplist.app.test_client().post('/batch', json={"user": user,
+                                                               "operations": operations,
+                                                               **params})
+    return response.status_code, response.get_json()
+
+
+def statuses(content):
+    return [result['status'] for result in content['results']]
+
+
+def test_ordered_stops_on_precheck_error(shoplist, monkeypatch):
+    requests = []
+    request = shoplist.database_request
+
+    def counting(params, method, *args, **kwargs):
+        requests.append(method)
+        return request(params, method, *args, **kwargs)
+
+    monkeypatch.setattr(shoplist, 'database_request', counting)
+    user = uuid.uuid4().hex
+    status, content = run_batch(shoplist, user, [{"op": "buy", "name": "milk"},
+                                                 {"op": "delete", "name": "milk", "shop": ""}])
+    assert status == 200
+    assert statuses(content) == ['error', 'skipped']
+    assert content['status'] == 'error'
+    assert 'BULK' not in requests
+
+
+def test_unordered_continues(shoplist):
+    user = uuid.uuid4().hex
+    status, content = run_batch(shoplist, user, [{"op": "buy", "name": "milk"},
+                                                 {"op": "delete", "name": "milk", "shop": ""}],
+                                ordered=False)
+    assert statuses(content) == ['error', 'success']
+
+
+def test_bulk_without_results(shoplist, monkeypatch):
+    user = uuid.uuid4().hex
+    request = shoplist.database_request
+
+    def failing_bulk(params, method, *args, **kwargs):
+        if method == 'BULK':
+            return FakeResponse(504, b'<html>Gateway Timeout</html>', 'text/html')
+        return request(params, method, *args, **kwargs)
+
+    monkeypatch.setattr(shoplist, 'database_request', failing_bulk)
+    pubsub = shoplist.redis.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(live_events.channel(user))
+
+    status, content = run_batch(shoplist, user, [{"op": "delete", "name": "milk", "shop": ""}])
+    assert status == 504
+    assert content == {"error": "batch failed"}
+    # часть операций могла выполниться: версия увеличена, но событие без операций не отправлено
+    assert shoplist.get_version(user) == (1, True)
+    assert pubsub.get_message(timeout=0.1) is None
+    pubsub.close()
@@ -0,0 +1,51 @@
+""" Бенчмарк эндпоинтов (benchmarks/bench_services.py): нагрузка проходит по стенду в процессе
+без ошибок, перцентили, сравнение с сохранёнными результатами """
+import pytest
+
+
+@pytest.fixture
+def bench(stack):
+    import bench_services
+    return bench_services
+
+
+def test_workload(stack, bench):
+    runner = bench.Runner(stack['api'])
+    bench.workload(runner, users=2, items=3, reads=2)
+    result = bench.summarize(runner.timings)
+    assert set(result) == {'POST /register', 'POST /auth', 'GET /auth', 'POST /shoplist',
+                           'GET /shoplist (3 items)', 'POST /shoplist/bought', 'DELETE /shoplist'}
+    assert result['POST /shoplist']['count'] == 6
+    assert result['GET /shoplist (3 items)']['count'] == 4
+    assert all(row['p50_ms'] <= row['p95_ms'] <= row['p99_ms'] for row in result.values())
+
+
+def test_failed_request(stack, bench, monkeypatch):
+    import api
+    from local_transport import LocalResponse
+    runner = bench.Runner(stack['api'])
+    user = runner.call('POST', '/register', json={"user": "bench_failed", "password": "password"})
+    token = user.get_json()['token']
+    # ответ 5xx останавливает бенчмарк, а не остаётся незамеченным в перцентилях
+    monkeypatch.setattr(api.shoplist_client, 'get', lambda *args, **kwargs: LocalResponse(
+        503, {"Content-Type": "application/json"}, b'{"error": "database unavailable"}'))
+    with pytest.raises(RuntimeError):
+        runner.call('GET', '/shoplist', query_string={"token": token})
+    assert len(runner.timings['GET /shoplist']) == 1
+
+
+def test_percentile(bench):
+    values = [i / 1000 for i in range(1, 101)]
+    assert bench.percentile(values, 50) == 0.051
+    assert bench.percentile(values, 99) == 0.099
+    assert bench.percentile([0.5], 95) == 0.5
+
+
+def test_compare(bench):
+    baseline = {"GET /auth": {"p50_ms": 1.0, "rps": 1000},
+                "POST /auth": {"p50_ms": 1.0, "rps": 1000}}
+    result = {"GET /auth": {"p50_ms": 1.2, "rps": 900},
+              "POST /auth": {"p50_ms": 1.5, "rps": 700},
+              "GET /shoplist": {"p50_ms": 9.0, "rps": 10}}
+    assert bench.compare(result, baseline, 0.25) == ["POST /auth: p50 1.0ms -> 1.5ms",
+                                                     "POST /auth: req/s 1000 -> 700"]
@@ -0,0 +1,77 @@
+""" Пакетная запись сервиса database: /bulk со вставками и удалениями, ordered и unordered при
+ошибке, вставка нескольких документов одним POST """
+import uuid
+
+import pytest
+
+
+@pytest.fixture
+def client(stack):
+    return stack['database'].test_client()
+
+
+@pytest.fixture
+def base():
+    return {"database": "organizer", "collection": "bulk_test"}
+
+
+def count(client, base, **query):
+    response = client.get('/', query_string={**base, **query})
+    return 0 if response.status_code == 404 else len(response.get_json())
+
+
+def test_insert_and_delete(client, base):
+    name = uuid.uuid4().hex
+    response = client.post('/bulk', json={**base, "operations": [
+        {"op": "insert", "data": {"name": name, "shop": "s1"}},
+        {"op": "insert", "data": {"name": name, "shop": "s2"}},
+        {"op": "delete", "query": {"name": name, "shop": "s1"}}]})
+    assert response.status_code == 200
+    content = response.get_json()
+    assert content['status'] == 'success'
+    assert (content['inserted'], content['deleted']) == (2, 1)
+    assert [result['status'] for result in content['results']] == ['success'] * 3
+    assert 'inserted' in content['results'][0]
+    assert count(client, base, name=name) == 1
+
+
+@pytest.mark.parametrize('ordered, statuses, inserted', [
+    (True, ['success', 'error', 'skipped'], 1),
+    (False, ['success', 'error', 'success'], 2),
+])
+def test_duplicate_key(client, base, ordered, statuses, inserted):
+    key = uuid.uuid4().hex
+    response = client.post('/bulk', json={**base, "ordered": ordered, "operations": [
+        {"op": "insert", "data": {"_id": key, "name": key}},
+        {"op": "insert", "data": {"_id": key, "name": key}},
+        {"op": "insert", "data": {"_id": key + '2', "name": key}}]})
+    assert response.status_code == 400
+    content = response.get_json()
+    assert content['status'] == 'error'
+    assert [result['status'] for result in content['results']] == statuses
+    assert content['inserted'] == inserted
+    assert count(client, base, name=key) == inserted
+
+
+@pytest.mark.parametrize('operations', [
+    [],
+    [{"op": "replace", "query": {}}],
+    [{"op": "insert"}],
+])
+def test_incorrect_operations(client, base, operations):
+    response = client.post('/bulk', json={**base, "operations": operations})
+    assert response.status_code == 400
+
+
+def test_insert_many(client, base):
+    name = uuid.uuid4().hex
+    response = client.post('/', json={**base, "data": [{"name": name, "shop": shop}
+                                                       for shop in ("s1", "s2", "s3")]})
+    assert response.status_code == 201
+    assert len(response.get_json()['output']) == 3
+
+    response = client.delete('/', json={**base, "data": [{"name": name, "shop": "s1"},
+                                                         {"name": name, "shop": "s2"}]})
+    assert response.status_code == 201
+    assert response.get_json()['deleted'] == 2
+    assert count(client, base, name=name) == 1
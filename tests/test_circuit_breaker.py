@@ -0,0 +1,125 @@
+""" Circuit breaker апстрима: closed -> open -> half_open, пробные запросы и удвоение open """
+import pytest
+
+import circuit_breaker
+from circuit_breaker import CircuitBreaker, CircuitOpen
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(circuit_breaker.time, 'monotonic', clock)
+    return clock
+
+
+def make_breaker():
+    return CircuitBreaker('test', failure_rate=0.5, min_calls=4, window=10, slow_call=1,
+                          open_seconds=5, max_open_seconds=12, probes=2)
+
+
+def call(breaker, failed=False, seconds=0.01):
+    probe = breaker.before_call()
+    breaker.after_call(probe, failed, seconds)
+    return probe
+
+
+def trip(breaker):
+    for _ in range(4):
+        call(breaker, failed=True)
+    assert breaker.state == 'open'
+
+
+def test_opens_on_failure_rate(clock):
+    breaker = make_breaker()
+    call(breaker, failed=True)
+    call(breaker, failed=True)
+    # меньше min_calls запросов - breaker остаётся closed
+    assert breaker.state == 'closed'
+    call(breaker)
+    call(breaker, failed=True)
+    assert breaker.state == 'open'
+
+    with pytest.raises(CircuitOpen):
+        breaker.before_call()
+    assert breaker.stats()['rejected'] == 1
+
+
+def test_slow_calls_are_failures(clock):
+    breaker = make_breaker()
+    for _ in range(4):
+        call(breaker, seconds=2)
+    assert breaker.state == 'open'
+
+
+def test_old_failures_leave_window(clock):
+    breaker = make_breaker()
+    for _ in range(3):
+        call(breaker, failed=True)
+    clock.now += 11
+    call(breaker, failed=True)
+    assert breaker.state == 'closed'
+
+
+def test_half_open_probes(clock):
+    breaker = make_breaker()
+    trip(breaker)
+    clock.now += 5
+
+    assert breaker.before_call() is True
+    assert breaker.state == 'half_open'
+    assert breaker.before_call() is True
+    # больше probes одновременных пробных запросов не пропускается
+    with pytest.raises(CircuitOpen):
+        breaker.before_call()
+
+    breaker.after_call(True, False, 0.01)
+    assert breaker.state == 'half_open'
+    breaker.after_call(True, False, 0.01)
+    assert breaker.state == 'closed'
+    # после закрытия окно начинается заново
+    call(breaker, failed=True)
+    assert breaker.state == 'closed'
+
+
+def test_failed_probe_doubles_open_time(clock):
+    breaker = make_breaker()
+    trip(breaker)
+    assert breaker.stats()['open_for'] == 5
+
+    clock.now += 5
+    call(breaker, failed=True)
+    assert breaker.state == 'open'
+    assert breaker.stats()['open_for'] == 10
+    clock.now += 5
+    with pytest.raises(CircuitOpen):
+        breaker.before_call()
+
+    clock.now += 5
+    call(breaker, failed=True)
+    # не больше max_open_seconds
+    assert breaker.stats()['open_for'] == 12
+    assert breaker.stats()['opened'] == 3
+
+    clock.now += 12
+    call(breaker)
+    call(breaker)
+    assert breaker.state == 'closed'
+    trip(breaker)
+    assert breaker.stats()['open_for'] == 5
+
+
+def test_late_response_ignored(clock):
+    breaker = make_breaker()
+    probe = breaker.before_call()
+    trip(breaker)
+    # ответ на запрос, отправленный до перехода в open, не меняет состояние
+    breaker.after_call(probe, False, 0.01)
+    assert breaker.state == 'open'
@@ -0,0 +1,109 @@
+""" Дедлайн запроса: передача оставшегося времени в X-Request-Timeout и ответ 504 """
+import time
+
+import pytest
+from flask import Flask, jsonify, request
+
+import deadline
+import service_client
+
+
+def make_app(default_timeout=None):
+    app = Flask(__name__)
+    deadline.setup_deadline(app, default_timeout)
+    service_client.register_breakers(app)
+    return app
+
+
+@pytest.fixture
+def upstream():
+    """ Апстрим, который возвращает полученный заголовок дедлайна """
+    app = make_app()
+
+    @app.route('/echo')
+    def echo():
+        return jsonify({"header": request.headers.get(deadline.deadline_header),
+                        "remaining": deadline.remaining()})
+
+    return app
+
+
+@pytest.fixture
+def gateway(upstream):
+    app = make_app(default_timeout=2)
+    client = service_client.ServiceClient('upstream-test', 'http://upstream')
+    client.mount_local(upstream)
+
+    @app.route('/proxy')
+    def proxy():
+        return jsonify(client.get('/echo').json())
+
+    @app.route('/slow')
+    def slow():
+        time.sleep(0.2)
+        client.get('/echo')
+        return jsonify({})
+
+    app.upstream_client = client
+    return app
+
+
+def test_outgoing_headers():
+    assert deadline.outgoing_headers() == {}
+    token = deadline.start(time.monotonic() + 1.5)
+    try:
+        value = int(deadline.outgoing_headers()[deadline.deadline_header])
+        assert 1400 < value <= 1500
+        with deadline.suspended():
+            assert deadline.outgoing_headers() == {}
+    finally:
+        deadline.finish(token)
+    assert deadline.remaining() is None
+
+
+def test_incoming_deadline():
+    now = time.monotonic()
+    assert 0.4 < deadline.incoming_deadline('500') - now <= 0.6
+    assert 2.9 < deadline.incoming_deadline(None, 3) - now <= 3.1
+    # некорректный заголовок - как его отсутствие
+    assert 2.9 < deadline.incoming_deadline('soon', 3) - now <= 3.1
+    assert deadline.incoming_deadline(None) is None
+
+
+def test_deadline_propagated(gateway):
+    content = gateway.test_client().get('/proxy').get_json()
+    assert 1500 < int(content['header']) <= 2000
+    assert 1.4 < content['remaining'] <= 2
+
+    content = gateway.test_client().get('/proxy', headers={deadline.deadline_header: '800'}).get_json()
+    assert 500 < int(content['header']) <= 800
+
+
+def test_expired_header(upstream):
+    response = upstream.test_client().get('/echo', headers={deadline.deadline_header: '0'})
+    assert response.status_code == 504
+    assert response.get_json() == {"error": "deadline exceeded"}
+
+
+def test_upstream_call_after_deadline(gateway):
+    # до запроса к апстриму дедлайн уже истёк: он не отправляется, ответ - 504
+    response = gateway.test_client().get('/slow', headers={deadline.deadline_header: '100'})
+    assert response.status_code == 504
+    assert gateway.upstream_client.requests == 0
+
+
+def test_request_timeout_bounded_by_deadline():
+    assert service_client.request_timeout((2, 30)) == (2, 30)
+    token = deadline.start(time.monotonic() + 1)
+    try:
+        connect, read = service_client.request_timeout((2, 30))
+        assert connect <= 1 and read <= 1
+    finally:
+        deadline.finish(token)
+
+    token = deadline.start(time.monotonic() - 1)
+    try:
+        with pytest.raises(deadline.DeadlineExceeded):
+            service_client.request_timeout((2, 30))
+    finally:
+        deadline.finish(token)
@@ -0,0 +1,86 @@
+""" ETag списка покупок через шлюз: 304 по If-None-Match, новая версия после изменения, изменения
+без результата (удаление и /bought несуществующего элемента) не меняют версию """
+import uuid
+
+import pytest
+
+import live_events
+
+
+@pytest.fixture
+def client(stack):
+    return stack['api'].test_client()
+
+
+@pytest.fixture
+def shoplist(stack):
+    import shoplist
+    return shoplist
+
+
+def register(client):
+    user = uuid.uuid4().hex
+    response = client.post('/register', json={"user": user, "password": "testpassword"})
+    return user, response.get_json()['token']
+
+
+def get_list(client, token, etag=None):
+    headers = {"If-None-Match": etag} if etag else {}
+    return client.get('/shoplist', query_string={"token": token}, headers=headers)
+
+
+def test_not_modified(client):
+    user, token = register(client)
+    response = get_list(client, token)
+    assert response.status_code == 200
+    etag = response.headers['ETag']
+
+    response = get_list(client, token, etag)
+    assert response.status_code == 304
+    assert response.data == b''
+    assert response.headers['ETag'] == etag
+
+    assert client.post('/shoplist', json={"token": token, "name": "milk"}).status_code == 201
+    response = get_list(client, token, etag)
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    assert [item['name'] for item in response.get_json()] == ['milk']
+    assert get_list(client, token, response.headers['ETag']).status_code == 304
+
+
+def test_noop_keeps_version(client, shoplist):
+    user, token = register(client)
+    client.post('/shoplist', json={"token": token, "name": "milk", "shop": "s1"})
+    etag = get_list(client, token).headers['ETag']
+    # список в кэше
+    assert shoplist.shoplist_cache.get(user)[0] is not None
+    pubsub = shoplist.redis.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(live_events.channel(user))
+
+    response = client.delete('/shoplist', json={"token": token, "name": "bread", "shop": "s1"})
+    assert response.status_code == 404
+    response = client.post('/shoplist/bought', json={"token": token, "name": "bread",
+                                                     "shop": "s1", "bought": "true"})
+    assert response.status_code == 404
+
+    assert get_list(client, token, etag).status_code == 304
+    assert shoplist.shoplist_cache.get(user)[0] is not None
+    assert pubsub.get_message(timeout=0.1) is None
+
+    response = client.delete('/shoplist', json={"token": token, "name": "milk", "shop": "s1"})
+    assert response.status_code == 200
+    assert get_list(client, token, etag).status_code == 200
+    message = pubsub.get_message(timeout=1)
+    assert message is not None and b'"delete"' in message['data']
+    pubsub.close()
+
+
+def test_since_after_noop(client):
+    user, token = register(client)
+    client.post('/shoplist', json={"token": token, "name": "milk"})
+    version = int(get_list(client, token).headers['ETag'].strip('"'))
+    client.delete('/shoplist', json={"token": token, "name": "bread", "shop": ""})
+
+    response = client.get('/shoplist', query_string={"token": token, "since": version})
+    assert response.status_code == 200
+    assert response.get_json() == {"version": version, "items": [], "deleted": []}
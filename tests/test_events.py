@@ -0,0 +1,113 @@
+""" Поток событий /shoplist/events шлюза на потоках и подписки EventHub поверх Redis pub/sub """
+import asyncio
+import json
+import uuid
+
+import pytest
+from redis import ConnectionError as RedisConnectionError
+
+import live_events
+
+
+@pytest.fixture
+def api(stack, monkeypatch):
+    import api
+    monkeypatch.setattr(api, 'events_heartbeat', 0.1)
+    return api
+
+
+def register(client):
+    user = uuid.uuid4().hex
+    response = client.post('/register', json={"user": user, "password": "testpassword"})
+    return user, response.get_json()['token']
+
+
+def next_event(chunks):
+    """ Следующее событие потока, heartbeat пропускаются """
+    for chunk in chunks:
+        if chunk.startswith(b':'):
+            continue
+        name, data = chunk.decode().strip().split('\n')
+        return name[len('event: '):], json.loads(data[len('data: '):])
+    return None
+
+
+def test_events_stream(api):
+    client = api.app.test_client()
+    user, token = register(client)
+    response = client.get('/shoplist/events', query_string={"token": token}, buffered=False)
+    assert response.status_code == 200
+    assert response.mimetype == 'text/event-stream'
+    chunks = iter(response.response)
+    assert next_event(chunks) == ('subscribed', {"type": "subscribed"})
+    assert api.event_hub.stats()['subscribers'] == 1
+
+    assert client.post('/shoplist', json={"token": token, "name": "milk", "shop": "s1"}) \
+        .status_code == 201
+    name, event = next_event(chunks)
+    assert name == 'change'
+    assert event['ops'][0]['op'] == 'add' and event['ops'][0]['name'] == 'milk'
+
+    # клиент отключился: подписка снимается
+    response.close()
+    assert user not in api.event_hub.subscribers
+
+
+def test_events_without_redis(api, monkeypatch):
+    client = api.app.test_client()
+    user, token = register(client)
+
+    def unavailable(*args, **kwargs):
+        raise RedisConnectionError("redis is down")
+
+    monkeypatch.setattr(api.event_hub, 'max_subscribers', 10)
+    monkeypatch.setattr(api.event_hub.redis, 'pubsub', unavailable)
+    monkeypatch.setattr(api.event_hub, '_pubsub', None)
+    response = client.get('/shoplist/events', query_string={"token": token})
+    assert response.status_code == 503
+    assert user not in api.event_hub.subscribers
+
+
+class SlowPubSub:
+    """ Подписка на канал ждёт release и завершается ошибкой Redis """
+
+    def __init__(self):
+        self.release = asyncio.Event()
+
+    async def subscribe(self, name):
+        await self.release.wait()
+        raise RedisConnectionError("redis is down")
+
+
+class FakeRedis:
+    def __init__(self):
+        self.pubsub_connection = SlowPubSub()
+
+    def pubsub(self):
+        return self.pubsub_connection
+
+
+def test_failed_subscribe_keeps_other_subscribers():
+    """ Пока первый подписчик ждёт подписки на канал, подключается второй: ошибка подписки
+    убирает только первого """
+    async def run():
+        redis = FakeRedis()
+        hub = live_events.EventHub(redis)
+        hub._reader = asyncio.get_running_loop().create_future()
+        first = asyncio.ensure_future(hub.subscribe('user'))
+        await asyncio.sleep(0)
+        second = await hub.subscribe('user')
+        redis.pubsub_connection.release.set()
+        with pytest.raises(RedisConnectionError):
+            await first
+        assert hub.subscribers == {'user': {second}}
+
+    asyncio.run(run())
+
+
+def test_subscription_overflow():
+    subscription = live_events.ThreadSubscription('user', 2)
+    for n in range(3):
+        subscription.push({"type": "change", "version": n})
+    assert subscription.get(0) == {"type": "resync"}
+    assert subscription.dropped == 3
@@ -0,0 +1,66 @@
+""" /healthz и /readyz всех сервисов, выбор модели воркеров gunicorn из окружения """
+import importlib
+
+import pytest
+import redis
+import requests
+
+
+@pytest.mark.parametrize('service', ['api', 'auth', 'shoplist', 'database'])
+def test_ready(stack, service):
+    client = stack[service].test_client()
+    assert client.get('/healthz').get_json() == {"status": "ok"}
+    response = client.get('/readyz')
+    assert response.status_code == 200
+    content = response.get_json()
+    assert content['status'] == 'ok'
+    assert set(content['checks'].values()) == {"ok"}
+
+
+def test_redis_unavailable(stack, monkeypatch):
+    import auth
+
+    def execute_command(*args, **kwargs):
+        raise redis.ConnectionError("redis unavailable")
+
+    # проверка готовности держит связанный метод ping, поэтому отказ - на уровне команд
+    monkeypatch.setattr(auth.redis, 'execute_command', execute_command)
+    client = stack['auth'].test_client()
+    # процесс жив, но принимать запросы не готов
+    assert client.get('/healthz').status_code == 200
+    response = client.get('/readyz')
+    assert response.status_code == 503
+    assert response.get_json() == {"status": "unavailable",
+                                   "checks": {"redis": "redis unavailable", "database": "ok"}}
+
+
+def test_upstream_unavailable(stack, monkeypatch):
+    import api
+
+    def get(*args, **kwargs):
+        raise requests.ConnectionError("connection refused")
+
+    monkeypatch.setattr(api.shoplist_client, 'get', get)
+    response = stack['api'].test_client().get('/readyz')
+    assert response.status_code == 503
+    checks = response.get_json()['checks']
+    assert checks['auth'] == 'ok'
+    assert checks['shoplist'] == 'connection refused'
+
+
+@pytest.mark.parametrize('name, worker_class', [
+    ('sync', 'sync'),
+    ('threaded', 'gthread'),
+    ('aiohttp', 'aiohttp.GunicornWebWorker'),
+])
+def test_worker_class(monkeypatch, name, worker_class):
+    import gunicorn_conf
+    monkeypatch.setenv('WORKER_CLASS', name)
+    monkeypatch.setenv('WORKERS', '3')
+    try:
+        conf = importlib.reload(gunicorn_conf)
+        assert conf.worker_class == worker_class
+        assert conf.workers == 3
+    finally:
+        monkeypatch.undo()
+        importlib.reload(gunicorn_conf)
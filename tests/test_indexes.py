@@ -0,0 +1,84 @@
+""" Индексы сервиса database: создание объявленных индексов через POST /admin/indexes, уникальность
+пользователя и элемента списка, разбор плана запроса для /admin/explain """
+import uuid
+
+import pytest
+
+
+@pytest.fixture
+def database(stack):
+    import database
+    return database
+
+
+class FakeCursor:
+    def __init__(self, explain):
+        self._explain = explain
+
+    def sort(self, sort):
+        return self
+
+    def explain(self):
+        return self._explain
+
+
+class FakeCollection:
+    def __init__(self, explain):
+        self._explain = explain
+
+    def find(self, query):
+        return FakeCursor(self._explain)
+
+
+def test_ensure_indexes(database):
+    client = database.app.test_client()
+    response = client.post('/admin/indexes')
+    assert response.status_code == 200
+    content = response.get_json()
+    assert 'user_unique' in content['organizer.users']
+    assert 'user_name_shop_unique' in content['organizer.shoplist']
+
+    for (db_name, collection_name), models in database.indexes.items():
+        names = database.client[db_name][collection_name].index_information().keys()
+        assert {model.document['name'] for model in models} <= set(names)
+
+
+def test_unique_user(database):
+    client = database.app.test_client()
+    client.post('/admin/indexes')
+    user = uuid.uuid4().hex
+    base = {"database": "organizer", "collection": "users"}
+    assert client.post('/', json={**base, "data": [{"user": user}]}).status_code == 201
+    response = client.post('/', json={**base, "data": [{"user": user}]})
+    assert response.status_code == 400
+    assert response.get_json()['results'][0]['status'] == 'error'
+
+
+def test_explain_summary(database):
+    explain = {"queryPlanner": {"namespace": "organizer.shoplist", "winningPlan": {
+        "stage": "FETCH",
+        "inputStage": {"stage": "IXSCAN", "indexName": "user_name_shop_unique"}}}}
+    summary = database.explain_summary(FakeCollection(explain), {"user": ""})
+    assert summary['stages'] == ['FETCH', 'IXSCAN']
+    assert summary['indexes'] == ['user_name_shop_unique']
+    assert not summary['collscan']
+
+    explain = {"queryPlanner": {"namespace": "organizer.shoplist", "winningPlan": {
+        "queryPlan": {"stage": "SORT", "inputStage": {"stage": "COLLSCAN"}}}}}
+    summary = database.explain_summary(FakeCollection(explain), {"user": ""}, [('name', 1)])
+    assert summary['stages'] == ['SORT', 'COLLSCAN']
+    assert summary['indexes'] == []
+    assert summary['collscan']
+
+
+@pytest.mark.parametrize('db_name, collection_name, query', [
+    ('organizer', 'users', {"user": ""}),
+    ('organizer', 'shoplist', {"user": "", "name": "", "shop": ""}),
+    ('organizer', 'shoplist_versions', {"user": ""}),
+])
+def test_hot_queries_indexed(database, db_name, collection_name, query):
+    """ Для каждого горячего запроса объявлен индекс, начинающийся с его полей """
+    assert (db_name, collection_name, query) in database.hot_queries
+    keys = [list(model.document['key'].keys())
+            for model in database.indexes[(db_name, collection_name)]]
+    assert any(key[:len(query)] == list(query) for key in keys)
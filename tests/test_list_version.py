@@ -0,0 +1,119 @@
+""" Версия списка shoplist без блокировки: номер изменения из $inc, версия для читателей во время
+параллельных изменений, прерванные изменения и ошибки записи версии """
+import time
+import uuid
+
+import pytest
+
+
+@pytest.fixture
+def shoplist(stack):
+    import shoplist
+    return shoplist
+
+
+op = {"op": "add", "name": "milk", "shop": ""}
+
+
+def versions(shoplist, user):
+    r = shoplist.database_request({"user": user}, 'GET', shoplist.versions_collection)
+    return r.json()[0]
+
+
+def test_sequential_changes(shoplist):
+    user = uuid.uuid4().hex
+    assert shoplist.get_version(user) == (0, True)
+    # изменение без операций (ничего не найдено) не меняет версию
+    with shoplist.list_change(user, []) as version:
+        assert version == 1
+    assert shoplist.get_version(user) == (0, True)
+    for expected in (2, 3, 4):
+        with shoplist.list_change(user, [op]) as version:
+            assert version == expected
+        assert shoplist.get_version(user) == (expected, True)
+    assert versions(shoplist, user)['done'] == 4
+
+
+def test_concurrent_changes(shoplist):
+    """ Второе изменение завершилось раньше первого: пока первое выполняется, читатели получают
+    версию, до которой все изменения записаны, и список без ETag """
+    user = uuid.uuid4().hex
+    with shoplist.list_change(user, [op]):
+        pass
+    client = shoplist.app.test_client()
+
+    with shoplist.list_change(user, [op]) as first:
+        with shoplist.list_change(user, [op]) as second:
+            assert (first, second) == (2, 3)
+            assert shoplist.get_version(user) == (1, False)
+        # второе завершено, первое ещё нет
+        assert shoplist.get_version(user) == (1, False)
+        response = client.get('/', query_string={"user": user})
+        assert response.status_code == 200
+        assert 'ETag' not in response.headers
+        response = client.get('/', query_string={"user": user, "since": 3})
+        assert response.get_json()['version'] == 1
+    assert shoplist.get_version(user) == (3, True)
+    assert client.get('/', query_string={"user": user}).headers['ETag'] == '"3"'
+
+
+def test_interrupted_change(shoplist, monkeypatch):
+    """ Изменение, которое не завершилось (процесс упал), засчитывается следующим """
+    monkeypatch.setattr(shoplist, 'list_change_timeout', 0.2)
+    user = uuid.uuid4().hex
+    shoplist.reserve_version(user)
+    assert shoplist.get_version(user) == (0, False)
+    time.sleep(0.3)
+    assert shoplist.get_version(user) == (0, True)
+
+    with shoplist.list_change(user, [op]) as version:
+        assert version == 2
+    doc = versions(shoplist, user)
+    assert doc['done'] == doc['next'] == 2
+    assert shoplist.get_version(user) == (2, True)
+
+
+def test_no_change_without_database(shoplist, monkeypatch):
+    class Unavailable:
+        status_code = 503
+
+    monkeypatch.setattr(shoplist, 'database_request', lambda *args, **kwargs: Unavailable())
+    user = uuid.uuid4().hex
+    with pytest.raises(shoplist.ListBusy):
+        with shoplist.list_change(user, []):
+            pytest.fail("change must not run without a version")
+
+
+def test_version_not_saved(shoplist, monkeypatch):
+    request = shoplist.database_request
+
+    def failing_completion(params, method, collection_name=shoplist.collection, options=None):
+        if method == 'PUT' and collection_name == shoplist.versions_collection and \
+                'return_document' not in params:
+            return None
+        return request(params, method, collection_name, options)
+
+    monkeypatch.setattr(shoplist, 'database_request', failing_completion)
+    user = uuid.uuid4().hex
+    response = shoplist.app.test_client().post('/', json={"user": user, "name": "milk",
+                                                          "shop": ""})
+    assert response.status_code == 503
+
+
+def test_find_and_update(stack):
+    client = stack['database'].test_client()
+    base = {"database": "organizer", "collection": "counters_test",
+            "query": {"name": uuid.uuid4().hex}, "update": {"$inc": {"value": 1}}}
+
+    response = client.put('/', json={**base, "upsert": True, "return_document": "before"})
+    assert response.status_code == 201
+    assert response.get_json()['document'] is None
+    response = client.put('/', json={**base, "return_document": "after"})
+    assert response.status_code == 200
+    assert response.get_json()['document']['value'] == 2
+
+    assert client.put('/', json={**base, "query": {"name": "missing"},
+                                 "return_document": "after"}).status_code == 404
+    assert client.put('/', json={**base, "return_document": "new"}).status_code == 400
+    assert client.put('/', json={**base, "return_document": "after",
+                                 "write_concern": 0}).status_code == 400
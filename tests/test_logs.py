@@ -0,0 +1,88 @@
+""" Общий слой логирования: JSON-формат, отбрасывание записей при переполненной очереди,
+сэмплирование записей запроса и перечитывание конфигурации из файла """
+import json
+import logging
+import queue
+
+import pytest
+from flask import Flask, g
+
+import logs
+
+
+def make_record(level=logging.INFO, message='item %s added', args=('milk',)):
+    return logging.LogRecord('test', level, __file__, 1, message, args, None)
+
+
+@pytest.fixture
+def app():
+    app = Flask('test')
+
+    @app.route('/items')
+    def items():
+        return ''
+
+    return app
+
+
+def test_json_format():
+    record = make_record()
+    record.service = 'shoplist'
+    data = json.loads(logs.JsonFormatter().format(record))
+    assert data['level'] == 'INFO'
+    assert data['service'] == 'shoplist'
+    assert data['message'] == 'item milk added'
+
+
+def test_full_queue_drops_records():
+    handler = logs.DroppingQueueHandler(queue.Queue(maxsize=1))
+    handler.handle(make_record())
+    handler.handle(make_record())
+    assert handler.queue.qsize() == 1
+    assert handler.dropped == 1
+
+
+def test_request_sampling(app):
+    request_filter = logs.RequestFilter('shoplist')
+    with app.test_request_context('/items'):
+        g.log_sampled = False
+        assert not request_filter.filter(make_record())
+        # предупреждения и ошибки не сэмплируются
+        assert request_filter.filter(make_record(logging.WARNING))
+        g.log_sampled = True
+        record = make_record()
+        assert request_filter.filter(record)
+        assert record.endpoint == 'items'
+    # записи вне запроса не отбрасываются
+    assert request_filter.filter(make_record())
+
+
+def test_config_reload(tmp_path, monkeypatch):
+    monkeypatch.setattr(logs, 'reload_interval', 0)
+    path = tmp_path / 'logging.json'
+    path.write_text(json.dumps({"level": "info", "sampling": {"*": 0.5, "items": 0.1},
+                                "services": {"shoplist": {"level": "debug",
+                                                          "sampling": {"items": 1}}}}))
+    logger = logging.getLogger('test_config_reload')
+    config = logs.LogConfig('shoplist', logger, str(path))
+    config.refresh()
+    assert config.level == 'DEBUG'
+    assert logger.level == logging.DEBUG
+    assert config.sample_rate('items') == 1
+    assert config.sample_rate('summary') == 0.5
+
+    # некорректный файл не сбрасывает текущие настройки
+    path.write_text('{')
+    config._mtime = None
+    config.refresh()
+    assert config.level == 'DEBUG'
+
+
+def test_setup_logging(app):
+    config = logs.setup_logging(app, 'shoplist')
+    config.apply('INFO', {"items": 0})
+    with app.test_client() as client:
+        client.get('/items')
+        assert g.log_sampled is False
+    assert app.extensions['logs']['config'] is config
+    assert isinstance(app.logger.handlers[0], logs.DroppingQueueHandler)
@@ -0,0 +1,75 @@
+""" Метрики Prometheus: входящие запросы по шаблону маршрута, запросы к апстримам, команды Redis,
+обращения к кэшу списка и эндпоинт /metrics """
+import uuid
+
+import pytest
+from prometheus_client import REGISTRY
+
+
+@pytest.fixture
+def client(stack):
+    return stack['api'].test_client()
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+def register(client):
+    user = uuid.uuid4().hex
+    response = client.post('/register', json={"user": user, "password": "testpassword"})
+    return user, response.get_json()['token']
+
+
+def test_requests_by_route(client):
+    user, token = register(client)
+    labels = {"service": "api", "route": "/shoplist", "method": "GET", "status": "200"}
+    count = sample('http_requests_total', **labels)
+    observed = sample('http_request_duration_seconds_count', **labels)
+
+    client.get('/shoplist', query_string={"token": token})
+    assert sample('http_requests_total', **labels) == count + 1
+    assert sample('http_request_duration_seconds_count', **labels) == observed + 1
+    # путь без маршрута не создаёт отдельную метку
+    before = sample('http_requests_total', service="api", route="unmatched", method="GET",
+                    status="404")
+    client.get(f'/missing/{uuid.uuid4().hex}')
+    assert sample('http_requests_total', service="api", route="unmatched", method="GET",
+                  status="404") == before + 1
+
+
+def test_upstream_and_redis(client):
+    upstream = {"service": "api", "upstream": "shoplist", "method": "POST", "status": "200"}
+    command = {"service": "auth", "command": "PIPELINE", "status": "ok"}
+    user, token = register(client)
+    before = (sample('upstream_request_duration_seconds_count', **upstream),
+              sample('redis_command_duration_seconds_count', **command))
+
+    client.post('/shoplist', json={"token": token, "name": "milk"})
+    # токен ещё не в кэше шлюза: auth проверяет его pipeline-запросом к Redis
+    assert sample('upstream_request_duration_seconds_count', **upstream) == before[0] + 1
+    assert sample('redis_command_duration_seconds_count', **command) > before[1]
+
+
+def test_cache_events(stack):
+    import shoplist
+    user = uuid.uuid4().hex
+    client = stack['shoplist'].test_client()
+    events = {event: sample('cache_events_total', service="shoplist", cache="shoplist",
+                            event=event) for event in ('hit', 'miss')}
+
+    client.get('/', query_string={"user": user})
+    client.get('/', query_string={"user": user})
+    assert sample('cache_events_total', service="shoplist", cache="shoplist",
+                  event="miss") == events['miss'] + 1
+    assert sample('cache_events_total', service="shoplist", cache="shoplist",
+                  event="hit") == events['hit'] + 1
+    assert shoplist.shoplist_cache.stats()['hit'] >= 1
+
+
+@pytest.mark.parametrize('service', ['api', 'auth', 'shoplist', 'database'])
+def test_metrics_endpoint(stack, service):
+    response = stack[service].test_client().get('/metrics')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    assert b'http_requests_total' in response.data
@@ -0,0 +1,69 @@
+""" Read preference и write concern запросов к сервису БД """
+import uuid
+
+import pytest
+from pymongo import WriteConcern
+from pymongo.read_preferences import Primary, SecondaryPreferred
+
+
+@pytest.fixture
+def database(stack):
+    import database
+    return database
+
+
+@pytest.mark.parametrize('value, expected', [
+    (1, WriteConcern(w=1)),
+    ("1", WriteConcern(w=1)),
+    ("0", WriteConcern(w=0)),
+    ("majority", WriteConcern(w="majority")),
+    ({"w": "2", "j": True}, WriteConcern(w=2, j=True)),
+    ({"w": "majority", "wtimeout": 1000}, WriteConcern(w="majority", wtimeout=1000)),
+])
+def test_write_concern(database, value, expected):
+    assert database.parse_write_concern(value) == expected
+
+
+@pytest.mark.parametrize('value', ["dc-east", True, -1, 1.5, {"w": "tags"}, {"fsync": True}])
+def test_incorrect_write_concern(database, value):
+    with pytest.raises(database.IncorrectSettings):
+        database.parse_write_concern(value)
+
+
+def test_read_preference(database):
+    assert database.parse_read_preference(None) is None
+    assert database.parse_read_preference("primary") == Primary()
+    assert database.parse_read_preference({"mode": "secondaryPreferred", "max_staleness": 120}) \
+        == SecondaryPreferred(max_staleness=120)
+    for value in ("fastest", {"mode": "primary", "tags": [{}]}, {"mode": "nearest",
+                                                                  "max_staleness": "1"}):
+        with pytest.raises(database.IncorrectSettings):
+            database.parse_read_preference(value)
+
+
+def test_collection_settings(database, monkeypatch):
+    monkeypatch.setattr(database, 'collection_settings',
+                        {"organizer.items": {"write_concern": {"w": "1"},
+                                             "read_preference": "secondaryPreferred"}})
+    collection = database.get_collection('organizer', 'items')
+    assert collection.write_concern == WriteConcern(w=1)
+    assert collection.read_preference == SecondaryPreferred()
+    # параметры запроса (GET - строками) важнее настроек коллекции
+    collection = database.get_collection('organizer', 'items', {"write_concern": "0",
+                                                                "read_preference": "primary"})
+    assert collection.write_concern == WriteConcern(w=0)
+    assert collection.read_preference == Primary()
+
+
+def test_request_settings(stack):
+    client = stack['database'].test_client()
+    base = {"database": "organizer", "collection": uuid.uuid4().hex}
+
+    response = client.post('/', json={**base, "data": [{"n": 1}], "write_concern": "1"})
+    assert response.status_code == 201
+    response = client.post('/', json={**base, "data": [{"n": 2}], "write_concern": "dc-east"})
+    assert response.status_code == 400
+    response = client.get('/', query_string={**base, "read_preference": "nearest"})
+    assert response.status_code == 200
+    response = client.get('/', query_string={**base, "read_preference": "fastest"})
+    assert response.status_code == 400
@@ -0,0 +1,65 @@
+""" Режим монолита: service_client вызывает приложения апстримов в процессе через
+local_transport, без сокетов; параметры, тело, заголовки и статусы передаются как по сети """
+import uuid
+
+import pytest
+import requests
+from flask import Flask, jsonify, request
+
+from local_transport import LocalDispatcher
+
+
+@pytest.fixture
+def echo():
+    app = Flask('echo')
+
+    @app.route('/echo', methods=['GET', 'POST'])
+    def echo_handler():
+        return jsonify({"args": request.args.to_dict(), "json": request.get_json(silent=True),
+                        "header": request.headers.get('X-Test')}), int(request.args.get('status', 200))
+
+    return LocalDispatcher(app)
+
+
+def test_local_request(echo):
+    r = echo.request('POST', '/echo', params={"name": "milk"}, json={"amount": 2},
+                     headers={"X-Test": "value"}, timeout=(1, 2))
+    assert r.status_code == 200
+    assert r.json() == {"args": {"name": "milk"}, "json": {"amount": 2}, "header": "value"}
+    r.raise_for_status()
+
+
+def test_local_error(echo):
+    r = echo.request('GET', '/echo', params={"status": 503})
+    assert r.status_code == 503
+    with pytest.raises(requests.HTTPError) as e:
+        r.raise_for_status()
+    assert e.value.response is r
+    assert echo.request('GET', '/missing').status_code == 404
+
+
+def test_upstreams_mounted(stack):
+    import service_client
+    client = stack['api'].test_client()
+    user = uuid.uuid4().hex
+    token = client.post('/register', json={"user": user, "password": "testpassword"}).get_json()['token']
+    assert client.post('/shoplist', json={"token": token, "name": "milk"}).status_code == 201
+
+    stats = service_client.stats()
+    for name in ('auth', 'shoplist', 'database'):
+        assert stats[name]['local']
+        assert stats[name]['requests'] > 0
+        # запросы не открывают соединений
+        assert stats[name]['connections'] == 0
+
+
+def test_statuses_as_distributed(stack):
+    client = stack['api'].test_client()
+    # ошибки апстримов (неизвестный пользователь в auth, несуществующий элемент в shoplist)
+    # доходят до клиента с теми же статусами, что и по сети
+    response = client.post('/auth', json={"user": uuid.uuid4().hex, "password": "testpassword"})
+    assert response.status_code == 401
+    user = uuid.uuid4().hex
+    token = client.post('/register', json={"user": user, "password": "testpassword"}).get_json()['token']
+    response = client.delete('/shoplist', json={"token": token, "name": "milk", "shop": ""})
+    assert response.status_code == 404
@@ -0,0 +1,57 @@
+""" Чтение сервиса database страницами (limit и after с X-Next-Cursor) и потоком NDJSON """
+import json
+import uuid
+
+import pytest
+
+
+@pytest.fixture
+def client(stack):
+    return stack['database'].test_client()
+
+
+@pytest.fixture
+def items(client):
+    name = uuid.uuid4().hex
+    base = {"database": "organizer", "collection": "pagination_test"}
+    client.post('/', json={**base, "data": [{"name": name, "index": index} for index in range(5)]})
+    return {**base, "name": name}
+
+
+def test_pages(client, items):
+    indexes = []
+    params = {**items, "limit": 2}
+    while True:
+        response = client.get('/', query_string=params)
+        if response.status_code == 404:
+            break
+        page = response.get_json()
+        indexes += [elem['index'] for elem in page]
+        if 'X-Next-Cursor' not in response.headers:
+            assert len(page) < 2
+            break
+        assert response.headers['X-Next-Cursor'] == page[-1]['id']
+        params['after'] = response.headers['X-Next-Cursor']
+    assert indexes == list(range(5))
+
+
+def test_stream(client, items):
+    response = client.get('/', query_string={**items, "stream": "true", "batch_size": 2})
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    lines = [json.loads(line) for line in response.data.splitlines()]
+    assert [elem['index'] for elem in lines] == list(range(5))
+
+    # продолжение потока с id последней полученной строки
+    response = client.get('/', query_string={**items, "stream": "true", "after": lines[2]['id']})
+    assert [json.loads(line)['index'] for line in response.data.splitlines()] == [3, 4]
+
+
+def test_stream_not_found(client, items):
+    response = client.get('/', query_string={**items, "name": "missing", "stream": "true"})
+    assert response.status_code == 404
+
+
+@pytest.mark.parametrize('params', [{"after": "not-an-id"}, {"limit": "many"}])
+def test_incorrect_params(client, items, params):
+    assert client.get('/', query_string={**items, **params}).status_code == 400
@@ -0,0 +1,62 @@
+""" Типизированный запрос /query сервиса БД: проекция, сортировка, подсчёт, агрегация и
+запрет выполнения кода на сервере """
+import uuid
+
+import pytest
+
+
+@pytest.fixture
+def query(stack):
+    client = stack['database'].test_client()
+    collection = uuid.uuid4().hex
+    client.post('/', json={"database": "organizer", "collection": collection,
+                           "data": [{"user": "u", "name": name, "shop": shop, "amount": amount}
+                                    for name, shop, amount in [("a", "s1", 1), ("b", "s1", 2),
+                                                               ("c", "s2", 3)]]})
+
+    def run(body):
+        response = client.post('/query', json={"database": "organizer",
+                                               "collection": collection, **body})
+        return response.status_code, response.get_json()
+
+    return run
+
+
+def test_find(query):
+    status, content = query({"filter": {"amount": {"$gte": 2}}, "projection": ["name"],
+                             "sort": [["name", -1]]})
+    assert status == 200
+    assert [elem['name'] for elem in content['result']] == ['c', 'b']
+    assert 'shop' not in content['result'][0]
+
+    status, content = query({"filter": {"user": "u"}, "projection": {"_id": 0, "shop": 1},
+                             "limit": 1, "skip": 1, "sort": [["name", 1]]})
+    assert content['result'] == [{"shop": "s1"}]
+    assert query({"filter": {"shop": "s1"}, "count": True}) == (200, {"count": 2})
+
+
+def test_aggregate(query):
+    status, content = query({"pipeline": [{"$group": {"_id": "$shop",
+                                                      "amount": {"$sum": "$amount"}}},
+                                          {"$sort": {"_id": 1}}]})
+    assert status == 200
+    assert content['result'] == [{"_id": "s1", "amount": 3}, {"_id": "s2", "amount": 3}]
+
+
+@pytest.mark.parametrize('body', [
+    {"filter": {"$where": "sleep(1000)"}},
+    {"projection": {"name": {"$function": {"body": "function() {}", "args": [],
+                                           "lang": "js"}}}},
+    # выражения в проекции не принимаются, даже без запрещённых операторов
+    {"projection": {"total": {"$add": ["$amount", 1]}}},
+    {"projection": {"name": "1"}},
+    {"pipeline": [{"$lookup": {"from": "users", "localField": "user",
+                               "foreignField": "user", "as": "owner"}}]},
+    {"pipeline": [{"$project": {"x": {"$function": {"body": "function() {}", "args": [],
+                                                    "lang": "js"}}}}]},
+    {"limit": 0},
+])
+def test_rejected(query, body):
+    status, content = query(body)
+    assert status == 400
+    assert 'error' in content
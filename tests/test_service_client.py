@@ -0,0 +1,79 @@
+""" Пул keep-alive соединений service_client: счётчики новых и переиспользованных соединений """
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import service_client
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = b'{"status": "ok"}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if self.path == '/close':
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def upstream():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
+
+
+def test_keep_alive(upstream):
+    client = service_client.ServiceClient('keep-alive-test', upstream)
+    for _ in range(5):
+        assert client.get('/').json() == {"status": "ok"}
+
+    stats = client.stats()
+    assert stats['requests'] == 5
+    assert stats['connections'] == 1
+    assert stats['reused'] == 4
+    client.close()
+
+
+def test_closed_connections_not_reused(upstream):
+    client = service_client.ServiceClient('close-test', upstream)
+    for _ in range(3):
+        assert client.get('/close').status_code == 200
+
+    stats = client.stats()
+    assert stats['connections'] == 3
+    assert stats['reused'] == 0
+    client.close()
+
+
+def test_concurrent_requests_share_pool(upstream):
+    client = service_client.ServiceClient('pool-test', upstream, pool_size=4)
+    barrier = threading.Barrier(4)
+
+    def run():
+        barrier.wait()
+        for _ in range(5):
+            client.get('/')
+
+    threads = [threading.Thread(target=run) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    stats = client.stats()
+    assert stats['connections'] + stats['reused'] == 20
+    assert 1 <= stats['connections'] <= 4
+    client.close()
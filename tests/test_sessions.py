@@ -0,0 +1,112 @@
+""" Сессии auth: выход из одной и из всех сессий, лимит сессий и продление TTL токена """
+import time
+import uuid
+
+import pytest
+
+
+@pytest.fixture
+def api(stack):
+    return stack['api'].test_client()
+
+
+@pytest.fixture
+def auth(stack):
+    import auth
+    return auth
+
+
+def register(api):
+    user = uuid.uuid4().hex
+    token = api.post('/register', json={"user": user, "password": "testpassword"}).get_json()['token']
+    return user, token
+
+
+def login(api, user):
+    return api.post('/auth', json={"user": user, "password": "testpassword"}).get_json()['token']
+
+
+def is_valid(api, token):
+    return api.get('/auth', query_string={"token": token}).status_code == 200
+
+
+def test_logout(api):
+    user, first = register(api)
+    second = login(api, user)
+
+    content = api.post('/logout', json={"token": first}).get_json()
+    assert content['status'] == 'success'
+    assert content['deleted'] == 1
+    assert not is_valid(api, first)
+    assert is_valid(api, second)
+
+    # повторный выход тем же токеном
+    assert api.post('/logout', json={"token": first}).status_code == 401
+
+
+def test_logout_all(api):
+    user, first = register(api)
+    tokens = [first, login(api, user), login(api, user)]
+    assert all(is_valid(api, token) for token in tokens)
+
+    content = api.post('/logout', json={"token": tokens[1], "all": True}).get_json()
+    assert content['deleted'] == 3
+    assert not any(is_valid(api, token) for token in tokens)
+
+
+def test_session_limit_evicts_oldest(api, auth, monkeypatch):
+    monkeypatch.setattr(auth, 'max_sessions', 3)
+    user, first = register(api)
+    tokens = [first] + [login(api, user) for _ in range(3)]
+
+    # вход сверх лимита не отклоняется, а вытесняет самую старую сессию
+    assert not is_valid(api, tokens[0])
+    assert all(is_valid(api, token) for token in tokens[1:])
+    assert auth.redis.zcard(auth.sessions_key(user)) == 3
+
+
+def test_token_refreshed_only_below_threshold(api, auth):
+    user, token = register(api)
+    # проверка напрямую в auth: шлюз отвечает на повторные проверки из своего кэша
+    client = auth.app.test_client()
+
+    # далеко от истечения: проверка токена не продлевает TTL
+    auth.redis.expire(token, auth.token_refresh_threshold + 100)
+    assert client.get('/', query_string={"token": token}).status_code == 200
+    assert auth.redis.ttl(token) <= auth.token_refresh_threshold + 100
+
+    # меньше порога: TTL токена и время истечения в индексе сессий продлеваются
+    auth.redis.expire(token, 60)
+    assert client.get('/', query_string={"token": token}).status_code == 200
+    assert auth.redis.ttl(token) > auth.token_ttl - 10
+    assert auth.redis.zscore(auth.sessions_key(user), token) > time.time() + auth.token_ttl - 10
+
+
+def test_expired_sessions_pruned(api, auth):
+    user, token = register(api)
+    # токен истёк раньше, чем его запись в индексе сессий
+    auth.redis.delete(token)
+    auth.redis.zadd(auth.sessions_key(user), {token: time.time() - 1})
+    second = login(api, user)
+    assert auth.redis.zrange(auth.sessions_key(user), 0, -1) == [second.encode()]
+
+
+def test_evicted_session_leaves_gateway_cache(stack, auth, monkeypatch):
+    import api as gateway
+    client = stack['api'].test_client()
+    for _ in range(50):
+        if gateway.token_cache.active:
+            break
+        time.sleep(0.05)
+    monkeypatch.setattr(auth, 'max_sessions', 1)
+    user, token = register(client)
+    assert client.get('/shoplist', query_string={"token": token}).status_code == 200
+    assert gateway.token_cache.get(token) == user
+
+    login(client, user)
+    for _ in range(50):
+        if gateway.token_cache.get(token) is None:
+            break
+        time.sleep(0.05)
+    assert gateway.token_cache.get(token) is None
+    assert client.get('/shoplist', query_string={"token": token}).status_code == 400
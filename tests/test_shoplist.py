@@ -114,4 +114,91 @@ def test_setbought_shop():
     data = get_shoplist_items(token)
     assert data[0]["bought"] == 'true'
     assert data[1]["bought"] == 'true'
-    assert data[2]["bought"] == 'false'
\ No newline at end of file
+    assert data[2]["bought"] == 'false'
+
+def test_batch():
+    token = register('test', 'testpassword')
+    content = request('POST', '/shoplist/batch', {"token": token, "operations": [
+        {"op": "add", "name": "item1", "shop": "shop1"},
+        {"op": "add", "name": "item1", "shop": "shop1", "amount": 2},
+        {"op": "add", "name": "item2"},
+        {"op": "bought", "name": "item1", "shop": "shop1", "bought": "true"},
+        {"op": "bought", "name": "item3", "bought": "true"},
+        {"op": "delete", "name": "item2", "shop": ""}
+    ]})
+    assert content['status'] == 'error'
+    assert [result['status'] for result in content['results']] == \
+        ['success', 'success', 'success', 'success', 'error', 'success']
+    assert content['results'][4]['error'] == 'item not found'
+
+    data = get_shoplist_items(token)
+    assert len(data) == 1
+    assert data[0]['name'] == 'item1'
+    assert data[0]['amount'] == 3
+    assert data[0]['bought'] == 'true'
+
+
+def test_etag():
+    token = register('test', 'testpassword')
+    r = requests.get(url="https://" + HOST + '/shoplist', params={"token": token}, verify=False)
+    etag = r.headers['ETag']
+    assert r.json() == []
+
+    # список не менялся
+    r = requests.get(url="https://" + HOST + '/shoplist', params={"token": token},
+                     headers={"If-None-Match": etag}, verify=False)
+    assert r.status_code == 304
+    assert r.headers['ETag'] == etag
+
+    # после изменения возвращается новый список и новая версия
+    request('POST', '/shoplist', {"name": "item1", "token": token, "shop": "shop1"})
+    r = requests.get(url="https://" + HOST + '/shoplist', params={"token": token},
+                     headers={"If-None-Match": etag}, verify=False)
+    assert r.status_code == 200
+    assert r.headers['ETag'] != etag
+    assert len(r.json()) == 1
+
+
+def test_changes():
+    token = register('test', 'testpassword')
+    request('POST', '/shoplist', {"name": "item1", "token": token, "shop": "shop1"})
+    request('POST', '/shoplist', {"name": "item2", "token": token, "shop": "shop1"})
+    content = request('GET', '/shoplist', {"token": token, "since": 0})
+    assert len(content['items']) == 2
+    assert content['deleted'] == []
+    version = content['version']
+
+    request('DELETE', '/shoplist', {"name": "item1", "token": token, "shop": "shop1"})
+    request('POST', '/shoplist/bought', {"name": "item2", "token": token, "shop": "shop1", "bought": "true"})
+    content = request('GET', '/shoplist', {"token": token, "since": version})
+    assert content['version'] > version
+    assert len(content['items']) == 1
+    assert content['items'][0]['name'] == 'item2'
+    assert content['items'][0]['bought'] == 'true'
+    assert content['deleted'] == [{"name": "item1", "shop": "shop1", "version": content['deleted'][0]['version']}]
+
+    # изменений нет
+    content = request('GET', '/shoplist', {"token": token, "since": content['version']})
+    assert content['items'] == [] and content['deleted'] == []
+
+
+def test_summary():
+    token = register('test', 'testpassword')
+    request('POST', '/shoplist', {"name": "item1", "token": token, "shop": "shop1", "amount": 2})
+    request('POST', '/shoplist', {"name": "item2", "token": token, "shop": "shop1"})
+    request('POST', '/shoplist', {"name": "item3", "token": token, "shop": "shop2"})
+    request('POST', '/shoplist/bought', {"name": "item2", "token": token, "shop": "shop1", "bought": "true"})
+
+    content = request('GET', '/shoplist/summary', {"token": token})
+    assert content['items'] == 3
+    assert content['unbought'] == 2
+    assert content['shops'] == [{"shop": "shop1", "items": 2, "amount": 3, "unbought": 1},
+                                {"shop": "shop2", "items": 1, "amount": 1, "unbought": 1}]
+
+
+def test_incorrect_input():
+    token = register('test', 'testpassword')
+    assert request('POST', '/shoplist', {"token": token}) == {"error": "incorrect POST input"}
+    assert request('POST', '/shoplist/batch', {"token": token, "operations": "item1"}) == \
+        {"error": "incorrect POST input"}
+    assert get_shoplist_items(token) == []
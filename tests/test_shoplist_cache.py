@@ -0,0 +1,104 @@
+""" Кэш списка покупок в Redis: чтение без БД, сброс при изменении, отброшенная запись
+устаревшего чтения, вытеснение по лимиту памяти и чтение из БД при недоступном Redis """
+import uuid
+
+import pytest
+from redis import RedisError
+
+from shoplist_cache import ShoplistCache
+
+
+@pytest.fixture
+def shoplist(stack):
+    import shoplist
+    return shoplist
+
+
+@pytest.fixture
+def cache(shoplist):
+    # отдельный префикс: счётчик памяти не общий с кэшем сервиса
+    return ShoplistCache(shoplist.redis, 'test', ttl=60, max_bytes=100,
+                         prefix=f'test_{uuid.uuid4().hex}')
+
+
+def count_reads(shoplist, monkeypatch):
+    reads = []
+    read_items = shoplist.read_items
+
+    def counting(user):
+        reads.append(user)
+        return read_items(user)
+
+    monkeypatch.setattr(shoplist, 'read_items', counting)
+    return reads
+
+
+def test_read_from_cache(shoplist, monkeypatch):
+    client = shoplist.app.test_client()
+    user = uuid.uuid4().hex
+    client.post('/', json={"user": user, "name": "milk", "shop": ""})
+    reads = count_reads(shoplist, monkeypatch)
+
+    first = client.get('/', query_string={"user": user})
+    second = client.get('/', query_string={"user": user})
+    assert len(reads) == 1
+    assert first.data == second.data
+    assert first.headers['ETag'] == second.headers['ETag']
+
+    # изменение сбрасывает запись, следующее чтение - из БД
+    client.post('/', json={"user": user, "name": "bread", "shop": ""})
+    assert shoplist.shoplist_cache.get(user)[0] is None
+    response = client.get('/', query_string={"user": user})
+    assert len(reads) == 2
+    assert sorted(item['name'] for item in response.get_json()) == ['bread', 'milk']
+
+
+def test_stale_put(cache):
+    user = uuid.uuid4().hex
+    data, generation = cache.get(user)
+    assert data is None
+    # список изменился между чтением из БД и записью в кэш
+    cache.invalidate(user)
+    cache.put(user, b'1\n[]', generation)
+    assert cache.get(user)[0] is None
+    assert cache.stats()['stale'] == 1
+
+    cache.put(user, b'2\n[]', cache.get(user)[1])
+    assert cache.get(user)[0] == b'2\n[]'
+
+
+def test_eviction(cache):
+    users = [uuid.uuid4().hex for _ in range(3)]
+    for user in users:
+        cache.put(user, b'x' * 40, cache.get(user)[1])
+    # третья запись превысила лимит в 100 байт: вытеснена одна запись с самым ранним временем
+    # истечения (все три записаны в одну секунду)
+    assert [cache.get(user)[0] is None for user in users].count(True) == 1
+    stats = cache.stats()
+    assert stats['evicted'] == 1
+    assert stats['bytes'] == 80
+
+    cache.put(users[0], b'x' * 101, '0')
+    assert cache.stats()['too_large'] == 1
+
+
+def test_disabled(shoplist):
+    cache = ShoplistCache(shoplist.redis, 'test', ttl=0)
+    cache.put('user', b'1\n[]', '0')
+    assert cache.get('user') == (None, None)
+
+
+def test_redis_unavailable(shoplist, monkeypatch):
+    client = shoplist.app.test_client()
+    user = uuid.uuid4().hex
+    client.post('/', json={"user": user, "name": "milk", "shop": ""})
+    errors = shoplist.shoplist_cache.stats()['error']
+
+    def pipeline(*args, **kwargs):
+        raise RedisError("redis unavailable")
+
+    monkeypatch.setattr(shoplist.shoplist_cache.redis, 'pipeline', pipeline)
+    response = client.get('/', query_string={"user": user})
+    assert response.status_code == 200
+    assert [item['name'] for item in response.get_json()] == ['milk']
+    assert shoplist.shoplist_cache.stats()['error'] > errors
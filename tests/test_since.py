@@ -0,0 +1,86 @@
+""" Изменения списка после версии (GET /?since=): созданные и изменённые элементы, записи об
+удалении, 410 для неизвестной версии и очистка старых записей об удалении """
+import uuid
+
+import pytest
+
+
+@pytest.fixture
+def shoplist(stack):
+    import shoplist
+    return shoplist
+
+
+@pytest.fixture
+def client(shoplist):
+    return shoplist.app.test_client()
+
+
+def changes(client, user, since):
+    return client.get('/', query_string={"user": user, "since": since})
+
+
+def names(items):
+    return sorted(item['name'] for item in items)
+
+
+def test_changes(client):
+    user = uuid.uuid4().hex
+    for name in ('milk', 'bread', 'eggs'):
+        client.post('/', json={"user": user, "name": name, "shop": ""})
+    content = changes(client, user, 0).get_json()
+    assert content['version'] == 3
+    assert names(content['items']) == ['bread', 'eggs', 'milk']
+    assert content['deleted'] == []
+
+    client.post('/bought', json={"user": user, "name": "milk", "shop": "", "bought": "true"})
+    client.delete('/', json={"user": user, "name": "bread", "shop": ""})
+    content = changes(client, user, 3).get_json()
+    assert content['version'] == 5
+    assert names(content['items']) == ['milk']
+    assert content['deleted'] == [{"name": "bread", "shop": "", "version": 5}]
+
+    assert changes(client, user, 5).get_json() == {"version": 5, "items": [], "deleted": []}
+
+
+def test_deleted_and_added_again(client):
+    user = uuid.uuid4().hex
+    client.post('/', json={"user": user, "name": "milk", "shop": ""})
+    client.delete('/', json={"user": user, "name": "milk", "shop": ""})
+    client.post('/', json={"user": user, "name": "milk", "shop": ""})
+    content = changes(client, user, 1).get_json()
+    # элемент снова в списке: клиент применяет удаление версии 2, затем элемент версии 3
+    assert [(item['name'], item['version']) for item in content['items']] == [('milk', 3)]
+    assert [elem['version'] for elem in content['deleted']] == [2]
+
+
+def test_unknown_version(shoplist, client, monkeypatch):
+    user = uuid.uuid4().hex
+    for name in ('milk', 'bread', 'eggs'):
+        client.post('/', json={"user": user, "name": name, "shop": ""})
+    response = changes(client, user, 4)
+    assert response.status_code == 410
+    assert response.get_json() == {"error": "unknown version, reload the list"}
+
+    # записи об удалении старше tombstone_retention версий уже могли быть удалены
+    monkeypatch.setattr(shoplist, 'tombstone_retention', 1)
+    assert changes(client, user, 1).status_code == 410
+    assert changes(client, user, 2).status_code == 200
+
+
+def test_compaction(shoplist, client, monkeypatch):
+    monkeypatch.setattr(shoplist, 'compact_every', 2)
+    monkeypatch.setattr(shoplist, 'tombstone_retention', 2)
+    user = uuid.uuid4().hex
+
+    def tombstones():
+        r = shoplist.database_request({"user": user}, 'GET', shoplist.tombstones_collection)
+        return [] if r.status_code == 404 else [elem['version'] for elem in r.json()]
+
+    client.post('/', json={"user": user, "name": "milk", "shop": ""})
+    client.delete('/', json={"user": user, "name": "milk", "shop": ""})
+    client.post('/', json={"user": user, "name": "bread", "shop": ""})
+    client.delete('/', json={"user": user, "name": "bread", "shop": ""})
+    # на версии 4 удаляются записи не новее версии 4 - 2
+    assert tombstones() == [4]
+    assert [elem['name'] for elem in changes(client, user, 2).get_json()['deleted']] == ['bread']
@@ -0,0 +1,92 @@
+""" Кэш токенов шлюза: повторные запросы без auth, отзыв токена через /logout и через канал
+Redis другого процесса, отзыв во время проверки токена """
+import time
+import uuid
+
+import pytest
+
+from token_cache import TokenCache, invalidation_channel, invalidation_message
+
+
+@pytest.fixture
+def api(stack):
+    import api
+    # подписка на канал отзыва устанавливается фоновым потоком
+    for _ in range(50):
+        if api.token_cache.active:
+            break
+        time.sleep(0.05)
+    assert api.token_cache.active
+    return api
+
+
+def register(client):
+    user = uuid.uuid4().hex
+    response = client.post('/register', json={"user": user, "password": "testpassword"})
+    return user, response.get_json()['token']
+
+
+def wait_for(condition):
+    for _ in range(50):
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def test_cached_token(api):
+    client = api.app.test_client()
+    user, token = register(client)
+    assert client.get('/shoplist', query_string={"token": token}).status_code == 200
+    requests = api.auth_client.requests
+    assert client.get('/shoplist', query_string={"token": token}).status_code == 200
+    assert api.auth_client.requests == requests
+    assert api.token_cache.get(token) == user
+
+
+def test_logout_invalidates(api):
+    client = api.app.test_client()
+    user, token = register(client)
+    client.get('/shoplist', query_string={"token": token})
+    assert api.token_cache.get(token) == user
+
+    assert client.post('/logout', json={"token": token}).status_code == 200
+    assert api.token_cache.get(token) is None
+    assert client.get('/shoplist', query_string={"token": token}).status_code == 400
+
+
+def test_invalidation_from_other_process(api):
+    client = api.app.test_client()
+    user, token = register(client)
+    client.get('/shoplist', query_string={"token": token})
+    assert api.token_cache.get(token) == user
+
+    api.redis.publish(invalidation_channel, invalidation_message(user=user))
+    assert wait_for(lambda: api.token_cache.get(token) is None)
+
+
+def test_invalidation_during_check(api, monkeypatch):
+    """ Отзыв пришёл между ответом auth и сохранением в кэш: токен не кэшируется """
+    client = api.app.test_client()
+    user, token = register(client)
+    get = api.auth_client.get
+
+    def get_then_logout(*args, **kwargs):
+        response = get(*args, **kwargs)
+        api.token_cache.apply(invalidation_message(token=token))
+        return response
+
+    monkeypatch.setattr(api.auth_client, 'get', get_then_logout)
+    assert api.check_auth_token(token) == user
+    assert api.token_cache.get(token) is None
+
+
+def test_put_with_old_generation():
+    cache = TokenCache(ttl=30)
+    cache.set_active(True)
+    generation = cache.generation
+    cache.invalidate_user('someone')
+    cache.put('token', 'user', generation)
+    assert cache.get('token') is None
+    cache.put('token', 'user', cache.generation)
+    assert cache.get('token') == 'user'
@@ -0,0 +1,98 @@
+""" Трассировка: один X-Request-Id на всю цепочку сервисов и запись span-ов в NDJSON-файл """
+import json
+import os
+import uuid
+
+import pytest
+
+import tracing
+
+
+class ListExporter:
+    def __init__(self):
+        self.spans = []
+
+    def export(self, span):
+        self.spans.append(span.to_dict())
+
+
+@pytest.fixture
+def spans(stack, monkeypatch):
+    exporter = ListExporter()
+    monkeypatch.setattr(tracing, 'exporter', exporter)
+    return exporter.spans
+
+
+def test_trace_across_services(stack, spans):
+    request_id = uuid.uuid4().hex
+    response = stack['api'].test_client().post(
+        '/register', json={"user": uuid.uuid4().hex, "password": "testpassword"},
+        headers={tracing.request_id_header: request_id})
+    assert response.status_code == 200
+    assert response.headers[tracing.request_id_header] == request_id
+
+    trace = [span for span in spans if span['trace_id'] == request_id]
+    assert len(trace) == len(spans)
+    by_id = {span['span_id']: span for span in trace}
+    services = {(span['service'], span['kind']) for span in trace}
+    assert {('api', 'server'), ('api', 'client'), ('auth', 'server'),
+            ('database', 'server')} <= services
+    root = [span for span in trace if span['parent_id'] is None]
+    assert len(root) == 1 and root[0]['service'] == 'api'
+    # span сервиса - дочерний для span-а запроса к нему
+    for span in trace:
+        if span['kind'] == 'server' and span['service'] != 'api':
+            parent = by_id[span['parent_id']]
+            assert parent['kind'] == 'client'
+            assert parent['name'].split(' ')[1] == span['service']
+
+
+def read_lines(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def make_span(name='GET /'):
+    span = tracing.Span(name, 'test')
+    span.duration = 0.001
+    return span
+
+
+def test_file_exporter_rotation(tmp_path):
+    path = str(tmp_path / 'spans.ndjson')
+    exporter = tracing.FileExporter(path, max_bytes=2000)
+    line = json.dumps(make_span().to_dict()) + '\n'
+    for _ in range(2000 // len(line) + 2):
+        exporter.write(line)
+
+    rotated = read_lines(path + '.1')
+    assert rotated and os.path.getsize(path + '.1') <= 2000
+    assert len(rotated) + len(read_lines(path)) == 2000 // len(line) + 2
+
+
+def test_concurrent_rotation_keeps_rotated_file(tmp_path):
+    """ Два процесса одновременно решили переименовать файл: второй не заменяет <path>.1 """
+    path = str(tmp_path / 'spans.ndjson')
+    first = tracing.FileExporter(path, max_bytes=10 ** 6)
+    second = tracing.FileExporter(path, max_bytes=10 ** 6)
+    first.write('{"n": 1}\n')
+    second.write('{"n": 2}\n')
+
+    first._rotate()
+    first.write('{"n": 3}\n')
+    second._rotate()
+    second.write('{"n": 4}\n')
+
+    assert read_lines(path + '.1') == [{"n": 1}, {"n": 2}]
+    assert read_lines(path) == [{"n": 3}, {"n": 4}]
+
+
+def test_file_exporter_drops_on_full_queue(tmp_path, monkeypatch):
+    path = str(tmp_path / 'spans.ndjson')
+    exporter = tracing.FileExporter(path, queue_size=5)
+    # фоновый поток не запущен: очередь не разбирается
+    monkeypatch.setattr(exporter, '_start_writer', lambda: None)
+    for _ in range(8):
+        exporter.export(make_span())
+    assert exporter.dropped == 3
+    assert exporter._queue.qsize() == 5
@@ -0,0 +1,70 @@
+""" Атомарное увеличение amount с созданием элемента (PUT с update и upsert сервиса БД) """
+import threading
+import uuid
+
+import pytest
+
+
+base = {"database": "organizer", "collection": "upsert_test"}
+
+
+@pytest.fixture
+def client(stack):
+    return stack['database'].test_client()
+
+
+def put(client, query, update, **params):
+    response = client.put('/', json={**base, "query": query, "update": update, **params})
+    return response.status_code, response.get_json()
+
+
+def find(client, query):
+    return client.post('/query', json={**base, "filter": query}).get_json()['result']
+
+
+def test_upsert(client):
+    query = {"user": uuid.uuid4().hex, "name": "milk"}
+    update = {"$inc": {"amount": 2}, "$setOnInsert": {"bought": "false"}}
+    status, content = put(client, query, update, upsert=True)
+    assert status == 201 and 'upserted' in content
+
+    status, content = put(client, query, update, upsert=True)
+    assert status == 200
+    assert content['matched'] == 1 and content['modified'] == 1
+    items = find(client, query)
+    assert len(items) == 1
+    assert items[0]['amount'] == 4 and items[0]['bought'] == 'false'
+
+
+def test_update_without_upsert(client):
+    query = {"user": uuid.uuid4().hex, "name": "milk"}
+    assert put(client, query, {"$set": {"bought": "true"}})[0] == 404
+    assert find(client, query) == []
+
+
+@pytest.mark.parametrize('update', [{}, {"$rename": {"amount": "count"}},
+                                    {"amount": 1}])
+def test_incorrect_operators(client, update):
+    status, content = put(client, {"user": "u"}, update, upsert=True)
+    assert status == 400
+    assert content == {"error": "incorrect update operators"}
+
+
+def test_concurrent_adds(stack):
+    """ Параллельные POST одного элемента складываются в amount одного документа """
+    import shoplist
+    user = uuid.uuid4().hex
+    client = stack['shoplist'].test_client()
+
+    def add():
+        client.post('/', json={"user": user, "name": "milk", "shop": "s1"})
+
+    threads = [threading.Thread(target=add) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    items = shoplist.database_request({"filter": {"user": user}}, 'QUERY').json()['result']
+    assert len(items) == 1
+    assert items[0]['amount'] == 8
@@ -0,0 +1,88 @@
+""" Ошибки апстримов в ответах шлюза: статус апстрима сохраняется, тело может быть не JSON """
+import json
+import uuid
+
+import pytest
+
+
+class FakeResponse:
+    def __init__(self, status_code, content, content_type='application/json', headers=None):
+        self.status_code = status_code
+        self.content = content.encode()
+        self.headers = {"Content-Type": content_type, **(headers or {})}
+
+    def json(self):
+        return json.loads(self.content)
+
+
+@pytest.fixture
+def api(stack):
+    import api
+    return api
+
+
+def register(client):
+    user = uuid.uuid4().hex
+    response = client.post('/register', json={"user": user, "password": "testpassword"})
+    return response.get_json()['token']
+
+
+def replace(monkeypatch, client, method, response):
+    monkeypatch.setattr(client, method, lambda *args, **kwargs: response)
+
+
+def test_shoplist_busy(api, monkeypatch):
+    client = api.app.test_client()
+    token = register(client)
+    replace(monkeypatch, api.shoplist_client, 'post',
+            FakeResponse(503, '{"error": "list is busy"}', headers={"Retry-After": "1"}))
+
+    response = client.post('/shoplist', json={"token": token, "name": "milk"})
+    assert response.status_code == 503
+    assert response.get_json() == {"error": "list is busy"}
+    assert response.headers['Retry-After'] == '1'
+
+    response = client.post('/shoplist/bought', json={"token": token, "name": "milk",
+                                                     "bought": True})
+    assert response.status_code == 503
+
+
+def test_not_json_error(api, monkeypatch):
+    client = api.app.test_client()
+    token = register(client)
+    replace(monkeypatch, api.shoplist_client, 'delete',
+            FakeResponse(504, '<html>Gateway Timeout</html>', 'text/html'))
+    response = client.delete('/shoplist', json={"token": token, "name": "milk", "shop": ""})
+    assert response.status_code == 504
+    assert response.get_json() == {"error": "upstream error"}
+
+    replace(monkeypatch, api.shoplist_client, 'get', FakeResponse(503, 'unavailable', 'text/plain'))
+    assert client.get('/shoplist', query_string={"token": token}).status_code == 503
+
+    replace(monkeypatch, api.auth_client, 'post', FakeResponse(502, 'Bad Gateway', 'text/plain'))
+    response = client.post('/logout', json={"token": token})
+    assert response.status_code == 502
+    assert response.get_json() == {"error": "upstream error"}
+
+
+def test_register_database_unavailable(api, monkeypatch):
+    import auth
+    client = api.app.test_client()
+    replace(monkeypatch, auth.database_client, 'post',
+            FakeResponse(503, '{"error": "database unavailable"}'))
+    response = client.post('/register', json={"user": uuid.uuid4().hex, "password": "testpassword"})
+    assert response.status_code == 503
+
+    replace(monkeypatch, auth.database_client, 'post', FakeResponse(504, 'timeout', 'text/plain'))
+    response = client.post('/register', json={"user": uuid.uuid4().hex, "password": "testpassword"})
+    assert response.status_code == 504
+    assert response.get_json() == {"error": "deadline exceeded"}
+
+
+def test_register_existing_user(api):
+    client = api.app.test_client()
+    user = uuid.uuid4().hex
+    client.post('/register', json={"user": user, "password": "testpassword"})
+    response = client.post('/register', json={"user": user, "password": "testpassword"})
+    assert response.status_code == 400
+    assert response.get_json() == {"error": "user exists"}
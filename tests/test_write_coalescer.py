@@ -0,0 +1,227 @@
+""" Групповая запись сервиса БД: сбор пакетов по окну, результаты и ошибки каждой записи """
+import threading
+
+import pytest
+from bson import ObjectId
+from pymongo import DeleteMany, InsertOne, UpdateOne, WriteConcern
+from pymongo.errors import (ClientBulkWriteException, DuplicateKeyError, OperationFailure,
+                            WriteConcernError, WriteError)
+from pymongo.results import DeleteResult, InsertOneResult, UpdateResult
+
+from write_coalescer import Batch, PendingWrite, WriteCoalescer, bulk_write_wire_version
+
+
+class Admin:
+    def __init__(self, wire_version):
+        self.wire_version = wire_version
+
+    def command(self, name):
+        return {"maxWireVersion": self.wire_version}
+
+
+class Results:
+    def __init__(self):
+        self.insert_results = {}
+        self.update_results = {}
+        self.delete_results = {}
+
+
+class FakeClient:
+    """ MongoClient.bulk_write: вставки и удаления выполняются успешно, вставка документа с
+    "duplicate" - ошибка 11000; write_concern_error - ошибка подтверждения всего пакета """
+
+    def __init__(self, wire_version=bulk_write_wire_version):
+        self.admin = Admin(wire_version)
+        self.batches = []
+        self.write_concern_error = None
+
+    def bulk_write(self, models, ordered, verbose_results, write_concern):
+        self.batches.append(models)
+        results, errors = Results(), []
+        for index, model in enumerate(models):
+            if isinstance(model, InsertOne):
+                # как и pymongo, _id проставляется прямо во вставляемом документе
+                document = model._doc
+                document.setdefault('_id', ObjectId())
+                if document.get('duplicate'):
+                    errors.append({"idx": index, "code": 11000, "errmsg": "E11000 duplicate key"})
+                else:
+                    results.insert_results[index] = InsertOneResult(document['_id'], True)
+            elif isinstance(model, UpdateOne):
+                results.update_results[index] = UpdateResult({"n": 1, "nModified": 1}, True,
+                                                             in_client_bulk=True)
+            else:
+                results.delete_results[index] = DeleteResult({"n": 2}, True)
+        concern_errors = [self.write_concern_error] if self.write_concern_error else []
+        if errors or concern_errors:
+            raise ClientBulkWriteException({"writeErrors": errors,
+                                            "writeConcernErrors": concern_errors,
+                                            "anySuccessful": True,
+                                            "insertResults": results.insert_results,
+                                            "updateResults": results.update_results,
+                                            "deleteResults": results.delete_results,
+                                            "nInserted": 0, "nMatched": 0, "nModified": 0,
+                                            "nUpserted": 0, "nDeleted": 0}, True)
+        return results
+
+
+class FakeCollection:
+    def __init__(self, name='organizer.shoplist', write_concern=None):
+        self.full_name = name
+        self.write_concern = write_concern or WriteConcern()
+
+
+def write_concurrently(coalescer, writes):
+    """ Выполнить записи (операция, аргументы) в отдельных потоках: индекс -> результат/ошибка """
+    out = {}
+
+    def run(index, operation, args):
+        try:
+            out[index] = coalescer.write(FakeCollection(), operation, *args)
+        except Exception as e:
+            out[index] = e
+
+    threads = [threading.Thread(target=run, args=(index, operation, args))
+               for index, (operation, args) in enumerate(writes)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return out
+
+
+def test_writes_in_window_share_batch():
+    client = FakeClient()
+    coalescer = WriteCoalescer(client, 'test', window=0.2, max_ops=100)
+    out = write_concurrently(coalescer, [(InsertOne, ({"n": n},)) for n in range(8)])
+
+    assert [len(batch) for batch in client.batches] == [8]
+    assert all(isinstance(result, InsertOneResult) for result in out.values())
+    assert len({result.inserted_id for result in out.values()}) == 8
+    stats = coalescer.stats()
+    assert stats['batches'] == 1 and stats['writes'] == 8 and stats['average_batch'] == 8
+
+
+def test_full_batch_flushed_before_window():
+    client = FakeClient()
+    coalescer = WriteCoalescer(client, 'test', window=5, max_ops=3)
+    write_concurrently(coalescer, [(DeleteMany, ({"n": n},)) for n in range(6)])
+
+    assert sorted(len(batch) for batch in client.batches) == [3, 3]
+
+
+def test_errors_mapped_to_writes():
+    client = FakeClient()
+    coalescer = WriteCoalescer(client, 'test', window=0.2, max_ops=100)
+    out = write_concurrently(coalescer, [(InsertOne, ({"duplicate": True},)),
+                                         (InsertOne, ({"n": 1},)),
+                                         (DeleteMany, ({"n": 1},))])
+
+    assert len(client.batches) == 1
+    # ошибка одной записи не отменяет остальные записи пакета
+    assert sum(isinstance(result, DuplicateKeyError) for result in out.values()) == 1
+    assert sum(isinstance(result, InsertOneResult) for result in out.values()) == 1
+    assert sum(isinstance(result, DeleteResult) for result in out.values()) == 1
+    assert coalescer.stats()['errors'] == 1
+
+
+def make_batch(count):
+    batch = Batch(FakeCollection())
+    batch.writes = [PendingWrite(InsertOne({"n": n})) for n in range(count)]
+    return batch
+
+
+def test_assign():
+    coalescer = WriteCoalescer(FakeClient(), 'test', window=0.01, max_ops=100)
+    batch = make_batch(4)
+    results = Results()
+    results.insert_results[0] = InsertOneResult(1, True)
+    results.delete_results[3] = DeleteResult({"n": 5}, True)
+    coalescer.assign(batch, results, [{"idx": 1, "code": 11000, "errmsg": "duplicate"},
+                                      {"idx": 2, "code": 121, "errmsg": "validation"}])
+
+    first, second, third, fourth = batch.writes
+    assert first.result.inserted_id == 1 and first.error is None
+    assert type(second.error) is DuplicateKeyError and second.error.code == 11000
+    assert type(third.error) is WriteError and third.error.code == 121
+    assert fourth.result.deleted_count == 5 and fourth.error is None
+
+
+def test_assign_write_concern_error():
+    coalescer = WriteCoalescer(FakeClient(), 'test', window=0.01, max_ops=100)
+    batch = make_batch(2)
+    results = Results()
+    results.delete_results[0] = DeleteResult({"n": 3}, True)
+    interrupted = OperationFailure("interrupted")
+    coalescer.assign(batch, results, (), [{"code": 64, "errmsg": "waiting for replication"}],
+                     interrupted)
+
+    first, second = batch.writes
+    assert isinstance(first.error, WriteConcernError) and first.error.code == 64
+    # запись выполнена, её результат доступен в ошибке
+    assert first.error.partial_result.deleted_count == 3
+    # bulk_write прервался до второй операции
+    assert second.result is None and second.error is interrupted
+
+
+def test_disabled():
+    assert not WriteCoalescer(FakeClient(), 'test', window=0, max_ops=100) \
+        .accepts(FakeCollection())
+    coalescer = WriteCoalescer(FakeClient(), 'test', window=0.01, max_ops=100)
+    # без подтверждения записи нет результатов операций
+    assert not coalescer.accepts(FakeCollection(write_concern=WriteConcern(w=0)))
+    assert coalescer.accepts(FakeCollection())
+    # MongoDB до 8.0 не поддерживает клиентский bulkWrite
+    old = WriteCoalescer(FakeClient(bulk_write_wire_version - 1), 'test', window=0.01,
+                         max_ops=100)
+    assert not old.accepts(FakeCollection())
+
+
+@pytest.fixture
+def database(stack, monkeypatch):
+    import database
+    client = FakeClient()
+    monkeypatch.setattr(database, 'write_coalescer',
+                        WriteCoalescer(client, 'database', window=0.01, max_ops=100))
+    database.fake_client = client
+    return database
+
+
+def test_database_write_concern_error(database):
+    """ Ошибка write concern групповой записи - тот же ответ, что у insert_many и bulk_write """
+    database.fake_client.write_concern_error = {"code": 64, "errmsg": "waiting for replication"}
+    client = database.app.test_client()
+    base = {"database": "organizer", "collection": "coalescer_test"}
+
+    response = client.post('/', json={**base, "data": [{"n": 1}]})
+    assert response.status_code == 200
+    content = response.get_json()
+    assert content['inserted'] == 1
+    assert content['results'][0]['status'] == 'success'
+
+    response = client.delete('/', json={**base, "data": [{"n": 1}]})
+    assert response.status_code == 200
+    assert response.get_json()['deleted'] == 2
+
+
+def test_database_duplicate_key(database):
+    client = database.app.test_client()
+    base = {"database": "organizer", "collection": "coalescer_test"}
+
+    response = client.post('/', json={**base, "data": [{"duplicate": True}]})
+    assert response.status_code == 400
+    assert response.get_json()['results'][0]['status'] == 'error'
+    assert len(database.fake_client.batches) == 1
+
+
+def test_database_without_window(database, monkeypatch):
+    """ WRITE_COALESCE_WINDOW_MS=0: одиночные записи выполняются сразу, без bulk_write """
+    monkeypatch.setattr(database.write_coalescer, 'window', 0)
+    client = database.app.test_client()
+    base = {"database": "organizer", "collection": "coalescer_test"}
+
+    response = client.post('/', json={**base, "data": [{"n": 2}]})
+    assert response.status_code == 201
+    assert len(response.get_json()['output']) == 1
+    assert client.delete('/', json={**base, "data": [{"n": 2}]}).get_json()['deleted'] == 1
+    assert database.fake_client.batches == []